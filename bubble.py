@@ -7,6 +7,21 @@ from collections import defaultdict
 from parse_tree import ParseNode
 from replacement_utils import get_overlaps
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Bubbles whose contexts make at least this many pairs are compared with NumPy
+# (if it is installed), all their pairs of contexts at once.
+MIN_VECTORIZED_CONTEXT_PAIRS = 16
+
+# Ids of the symbols in contexts, for the context matrices
+SYMBOL_IDS = {}
+PAD_ID = -2
+DUMMY_ID = -1
+SIDE_WEIGHTS = [1 / (2 ** (i + 2)) for i in range(4)]
+
 
 
 @functools.lru_cache(maxsize=None)
@@ -80,6 +95,35 @@ class Context:
             return lhs_score + rhs_score
 
 
+def side_ids(side: Tuple[str], reversed=False):
+    """
+    Encodes the side of a context as the ids of its 4 symbols, from the one next
+    to the bubble outwards, padded with PAD_ID.
+    >>> side_ids(('DUMMY',)) == [DUMMY_ID, PAD_ID, PAD_ID, PAD_ID]
+    True
+    """
+    if reversed:
+        side = side[::-1]
+    ids = [DUMMY_ID if elem == 'DUMMY' else SYMBOL_IDS.setdefault(elem, len(SYMBOL_IDS)) for elem in side[:4]]
+    return ids + [PAD_ID] * (4 - len(ids))
+
+
+def side_similarities(sides, other_sides):
+    """
+    Vectorized side_similarity between all the sides (encoded by side_ids) in the
+    (n, 4) array `sides` and the (m, 4) array `other_sides`. Returns an (n, m) array.
+    """
+    sides, other_sides = sides[:, None, :], other_sides[None, :, :]
+    identical = (sides == other_sides).all(axis=2)
+    padded, other_padded = sides == PAD_ID, other_sides == PAD_ID
+    # Stop at the first position where only one of the sides ended
+    not_stopped = numpy.logical_and.accumulate(padded == other_padded, axis=2)
+    dummy = (sides == DUMMY_ID) | (other_sides == DUMMY_ID)
+    matches = ((sides == other_sides) & ~dummy) & not_stopped
+    score = (matches * numpy.array(SIDE_WEIGHTS)).sum(axis=2)
+    return numpy.where(identical, 0.5, score)
+
+
 class Bubble:
     """
     Represents a `bubble`, that is, a sequence of terminals/nonterminals that are to be
@@ -97,10 +141,18 @@ class Bubble:
         # sources is a map of (tree idx, (child_idxs)) -> range which allows us to map back
         # to the range that was bubbled
         self.sources = defaultdict(list)
+        # Encoded contexts, see context_matrix
+        self.context_ids = None
 
     def add_source(self, tree_idx: int, child_idxs: List[int], seq_range: Tuple[int,int]):
         self.sources[(tree_idx, tuple(child_idxs))].append(seq_range)
 
+    def source_trees(self):
+        """
+        Returns the indices of the trees this bubble occurs in.
+        """
+        return {tree_idx for tree_idx, _ in self.sources}
+
     def add_direct_parent(self, parent):
         self.direct_parents.append(parent)
 
@@ -108,8 +160,11 @@ class Bubble:
         self.occ_count += 1
 
     def add_context(self, context_lhs: List[ParseNode], context_rhs: List[ParseNode]):
-        context = Context(tuple([e.payload for e in context_lhs]), tuple([e.payload for e in context_rhs]))
-        self.contexts[context] += 1
+        self.add_context_symbols(tuple([e.payload for e in context_lhs]), tuple([e.payload for e in context_rhs]))
+
+    def add_context_symbols(self, context_lhs: Tuple[str], context_rhs: Tuple[str], count=1):
+        context = Context(context_lhs, context_rhs)
+        self.contexts[context] += count
 
     def mark_successfully_bubbled(self):
         global SUCCESSFULLY_BUBBLED
@@ -126,7 +181,34 @@ class Bubble:
     # def get_bubble_elems(self):
     #     return self.bubbled_elems
 
+    def context_matrix(self):
+        """
+        Returns the contexts of the bubble encoded as a (number of contexts, 2, 4) array
+        of symbol ids (see side_ids), for the left and right sides.
+        """
+        if self.context_ids is None or len(self.context_ids) != len(self.contexts):
+            self.context_ids = numpy.array([[side_ids(context.lhs, reversed=True), side_ids(context.rhs)]
+                                            for context in self.contexts])
+        return self.context_ids
+
     def context_similarity(self, other):
+        """
+        Returns the maximum similarity of a context of self and a context of other.
+        >>> a, b, c = [ParseNode(x, True, []) for x in 'abc']
+        >>> first, second = Bubble('t1', [a]), Bubble('t2', [b])
+        >>> first.add_context([c], [a, b]); second.add_context([c], [a, c])
+        >>> first.context_similarity(second)
+        0.84375
+        >>> first.add_context([a], [b]); second.add_context([a], [b])
+        >>> first.context_similarity(second)
+        1
+        """
+        if numpy is not None and len(self.contexts) * len(other.contexts) >= MIN_VECTORIZED_CONTEXT_PAIRS:
+            mine, theirs = self.context_matrix(), other.context_matrix()
+            similarities = side_similarities(mine[:, 0], theirs[:, 0]) + side_similarities(mine[:, 1], theirs[:, 1])
+            # Equal contexts have similarity 1, as do contexts with both sides identical
+            best = float(similarities.max())
+            return 1 if best == 1 else best
         num_pairs = 0
         total_similarity = 0
         max_similarity = 0
@@ -143,6 +225,30 @@ class Bubble:
         other_re = re.compile(f"{other.bubble_str}")
         return other.bubble_str in self.bubble_str
 
+    def overlaps(self, other):
+        """
+        Returns true if `self` and `other` were found over some common elements, i.e.
+        if they have a source in the same layer with intersecting ranges. Bubbles that
+        do not overlap can be applied one after the other, in any order.
+        >>> c = ParseNode("c", False, [])
+        >>> bubble_0 = Bubble('t0', [c, c])
+        >>> bubble_0.add_source(0, [1], (0, 1))
+        >>> bubble_1 = Bubble('t1', [c, c])
+        >>> bubble_1.add_source(0, [1], (2, 3))
+        >>> bubble_1.add_source(1, [], (0, 1))
+        >>> bubble_0.overlaps(bubble_1)
+        False
+        >>> bubble_1.add_source(0, [1], (1, 2))
+        >>> bubble_0.overlaps(bubble_1)
+        True
+        """
+        for path, my_ranges in self.sources.items():
+            for my_range in my_ranges:
+                for their_range in other.sources.get(path, []):
+                    if not (my_range[1] < their_range[0] or my_range[0] > their_range[1]):
+                        return True
+        return False
+
     def application_breaks_other(self, other):
         """
         The point of this function is to calculate whether `self` and `other` are overlapping,
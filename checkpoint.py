@@ -0,0 +1,196 @@
+import gzip
+import hashlib
+import os
+import pickle
+import random
+import sys
+import tempfile
+import time
+
+import next_tid
+import verdicts
+from parallel import ORACLE_COUNTERS
+
+"""
+Checkpoints of a run of start.build_trees, so that a long search interrupted by a
+crash, running out of memory or preemption can be resumed (search.py --resume).
+
+A checkpoint is taken at the start of a grouping round of build_trees, once
+CHECKPOINT_INTERVAL seconds or CHECKPOINT_BUBBLES accepted bubbles have passed since
+the last one, and once the bubbling is over. It holds everything the rest of the
+run depends on: the trees, the position in the loop, the nonterminal counter, the
+random state, the coalesce verdicts, the oracle's cache and counters and the timing
+globals. So a resumed run redoes at most the round it was interrupted in, and
+learns the same grammar as an uninterrupted one.
+
+Checkpoints are gzipped pickles (the trees pickle as flat lists of nodes, see
+ParseNode.__reduce__), written to a temporary file and renamed over the previous
+checkpoint, so a crash while writing leaves the previous checkpoint intact. Loading
+a checkpoint unpickles it, which can run arbitrary code: only resume from
+checkpoints you wrote. Once the search completes, its checkpoint is removed.
+"""
+
+# File the search is checkpointed to, None to not checkpoint
+CHECKPOINT_FILE = None
+
+# Checkpoint once this many seconds have passed since the last checkpoint...
+CHECKPOINT_INTERVAL = 600
+
+# ... or once this many bubbles were accepted since then (None to only checkpoint by time)
+CHECKPOINT_BUBBLES = None
+
+# Checkpoint to resume the search from, None to start from scratch
+RESUME_FROM = None
+
+# Bumped when the contents of checkpoints change
+FORMAT_VERSION = 1
+
+
+def examples_fingerprint(leaves):
+    """
+    Returns a fingerprint of the examples `leaves` (lists of leaf ParseNodes), to check
+    that a checkpoint is resumed on the examples it was taken on.
+    >>> from parse_tree import ParseNode
+    >>> examples_fingerprint([[ParseNode('a', True, [])]]) == examples_fingerprint([[ParseNode('b', True, [])]])
+    False
+    """
+    digest = hashlib.sha256()
+    for leaf_lst in leaves:
+        digest.update(repr([leaf.payload for leaf in leaf_lst]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def save_checkpoint(path, state):
+    """
+    Atomically writes the checkpoint `state` (a dict) to `path`.
+    """
+    state = dict(state, format_version=FORMAT_VERSION)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as raw_file:
+            with gzip.GzipFile(fileobj=raw_file, mode='wb', compresslevel=6) as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            raw_file.flush()
+            os.fsync(raw_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_checkpoint(path):
+    """
+    Returns the checkpoint state written to `path` by save_checkpoint.
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'run.ckpt')
+    >>> save_checkpoint(path, {'position': (3, 2)})
+    >>> load_checkpoint(path)['position']
+    (3, 2)
+    """
+    with gzip.open(path, 'rb') as f:
+        state = pickle.load(f)
+    if state.get('format_version') != FORMAT_VERSION:
+        raise ValueError(f"{path} is a checkpoint of another version of Arvada")
+    return state
+
+
+def capture_run_state(oracle):
+    """
+    Returns the state shared by the whole run: the nonterminal counter, the random
+    state, the coalesce verdicts, and the oracle's cache and counters.
+    """
+    return {'next_tid': next_tid.next_tid,
+            'random_state': random.getstate(),
+            'verdicts': dict(verdicts.verdict_memo),
+            'oracle_cache': oracle.cache_set,
+            'oracle_counters': {name: getattr(oracle, name) for name in ORACLE_COUNTERS if hasattr(oracle, name)}}
+
+
+def restore_run_state(state, oracle):
+    """
+    Restores the state captured by capture_run_state into the modules and `oracle`.
+    """
+    next_tid.next_tid = state['next_tid']
+    random.setstate(state['random_state'])
+    verdicts.verdict_memo.clear()
+    verdicts.verdict_memo.update(state['verdicts'])
+    oracle.cache_set.update(state['oracle_cache'])
+    for name, value in state['oracle_counters'].items():
+        setattr(oracle, name, value)
+
+
+def remove_checkpoint():
+    """
+    Removes CHECKPOINT_FILE, once the search it checkpoints has completed.
+    """
+    if CHECKPOINT_FILE is None:
+        return
+    try:
+        os.remove(CHECKPOINT_FILE)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"WARNING: could not remove checkpoint {CHECKPOINT_FILE}: {e}", file=sys.stderr)
+
+
+class Checkpointer():
+    """
+    Decides when build_trees checkpoints, and writes the checkpoints to CHECKPOINT_FILE.
+
+    A run resumed from any of its checkpoints, in a fresh process (so with a fresh
+    oracle and module state), builds the same trees as the uninterrupted run:
+    >>> import contextlib, io, shutil
+    >>> from lark import Lark
+    >>> from oracle import CachingOracle
+    >>> from parse_tree import ParseNode
+    >>> import checkpoint, start
+    >>> def toy_oracle(): return CachingOracle(Lark('start: e\\ne: t (("+"|"*") t)*\\nt: /[0-9]/ | "(" e ")"'))
+    >>> leaves = [[ParseNode(c, True, []) for c in ex] for ex in ['1+2*3', '(4)', '(5*6)+7']]
+    >>> def run(oracle):
+    ...     with contextlib.redirect_stdout(io.StringIO()):
+    ...         trees, _ = start.build_trees(oracle, leaves)
+    ...     return [str(tree) for tree in trees]
+    >>> directory = tempfile.mkdtemp()
+    >>> checkpoint.CHECKPOINT_FILE, checkpoint.CHECKPOINT_BUBBLES = os.path.join(directory, 'run.ckpt'), 1
+    >>> saved = []
+    >>> def save_copy(path, state):
+    ...     save_checkpoint(path, state)
+    ...     saved.append(shutil.copy(path, os.path.join(directory, f'{len(saved)}.ckpt')))
+    >>> checkpoint.save_checkpoint = save_copy
+    >>> random.seed(0); next_tid.next_tid = 1; verdicts.clear_verdicts()
+    >>> trees = run(toy_oracle())
+    >>> checkpoint.save_checkpoint, checkpoint.CHECKPOINT_FILE = save_checkpoint, None
+    >>> resumed = []
+    >>> for path in saved:
+    ...     checkpoint.RESUME_FROM = path
+    ...     random.seed(1); next_tid.next_tid = 1; verdicts.clear_verdicts()
+    ...     resumed.append(run(toy_oracle()) == trees)
+    >>> checkpoint.RESUME_FROM, checkpoint.CHECKPOINT_BUBBLES = None, CHECKPOINT_BUBBLES
+    >>> len(saved) > 1, all(resumed)
+    (True, True)
+    """
+    def __init__(self):
+        self.last_time = time.time()
+        self.accepted = 0
+
+    def bubbles_accepted(self, num_bubbles):
+        self.accepted += num_bubbles
+
+    def due(self):
+        if CHECKPOINT_FILE is None:
+            return False
+        if CHECKPOINT_BUBBLES is not None and self.accepted >= CHECKPOINT_BUBBLES:
+            return True
+        return time.time() - self.last_time >= CHECKPOINT_INTERVAL
+
+    def save(self, state):
+        if CHECKPOINT_FILE is None:
+            return
+        try:
+            save_checkpoint(CHECKPOINT_FILE, state)
+        except OSError as e:
+            print(f"WARNING: could not write checkpoint {CHECKPOINT_FILE}: {e}", file=sys.stderr)
+        self.last_time = time.time()
+        self.accepted = 0
@@ -9,6 +9,7 @@ from grammar import Grammar, Rule
 from start import get_times, START
 from lark import Lark
 from oracle import CachingOracle, ExternalOracle
+import parser_cache
 import string
 
 """
@@ -69,7 +70,7 @@ def main(oracle_cmd, log_file_name, test_examples_folder ):
             exit()
 
         precision_set = learned_grammar.sample_positives(PRECISION_SIZE, 5)
-        parser: Lark = learned_grammar.parser()
+        parser = learned_grammar.parser()
 
         example_gen_time = time.time()
         num_precision_parsed = 0
@@ -127,11 +128,17 @@ if __name__ == '__main__':
     external_parser.add_argument('examples_dir', help='folder containing the test (recall) examples', type=str)
     external_parser.add_argument('log_file', help='log file output from search.py', type=str)
     external_parser.add_argument('-n', '--precision_set_size', help='size of precision set to sample from learned grammar (default 1000)', type=int, default=1000)
+    external_parser.add_argument('--parser_cache', help=f'directory of the on-disk cache of compiled parsers (default {parser_cache.PARSER_CACHE_DIR})', type=str)
+    external_parser.add_argument('--no-parser-cache', help='do not store compiled parsers on disk', action='store_true', dest='no_parser_cache')
 
     args = parser.parse_args()
     if args.mode == 'internal':
         main_internal(args.bench_folder, args.log_file)
     elif args.mode == 'external':
+        if args.no_parser_cache:
+            parser_cache.set_cache_dir(None)
+        elif args.parser_cache is not None:
+            parser_cache.set_cache_dir(args.parser_cache)
         if args.precision_set_size is not None:
             PRECISION_SIZE = args.precision_set_size
         main(args.oracle_cmd, args.log_file, args.examples_dir)
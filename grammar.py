@@ -1,10 +1,22 @@
 import re
-
-from lark import Lark
 import random
 
+from lark.exceptions import GrammarError, LarkError
+
+from parser_cache import get_parser
+from regular import LazyDFA, char_class, lexer_pattern, maximal_regular_nonterminals, non_nullable, nullable, \
+    plus, prefix_overlap, regular_nonterminals
+from sampler import DerivationCounter, GrammarSampler
+
 #random.seed(0)
 
+# Whether Grammar.parser() first tries to compile the grammar to an LALR parser with
+# a contextual lexer, before falling back on the (much slower) scannerless Earley parser.
+COMPILE_TO_LALR = True
+
+# Max length of the positive examples sampled from a grammar.
+MAX_SAMPLE_LENGTH = 300
+
 def elem_fixup(elem: str):
     """
     >>> elem_fixup('"-""')
@@ -42,8 +54,14 @@ class Grammar():
         # Define cacheable values and their valid bits
         self.cached_str = ""
         self.cached_parser = None
+        self.cached_regexes = {}
+        self.cached_sampler = None
+        self.cached_counter = None
         self.str_cache_hash = self._rule_hash()
         self.parser_cache_hash = self._rule_hash()
+        self.regex_cache_hash = self._rule_hash()
+        self.sampler_cache_hash = None
+        self.counter_cache_hash = None
 
     def copy(self):
         new_grammar = Grammar(self.start_symbol)
@@ -75,10 +93,91 @@ class Grammar():
         if self.parser_cache_valid():
             return self.cached_parser
 
-        self.cached_parser = Lark(str(self).replace('\u03B5', ''))
+        # Parsers are shared through the parser cache, so the same grammar is only
+        # compiled once across grammar copies, runs and processes.
+        regexes = self.regexes()
+        if 'start' in regexes:
+            # The whole grammar is regular: match it exactly with a DFA.
+            self.cached_parser = GrammarParser(regex=regexes['start'])
+        else:
+            earley_text = str(self).replace('\u03B5', '')
+            if COMPILE_TO_LALR:
+                compiled_rules, tokens = self.compiled()
+                self.cached_parser = GrammarParser(earley_text, compiled_text(compiled_rules, tokens),
+                                                   lexer_exact=lambda: lexer_is_exact(compiled_rules, tokens))
+            else:
+                self.cached_parser = GrammarParser(earley_text)
         self.parser_cache_hash = self._rule_hash()
         return self.cached_parser
 
+    def regexes(self):
+        """
+        Returns a map from the nonterminals heading the largest regular subgrammars
+        of this grammar (e.g. the integer, identifier or whitespace nonterminals from
+        token expansion) to a Regex matching exactly the strings they derive.
+        """
+        if self.regex_cache_hash == self._rule_hash():
+            return self.cached_regexes
+
+        regexes = regular_nonterminals(self.rules)
+        maximal = maximal_regular_nonterminals(self.rules, regexes)
+        self.cached_regexes = {nt: regexes[nt] for nt in maximal}
+        self.regex_cache_hash = self._rule_hash()
+        return self.cached_regexes
+
+    def compiled(self):
+        """
+        Returns the rules of this grammar for lexer-based parsing, and the map from
+        the names of their regex tokens to their Regexes: runs of adjacent terminals
+        are merged into single tokens, and the regular subgrammars deriving infinitely
+        many strings (see regexes) become regex tokens. Tokens cannot match the empty
+        string, so the regex tokens match the non-empty strings of their subgrammars,
+        and are optional (TOKEN?) in the rules if the subgrammar derives epsilon. The
+        language is unchanged.
+        """
+        token_names = {nt: nt.upper() for nt, regex in self.regexes().items()
+                       if nt != 'start' and regex.is_infinite()}
+        tokens = {token_names[nt]: non_nullable(self.regexes()[nt]) for nt in token_names}
+        optional = {nt for nt in token_names if nullable(self.regexes()[nt])}
+
+        compiled_rules = {}
+        for rule in self.rules.values():
+            if rule.start in token_names:
+                continue
+            compiled_rule = Rule(rule.start)
+            for body in rule.bodies:
+                compiled_body = []
+                for elem in body:
+                    if elem in token_names:
+                        compiled_body.append(token_names[elem] + ('?' if elem in optional else ''))
+                    elif elem in self.rules:
+                        compiled_body.append(elem)
+                    elif len(elem) == 0:
+                        continue
+                    elif compiled_body and compiled_body[-1].startswith('"'):
+                        compiled_body[-1] = compiled_body[-1][:-1] + elem[1:]
+                    else:
+                        compiled_body.append(elem)
+                compiled_rule.add_body(compiled_body if compiled_body else [''])
+            compiled_rules[rule.start] = compiled_rule
+
+        # Only keep the rules still reachable from the start
+        reachable, to_visit = set(), ['start']
+        while to_visit:
+            nt = to_visit.pop()
+            if nt in reachable:
+                continue
+            reachable.add(nt)
+            for body in compiled_rules[nt].bodies:
+                to_visit.extend(elem for elem in body if elem in compiled_rules)
+        return {nt: rule for nt, rule in compiled_rules.items() if nt in reachable}, tokens
+
+    def compiled_str(self):
+        """
+        Returns the Lark representation of the compiled grammar (see compiled).
+        """
+        return compiled_text(*self.compiled())
+
     def sample_negatives(self, n, terminals, max_size):
         """
         Samples n random strings that do not belong to the grammar.
@@ -111,48 +210,78 @@ class Grammar():
 
     def sample_positives(self, n, max_depth):
         """
-        Samples n random strings that do not belong to the grammar.
-        Returns the unique subset of these.
+        Samples n random strings that belong to the grammar, of length at most
+        MAX_SAMPLE_LENGTH. Returns the unique subset of these.
         """
+        sampler = self.sampler()
         samples = set()
         attempts = 0
         while len(samples) < n and attempts < 10*n:
             attempts += 1
-            try:
-                sample = self.generate_positive_example(max_depth)
-                if len(sample) > 300:
-                    continue
+            sample = sampler.sample(max_depth, MAX_SAMPLE_LENGTH)
+            if sample is not None:
                 samples.add(sample)
-            except RecursionError:
-                continue
         return samples
 
-    def generate_positive_example(self, max_depth, start_nonterminal='start', cur_depth=0):
+    def generate_positive_example(self, max_depth, start_nonterminal='start'):
         """
         Samples a random positive example from the grammar, with max_depth as much as possible.
+        Regular subgrammars are sampled from their compiled regex.
+        """
+        return self.sampler().sample(max_depth, start=start_nonterminal)
+
+    def sampler(self):
+        """
+        Returns the GrammarSampler compiled from the current rules.
+        """
+        if self.sampler_cache_hash == self._rule_hash():
+            return self.cached_sampler
+
+        self.cached_sampler = GrammarSampler(self.rules, self.regexes())
+        self.sampler_cache_hash = self._rule_hash()
+        return self.cached_sampler
+
+    def counter(self):
+        """
+        Returns the DerivationCounter of the current rules, for counting, enumerating
+        and uniformly sampling the strings of a given length.
+        """
+        if self.counter_cache_hash == self._rule_hash():
+            return self.cached_counter
+
+        self.cached_counter = DerivationCounter(GrammarSampler(self.rules))
+        self.counter_cache_hash = self._rule_hash()
+        return self.cached_counter
+
+    def sample_positives_of_length(self, n, length):
+        """
+        Samples n strings of exactly `length` characters uniformly at random (among the
+        derivations of that length, see DerivationCounter). Returns the unique subset
+        of these, which is empty if the grammar has no string of that length.
+
+        For an unambiguous grammar, the counts are the numbers of strings of each
+        length, all of which are sampled about equally often:
+        >>> grammar = Grammar('t0')
+        >>> grammar.add_rule(Rule('t0').add_body(['t1', '"+"', 't0']).add_body(['t1']))
+        >>> grammar.add_rule(Rule('t1').add_body(['"1"']).add_body(['"("', 't0', '")"']))
+        >>> strings = list(grammar.counter().enumerate(7))
+        >>> [grammar.counter().count(n) for n in range(8)] == [sum(len(s) == n for s in strings) for n in range(8)]
+        True
+        >>> all(grammar.parser().parse(s) is not None for s in strings)
+        True
+        >>> random.seed(0)
+        >>> samples = [grammar.counter().sample(7) for _ in range(2000)]
+        >>> sorted(set(samples)) == sorted(s for s in strings if len(s) == 7)
+        True
+        >>> 0.7 < min(map(samples.count, set(samples))) / (2000 / len(set(samples)))
+        True
+        >>> grammar.sample_positives_of_length(100, 7) == set(samples), grammar.sample_positives_of_length(10, 2)
+        (True, set())
         """
-        # Helper function: gets all the nonterminals for a body
-        def body_nonterminals(grammar, body):
-            nonterminals = []
-            for item in body:
-                if item in grammar.rules:
-                    nonterminals.append(item)
-            return nonterminals
-        bodies = self.rules[start_nonterminal].bodies
-        # If we've reached the max depth, try to choose a non-recursive rule.
-        if cur_depth >= max_depth:
-            terminal_bodies = [body for body in bodies if len(body_nonterminals(self, body)) == 0]
-            if len(terminal_bodies) > 0:
-                terminal_body = terminal_bodies[random.randint(0, len(terminal_bodies)-1)]
-                return "".join([elem.replace('"', '') for elem in terminal_body])
-            # Otherwise... guess we'll have to try to stop later.
-        body_to_expand = bodies[random.randint(0, len(bodies) -1)]
-        nonterminals_to_expand = body_nonterminals(self, body_to_expand)
-        expanded_body = [self.generate_positive_example(max_depth, elem, cur_depth + 1)
-                                if elem in nonterminals_to_expand
-                                else elem[1:-1]   # really just wanna non-clean up the terminals
-                                for elem in body_to_expand]
-        return "".join(expanded_body)
+        counter = self.counter()
+        if counter.count(length) == 0:
+            return set()
+        return set(counter.sample(length) for _ in range(n))
 
     def __str__(self):
         if self.str_cache_valid():
@@ -172,6 +301,154 @@ class Grammar():
     def size(self):
         return sum([rule.size() for rule in self.rules.values()])
 
+def compiled_text(compiled_rules, tokens):
+    """
+    Returns the Lark representation of the compiled rules and regex tokens of a
+    grammar (see Grammar.compiled). The regex tokens cannot stop before a character
+    continuing them (see regular.lexer_pattern).
+    """
+    lines = [str(rule) for rule in compiled_rules.values()]
+    for token_name, regex in tokens.items():
+        lines.append(f'{token_name}: /{lexer_pattern(regex, LazyDFA(regex).continuation_chars())}/')
+    return '\n'.join(lines).replace('\u03B5', '')
+
+
+def lexer_is_exact(compiled_rules, tokens):
+    """
+    Whether the lexer of the compiled grammar (see Grammar.compiled) always splits the
+    strings of the language into the tokens of their derivations: no string of a token
+    is a prefix of (or equal to) a string of another token, so at most one token
+    matches at a time, and no character continuing a regex token can follow it, so its
+    longest match is the right one. Then an LALR parser without conflicts accepts
+    exactly the language.
+    >>> rules = {'start': Rule('start').add_body(['t0']),
+    ...          't0': Rule('t0').add_body(['"["', 'T1?', '"]"']).add_body(['"(("', 'T1', '"))"'])}
+    >>> digits = plus(char_class('0123456789'))
+    >>> lexer_is_exact(rules, {'T1': digits}), lexer_is_exact(rules, {'T1': plus(char_class('0123456789)'))})
+    (True, False)
+    >>> _ = rules['t0'].add_body(['T1', 'T1'])
+    >>> lexer_is_exact(rules, {'T1': digits})
+    False
+    """
+    literals = {elem[1:-1] for rule in compiled_rules.values() for body in rule.bodies
+                for elem in body if elem.startswith('"')}
+    # The escapes of the terminals are left to Lark
+    if any('\\' in literal for literal in literals):
+        return False
+    dfas = {token_name: LazyDFA(regex) for token_name, regex in tokens.items()}
+
+    # No token is a prefix of another one. If a literal is a prefix of another, it
+    # is a prefix of the next one in order.
+    ordered = sorted(literals)
+    if any(second.startswith(first) for first, second in zip(ordered, ordered[1:])):
+        return False
+    for dfa in dfas.values():
+        for literal in literals:
+            lengths, is_prefix = dfa.prefix_matches(literal)
+            if lengths or is_prefix:
+                return False
+    for first in tokens:
+        for second in tokens:
+            if first != second and prefix_overlap(tokens[first], tokens[second]):
+                return False
+
+    # The first characters (and nullability) of the symbols, to a fixpoint
+    def symbol(elem):
+        return elem if elem.startswith('"') or elem in compiled_rules else elem.rstrip('?')
+    first_chars = {literal: {literal[0]} for literal in literals if literal}
+    first_chars.update({f'"{literal}"': chars for literal, chars in first_chars.items()})
+    first_chars.update({token_name: dfa.next_chars(dfa.start) for token_name, dfa in dfas.items()})
+    first_chars.update({nt: set() for nt in compiled_rules})
+    nullable_nts = set()
+    def is_nullable(elem):
+        return elem in ('', '""') or elem in nullable_nts or elem.endswith('?') and not elem.startswith('"')
+    def sequence_first(elems):
+        chars = set()
+        for elem in elems:
+            chars |= first_chars.get(symbol(elem), set())
+            if not is_nullable(elem):
+                return chars, False
+        return chars, True
+    changed = True
+    while changed:
+        changed = False
+        for nt, rule in compiled_rules.items():
+            for body in rule.bodies:
+                chars, body_nullable = sequence_first(body)
+                if not chars <= first_chars[nt] or (body_nullable and nt not in nullable_nts):
+                    first_chars[nt] |= chars
+                    if body_nullable:
+                        nullable_nts.add(nt)
+                    changed = True
+
+    # The characters which can follow the nonterminals and regex tokens
+    follow_chars = {elem: set() for elem in list(compiled_rules) + list(tokens)}
+    changed = True
+    while changed:
+        changed = False
+        for nt, rule in compiled_rules.items():
+            for body in rule.bodies:
+                for idx, elem in enumerate(body):
+                    if symbol(elem) not in follow_chars:
+                        continue
+                    chars, rest_nullable = sequence_first(body[idx + 1:])
+                    if rest_nullable:
+                        chars = chars | follow_chars[nt]
+                    if not chars <= follow_chars[symbol(elem)]:
+                        follow_chars[symbol(elem)] |= chars
+                        changed = True
+    return all(not (dfa.continuation_chars() & follow_chars[token_name]) for token_name, dfa in dfas.items())
+
+
+class GrammarParser():
+    """
+    Parser for a Grammar, with the same `parse` interface as a Lark parser.
+
+    If the whole grammar is regular, strings are matched exactly against its `regex`.
+    Otherwise, uses the LALR parser of the compiled grammar (see Grammar.compiled_str)
+    when Lark can build one, and the scannerless Earley parser otherwise. Strings
+    accepted by the LALR parser are always in the language. The strings it rejects are
+    too, unless Lark resolved shift/reduce conflicts or the lexer can split a string
+    into the wrong tokens (see lexer_is_exact, called with no arguments by
+    `lexer_exact`); only then are they double-checked with the Earley parser.
+    """
+    def __init__(self, earley_text=None, lalr_text=None, regex=None, lexer_exact=None):
+        self.earley_text = earley_text
+        self.earley = None
+        self.lalr = None
+        self.lexer_exact = lexer_exact
+        # Whether the LALR parser accepts exactly the language, computed on its first rejection
+        self.lalr_exact = None
+        self.dfa = LazyDFA(regex) if regex is not None else None
+        if self.dfa is not None:
+            return
+        if lalr_text is not None:
+            try:
+                self.lalr = get_parser(lalr_text, parser='lalr', lexer='contextual')
+            except GrammarError:
+                pass
+        if self.lalr is None:
+            self.earley = get_parser(earley_text)
+
+    def parse(self, string):
+        if self.dfa is not None:
+            if not self.dfa.matches(string):
+                raise LarkError(f"doesn't parse: {string}")
+            return True
+        if self.lalr is not None:
+            try:
+                return self.lalr.parse(string)
+            except LarkError:
+                if self.lalr_exact is None:
+                    self.lalr_exact = (not self.lalr.shift_reduce_conflicts and self.lexer_exact is not None
+                                       and self.lexer_exact())
+                if self.lalr_exact:
+                    raise
+        if self.earley is None:
+            self.earley = get_parser(self.earley_text)
+        return self.earley.parse(string)
+
+
 class Rule():
     """
     Object representing the string-represenation of a rule of a CFG.
@@ -1,3 +1,4 @@
+import heapq
 import random
 from collections import defaultdict
 from typing import Union, List, Dict, Tuple
@@ -6,9 +7,6 @@ from bubble import Bubble
 from next_tid import allocate_tid
 from parse_tree import ParseNode
 
-last_bubble_lst = None
-last_bubble_pairs = None
-
 def group(trees, max_group_size, last_applied_bubble = None) -> List[Bubble]:
     """
     TREES is a set of ParseNodes.
@@ -16,112 +14,222 @@ def group(trees, max_group_size, last_applied_bubble = None) -> List[Bubble]:
     Returns the set of all possible bubble of nonterminals in TREES,
     where each bubble is a data structure holding information about a
     grouping of contiguous nonterminals in TREES.
+
+    The sequences in the layers (lists of children) of the trees are enumerated with
+    a rolling key over the ids of their symbols, so no window is sliced or joined, and
+    the bubbles (with their contexts) are only built for the sequences kept.
     """
+    bubbles = collect_bubbles(trees, max_group_size)
+    bubbles = score_and_sort_bubbles(bubbles)
+
+    # Return the set of repeated groupings as an iterable
+    return bubbles
+
 
+def collect_bubbles(trees, max_group_size) -> Dict[Tuple[int], Bubble]:
+    """
+    Returns the bubbles of the sequences of at most `max_group_size` symbols in the
+    layers of `trees`, keyed by the ids of their symbols, in order of first occurrence.
+    >>> leaves = [ParseNode(c, True, []) for c in 'ab']
+    >>> tree = ParseNode('t0', False, [leaves[0], leaves[1], leaves[0], leaves[1], leaves[0]])
+    >>> sorted(bubble.bubble_str for bubble in collect_bubbles([tree], 2).values())
+    ['a', 'ab', 'b', 'ba']
+    >>> collect_bubbles([tree], 2)[(1, 2)].sources[(0, ())]
+    [(0, 1), (2, 3)]
+    """
+    # Ids of the symbols in the layers, from 1 so that the keys below are exact
+    symbol_ids = {}
+    # Each layer is (payloads of the children, tree idx, child idxs, left context, right
+    # context, children)
+    layers = []
+    for tree_idx, tree in enumerate(trees):
+        # Explicit stack, visiting the layers in preorder
+        stack = [(tree, [], "START", "END")]
+        while stack:
+            node, child_idxs, left_context, right_context = stack.pop()
+            layers.append((tuple(child.payload for child in node.children), tree_idx, child_idxs,
+                           left_context, right_context, node.children))
+            children = []
+            for i, child in enumerate(node.children):
+                lhs = left_context if i == 0 else 'DUMMY'
+                rhs = right_context if i == len(node.children) else 'DUMMY'
+                if not child.is_terminal:
+                    children.append((child, child_idxs + [i], lhs, rhs))
+            stack.extend(reversed(children))
+
+    # The key of a sequence of ids is its number in base len(symbol_ids) + 1, which
+    # is updated in constant time as the sequence grows.
+    for layer in layers:
+        for payload in layer[0]:
+            symbol_ids.setdefault(payload, len(symbol_ids) + 1)
+    base = len(symbol_ids) + 1
+
+    # key -> [(layer idx, start, end)]
+    occurrences = {}
     # Helper tracking if a subsequence is only seen as the "full" child of another nonterminal,
     # I.e. t2 t3 t4 in t1 -> t2 t3 t4, but not in t1 -> t2 t2 t3 t4
     full_bubbles = defaultdict(int)
-
-    def add_groups_for_tree(tree: ParseNode, bubbles: Dict[str, Bubble], tree_idx, child_idxs, left_context="START", right_context ="END"):
-        """
-        Add all groups possible groupings derived from the parse tree `tree` to `groups`.
-        """
-        children_lst = tree.children
-        # if not re.match("t([0-9]+)", tree.payload):
-        #     print("skipping subtree:" tree)
-        #     return
-
-        for i in range(len(children_lst)):
-            for j in range(i + 1, min(len(children_lst) + 1, i + max_group_size + 1)):
-                tree_sublist = children_lst[i:j]
-                tree_substr = ''.join([t.payload for t in tree_sublist])
-                if i == 0 and j == len(children_lst):
-                    # TODO: add direct parent to bubble
-                    full_bubbles[tree_substr] += 1
-
-                lhs_context = [ParseNode(left_context, True, [])] + children_lst[:i]
-                rhs_context = children_lst[j:] + [ParseNode(right_context, True, [])]
-
-                if not tree_substr in bubbles:
-                    bubble = Bubble(allocate_tid(), tree_sublist)
-                    bubble.add_context(lhs_context, rhs_context)
-                    bubbles[tree_substr] = bubble
-                    bubble.add_source(tree_idx, child_idxs, (i, j-1))
+    for layer_idx, layer in enumerate(layers):
+        payloads = layer[0]
+        ids = [symbol_ids[payload] for payload in payloads]
+        n = len(ids)
+        for i in range(n):
+            key = 0
+            for j in range(i, min(n, i + max_group_size)):
+                key = key * base + ids[j]
+                key_occurrences = occurrences.get(key)
+                if key_occurrences is None:
+                    occurrences[key] = [(layer_idx, i, j + 1)]
                 else:
-                    bubble: Bubble = bubbles[tree_substr]
-                    bubble.add_occurrence()
-                    bubble.add_context(lhs_context, rhs_context)
-                    bubble.add_source(tree_idx, child_idxs, (i, j-1))
-
-        # Recurse down in the other layers
-        for i, child in enumerate(tree.children):
-            lhs = left_context if i == 0 else 'DUMMY'
-            rhs = right_context if i == len(tree.children) else 'DUMMY'
-            if not child.is_terminal:
-                add_groups_for_tree(child, bubbles, tree_idx, child_idxs + [i], lhs, rhs)
-
-    # Compute a set of all possible groupings
+                    key_occurrences.append((layer_idx, i, j + 1))
+            if i == 0 and n <= max_group_size:
+                # TODO: add direct parent to bubble
+                full_bubbles[key] += 1
+
     bubbles = {}
-    for tree_num, tree in enumerate(trees):
-        add_groups_for_tree(tree, bubbles, tree_num, [])
-
-    # Remove sequences if they're the full list of children of a rule and don't appear anywhere else.
-    # Prevents us from adding ridiculous layers of indirection.
-    # TODO: I think this does prevent us from learning grammars that require indirection,
-    # but everything I've tried still gets us in a situation where we eternally bubble
-    # up the same sequence,
-    for bubble_str in full_bubbles:
-        if bubbles[bubble_str].occ_count == full_bubbles[bubble_str]:
-            bubbles.pop(bubble_str)
+    for key, key_occurrences in occurrences.items():
+        new_nt = allocate_tid()
+        # Remove sequences if they're the full list of children of a rule and don't appear anywhere else.
+        # Prevents us from adding ridiculous layers of indirection.
+        # TODO: I think this does prevent us from learning grammars that require indirection,
+        # but everything I've tried still gets us in a situation where we eternally bubble
+        # up the same sequence,
+        if full_bubbles.get(key) == len(key_occurrences):
+            continue
+        layer_idx, i, j = key_occurrences[0]
+        bubble = Bubble(new_nt, layers[layer_idx][5][i:j])
+        contexts = defaultdict(int)
+        for layer_idx, i, j in key_occurrences:
+            payloads, tree_idx, child_idxs, left_context, right_context, _ = layers[layer_idx]
+            lhs = payloads[i - 4:i] if i >= 4 else (left_context,) + payloads[:i]
+            rhs = payloads[j:j + 4] if j + 4 <= len(payloads) else payloads[j:] + (right_context,)
+            contexts[(lhs, rhs)] += 1
+            bubble.add_source(tree_idx, child_idxs, (i, j - 1))
+        for (lhs, rhs), count in contexts.items():
+            bubble.add_context_symbols(lhs, rhs, count)
+        bubble.occ_count = len(key_occurrences)
+        bubbles[tuple(symbol_ids[elem.payload] for elem in bubble.bubbled_elems)] = bubble
+    return bubbles
 
-    bubbles = score_and_sort_bubbles(bubbles)
 
-    # Return the set of repeated groupings as an iterable
-    return bubbles
+# Upper bounds on the context similarity (see bubble.Context.similarity) of two bubbles
+# which share a context, share one side of a context, share the token next to one side
+# of a context, or share none of these.
+SHARED_CONTEXT_SIMILARITY = 1
+SHARED_SIDE_SIMILARITY = 0.5 + 0.46875
+SHARED_TOKEN_SIMILARITY = 0.46875 + 0.46875
+OTHER_SIMILARITY = 0.21875 + 0.21875
 
+# Number of (pairs of) bubbles returned by score_and_sort_bubbles
+MAX_BUBBLES = 100
 
-def score_and_sort_bubbles(bubbles: Dict[str, Bubble]) -> List[Union[Bubble, Tuple[Bubble, Bubble]]]:
+
+def candidate_pairs_by_bound(bubble_lst: List[Bubble]):
     """
-    Given a set of bubbles, returns a sorted list of (tuples of) bubbles, sorted by a score on how
-    likely the bubble(s) is to increase the size of the grammar.
-    Single bubble --> likely coalesces with existing nonterminal
-    Double bubble --> likely coalesces with each other
+    Yields (upper bound, pairs), with decreasing upper bounds on the context similarity
+    of the pairs (i, j), i < j, of indices into `bubble_lst`. Every pair is yielded once,
+    with the first bound it satisfies; the pairs sharing nothing are only enumerated if
+    the caller asks for them.
     """
-    bubble_lst = list(sorted(list(bubbles.values()), key=lambda x: len(x.bubbled_elems), reverse=True))
-    bubble_pairs = []
-
-    for i in range(len(bubble_lst)):
-        for j in range(i + 1, len(bubble_lst)):
-            first_bubble: Bubble = bubble_lst[i]
-            second_bubble: Bubble = bubble_lst[j]
-            # Pairs of existing terminals we don't care about
-            if len(first_bubble.bubbled_elems) == len(second_bubble.bubbled_elems) == 1:
-                continue
+    by_context, by_side, by_token = defaultdict(set), defaultdict(set), defaultdict(set)
+    for idx, bubble in enumerate(bubble_lst):
+        for context in bubble.contexts:
+            by_context[context].add(idx)
+            by_side[('lhs', context.lhs)].add(idx)
+            by_side[('rhs', context.rhs)].add(idx)
+            if context.lhs and context.lhs[-1] != 'DUMMY':
+                by_token[('lhs', context.lhs[-1])].add(idx)
+            if context.rhs and context.rhs[0] != 'DUMMY':
+                by_token[('rhs', context.rhs[0])].add(idx)
+
+    seen = set()
+    for bound, index in [(SHARED_CONTEXT_SIMILARITY, by_context), (SHARED_SIDE_SIMILARITY, by_side),
+                         (SHARED_TOKEN_SIMILARITY, by_token)]:
+        pairs = []
+        for idxs in index.values():
+            idxs = sorted(idxs)
+            for a in range(len(idxs)):
+                for b in range(a + 1, len(idxs)):
+                    pair = (idxs[a], idxs[b])
+                    if pair not in seen:
+                        seen.add(pair)
+                        pairs.append(pair)
+        yield bound, pairs
+    yield OTHER_SIMILARITY, ((i, j) for i in range(len(bubble_lst)) for j in range(i + 1, len(bubble_lst))
+                             if (i, j) not in seen)
+
+
+def ranked_bubble_pairs(bubble_lst: List[Bubble]):
+    """
+    Lazily yields the scored pairs of bubbles in `bubble_lst` (see score_and_sort_bubbles),
+    by decreasing score, pairs with equal scores in the order of their indices. The
+    similarity of a pair is only computed once the bound of its group of pairs (see
+    candidate_pairs_by_bound) could beat the pairs already scored, so the pairs
+    unlikely to be similar are usually never scored.
+    """
+    totals = [sum(bubble.contexts.values()) for bubble in bubble_lst]
+
+    def commonness(i, j):
+        # bubble_lst is sorted by decreasing length, so the second is the shortest.
+        if len(bubble_lst[j].bubbled_elems) == 1:
+            return totals[i]
+        return totals[i] / 2 + totals[j] / 2
+
+    # Entries are (-similarity, -commonness, i, j, whether the similarity is exact), and
+    # for exact entries, whether applying the first bubble breaks the second
+    heap = []
+    tiers = candidate_pairs_by_bound(bubble_lst)
+    next_tier = next(tiers, None)
+    while True:
+        # Load the next groups of pairs while they could contain a better pair
+        while next_tier is not None and (not heap or -heap[0][0] <= next_tier[0]):
+            bound, pairs = next_tier
+            for i, j in pairs:
+                # Pairs of existing terminals we don't care about
+                if len(bubble_lst[i].bubbled_elems) == len(bubble_lst[j].bubbled_elems) == 1:
+                    continue
+                heapq.heappush(heap, (-bound, -commonness(i, j), i, j, False))
+            next_tier = next(tiers, None)
+        if not heap:
+            return
+        entry = heapq.heappop(heap)
+        neg_similarity, neg_commonness, i, j, exact = entry[:5]
+        first_bubble, second_bubble = bubble_lst[i], bubble_lst[j]
+        if not exact:
             # Skip overlapping/conflicting pairs
             first_prevents_second, second_prevents_first = first_bubble.application_breaks_other(second_bubble)
             if first_prevents_second and second_prevents_first:
                 continue
             # Score both for similarity of context and occurrence of the bubbles
             similarity = first_bubble.context_similarity(second_bubble)
-            if len(first_bubble.bubbled_elems) == 1:
-                commonness = sum([v for v in second_bubble.contexts.values()]) / 2
-            elif len(second_bubble.bubbled_elems) == 1:
-                commonness = sum([v for v in first_bubble.contexts.values()])
-            else:
-                commonness = sum([v for v in first_bubble.contexts.values()]) / 2 + sum(
-                    [v for v in second_bubble.contexts.values()]) / 2
-
-            # If they're partially overlapping, we may need a particular application order.
-            if first_prevents_second:
-                # need to invert the order of these, so we try all bubbles...
-                bubble_pairs.append(((similarity, commonness), (second_bubble, first_bubble)))
-            else:
-                # either they don't conflict, or we can still do second after we apply first
-                bubble_pairs.append(((similarity, commonness), (first_bubble, second_bubble)))
+            heapq.heappush(heap, (-similarity, neg_commonness, i, j, True, first_prevents_second))
+            continue
+        # If they're partially overlapping, we may need a particular application order.
+        first_prevents_second = entry[5]
+        if first_prevents_second:
+            # need to invert the order of these, so we try all bubbles...
+            yield (-neg_similarity, -neg_commonness), (second_bubble, first_bubble)
+        else:
+            # either they don't conflict, or we can still do second after we apply first
+            yield (-neg_similarity, -neg_commonness), (first_bubble, second_bubble)
+
+
+def score_and_sort_bubbles(bubbles: Dict[str, Bubble]) -> List[Union[Bubble, Tuple[Bubble, Bubble]]]:
+    """
+    Given a set of bubbles, returns a sorted list of (tuples of) bubbles, sorted by a score on how
+    likely the bubble(s) is to increase the size of the grammar.
+    Single bubble --> likely coalesces with existing nonterminal
+    Double bubble --> likely coalesces with each other
+
+    Only the MAX_BUBBLES best are returned, so the pairs are generated lazily, best first.
+    """
+    bubble_lst = list(sorted(list(bubbles.values()), key=lambda x: len(x.bubbled_elems), reverse=True))
 
     bubbles = {}
-    # Sort primarily by similarity, secondarily by commonness
-    for score, pair in list(sorted(bubble_pairs, key=lambda x: x[0], reverse=True)):
+    # Sorted primarily by similarity, secondarily by commonness
+    for score, pair in ranked_bubble_pairs(bubble_lst):
+        if len(bubbles) == MAX_BUBBLES:
+            break
         # Turn bubbles that are paired w/ a nonterm into single bubbles
         if len(pair[0].bubbled_elems) == 1:
             # This if statement probably never happens...
@@ -133,7 +241,5 @@ def score_and_sort_bubbles(bubbles: Dict[str, Bubble]) -> List[Union[Bubble, Tup
         else:
             bubbles[pair] = score
     bubbles = list(bubbles.items())
-    if len(bubbles) > 100:
-        bubbles = bubbles[:100]
     random.shuffle(bubbles)
-    return bubbles
\ No newline at end of file
+    return bubbles
@@ -0,0 +1,94 @@
+import hashlib
+import multiprocessing
+import random
+
+"""
+Helpers to run independent checks (e.g. the pairwise checks of start.coalesce) in a
+pool of worker processes.
+
+Workers are forked, so they see a read-only snapshot of the caller's state (the
+parse trees, the grammar, the oracle and its cache) without pickling it. Each check
+runs with the random state seeded from the check's own key, so its result does not
+depend on which process runs it or on the checks run before it. New oracle answers
+found by the workers are sent back and added to the caller's oracle cache, so later
+checks (and later snapshots) share them.
+"""
+
+# Oracle attributes counting calls, which are added up across workers.
+ORACLE_COUNTERS = ['parse_calls', 'real_calls', 'time_spent']
+
+# State of a worker: the check to run, the oracle it queries, and how much of the
+# oracle's cache was already sent back.
+worker_check = None
+worker_oracle = None
+worker_reported = 0
+
+
+def can_fork():
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+def seed_for(*key):
+    """
+    Returns a seed for the random state of the check identified by `key`.
+    Unlike hash, this does not depend on the process.
+    >>> seed_for(7, 't1', 't2') == seed_for(7, 't1', 't2') != seed_for(7, 't2', 't1')
+    True
+    """
+    digest = hashlib.sha256(repr(key).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'little')
+
+
+def run_seeded(seed, check, *args):
+    """
+    Runs check(*args) with the random state seeded by `seed`, and restores the
+    random state of the caller afterwards.
+    """
+    state = random.getstate()
+    random.seed(seed)
+    try:
+        return check(*args)
+    finally:
+        random.setstate(state)
+
+
+class CheckPool():
+    """
+    A pool of processes forked from the current state, which run check(*args) with
+    the random state seeded by seed for each (seed, args) given to `map`. The pool
+    must be closed (and a new one created) once the state the checks read changes.
+    """
+    def __init__(self, num_workers, check, oracle):
+        global worker_check, worker_oracle, worker_reported
+        worker_check, worker_oracle, worker_reported = check, oracle, len(oracle.cache_set)
+        self.oracle = oracle
+        self.pool = multiprocessing.get_context('fork').Pool(num_workers)
+
+    def map(self, tasks):
+        """
+        Returns the results of the (seed, args) `tasks`, in order, and adds the
+        oracle answers the workers found to the oracle's cache.
+        """
+        results = []
+        for result, new_answers, counters in self.pool.map(run_in_worker, tasks):
+            results.append(result)
+            for string, answer in new_answers:
+                self.oracle.cache_set.setdefault(string, answer)
+            for name, value in counters.items():
+                setattr(self.oracle, name, getattr(self.oracle, name) + value)
+        return results
+
+    def close(self):
+        self.pool.terminate()
+
+
+def run_in_worker(task):
+    global worker_reported
+    seed, args = task
+    counters = {name: getattr(worker_oracle, name) for name in ORACLE_COUNTERS if hasattr(worker_oracle, name)}
+    result = run_seeded(seed, worker_check, *args)
+    counters = {name: getattr(worker_oracle, name) - value for name, value in counters.items()}
+    # The cache is a dict, so the new answers are the last ones inserted.
+    new_answers = list(worker_oracle.cache_set.items())[worker_reported:]
+    worker_reported = len(worker_oracle.cache_set)
+    return result, new_answers, counters
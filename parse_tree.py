@@ -1,10 +1,11 @@
 import functools
 import random
 from collections import defaultdict
-from typing import List, Iterable
+from typing import Dict, List, Iterable, Tuple
 
 from grammar import Rule, Grammar
 from input import clean_terminal
+from verdicts import digest
 START = 't0'
 
 @functools.lru_cache(maxsize=None)
@@ -20,52 +21,344 @@ class ParseTreeList:
     Can be used just as a list but provides additional methods to check whether strings
     can be derived by the induced grammar of the list of parse trees.
 
-    TODO: This is currently a fragile data structure as it does not automatically
-    update the grammar when there are changes to the list of parse trees.
+    The trees are changed through this object (by replacing them, or with relabel),
+    which keeps the strings derivable from each nonterminal, the occurrences of the
+    nonterminals and their fingerprints up to date as it goes, only visiting the trees
+    which change: they stay what a list built from the current trees would compute.
+    So a list can live across many changes, e.g. the candidate bubbles of build_trees,
+    each tried (begin_trial) and then kept (commit_trial) or undone (revert_trial).
+    >>> def leaf(c): return ParseNode(c, True, [])
+    >>> first = ParseNode('t0', False, [ParseNode('t1', False, [leaf('1')]), leaf('+'), ParseNode('t1', False, [leaf('2')])])
+    >>> trees = ParseTreeList([first])
+    >>> version = trees.version
+    >>> trees.append(ParseNode('t0', False, [ParseNode('t2', False, [leaf('1')])]))
+    >>> trees.occurrences('t2')
+    [(1, (0,))]
+    >>> trees[0] = ParseNode('t0', False, [ParseNode('t1', False, [leaf('3')])])
+    >>> trees.relabel({'t2': 't1'})
+    {1}
+    >>> trees.version - version, trees.occurrences('t1'), trees.occurrences('t2')
+    (3, [(0, (0,)), (1, (0,))], [])
+    >>> fresh = ParseTreeList(list(trees))
+    >>> trees.derivables_from_nt == fresh.derivables_from_nt, trees.fingerprint('t1') == fresh.fingerprint('t1')
+    (True, True)
+    >>> sorted(trees.derivable_in_trees('t1')), sorted(trees.represented_strings()), first.derived_string()
+    (['1', '3'], ['1', '3'], '1+2')
+
+    A trial records the trees it replaces, to put them back if it is reverted:
+    >>> trees.begin_trial()
+    >>> trees[1] = first
+    >>> _ = trees.relabel({'t1': 't4'})
+    >>> trees.occurrences('t4'), trees.revert_trial()
+    ([(0, (0,)), (1, (0,)), (1, (2,))], {0, 1})
+    >>> [str(tree) for tree in trees] == [str(tree) for tree in fresh], trees.occurrences('t4')
+    (True, [])
+    >>> trees.derivables_from_nt == fresh.derivables_from_nt, trees.fingerprint('t1') == fresh.fingerprint('t1')
+    (True, True)
     """
 
     def __init__(self, start_list=None, grammar=None):
-        self.inner_list = [] if start_list is None else start_list
+        # Copied, as the trees are replaced through this object
+        self.inner_list = [] if start_list is None else list(start_list)
         if self.inner_list and grammar is None:
             self.grammar = build_grammar(self.inner_list)
         elif start_list and grammar is not None:
             self.grammar = grammar
-        self.derivables_from_nt = defaultdict(set)
-        self.__compute_derivables()
-        self.derivable_cache_hash = hash(tuple(self.inner_list))
+        # nonterminal -> {string derived by a node labeled nonterminal: number of such nodes}
+        self.derivables_from_nt = defaultdict(dict)
+        # TreeIndex of each tree, and the indices of the trees in which each nonterminal
+        # occurs, each expansion occurs, and each nonterminal is the child of a node
+        self.tree_indexes = []
+        self.trees_of_nt = defaultdict(set)
+        self.trees_of_expansion = defaultdict(set)
+        self.trees_of_child = defaultdict(set)
+        # nonterminal -> occurrences, nodes and fingerprint, dropped for the
+        # nonterminals of the trees which change
+        self.occurrences_of_nt = {}
+        self.nodes_of_nt = {}
+        self.fingerprints = {}
+        # nonterminal -> fingerprints which depend on the other nonterminals too,
+        # dropped whenever the trees change
+        self.level_fingerprints = {}
+        self.rule_fingerprints = {}
+        # nonterminal -> {(level, max samples): strings}, see replacement_utils.lvl_n_derivable.
+        # The level-0 strings of a nonterminal are kept until the trees it occurs in change.
+        self.derivable_memo = {}
+        for tree_idx, tree in enumerate(self.inner_list):
+            self.tree_indexes.append(None)
+            self.__index(tree_idx, TreeIndex(tree))
+        # Indices of the trees copied by this object, which it can change in place
+        self.owned = set()
+        # Incremented every time the trees change
+        self.version = 0
+        # (tree id, nonterminal or rule) -> placeholder spans, see
+        # replacement_utils.get_strings_with_replacement
+        self.template_cache = {}
+        # During a trial, tree index -> the tree (and its TreeIndex) it had when the
+        # trial began
+        self.trial = None
 
     def __getitem__(self, item):
         return self.inner_list[item]
 
     def __setitem__(self, key, value):
-        self.inner_list[key] = value
+        self.__replace(key, value, TreeIndex(value))
+        self.owned.discard(key)
+        self.trees_changed()
 
     def __iter__(self):
         return self.inner_list.__iter__()
 
+    def __len__(self):
+        return len(self.inner_list)
+
     def append(self, value):
         self.inner_list.append(value)
+        self.tree_indexes.append(None)
+        self.__index(len(self.inner_list) - 1, TreeIndex(value))
+        self.trees_changed()
+
+    def trees_changed(self):
+        """
+        Drops what was computed from the trees and depends on all of them. Called
+        whenever the trees change.
+        """
+        self.version += 1
+        self.level_fingerprints = {}
+        self.rule_fingerprints = {}
+        self.derivable_memo = {nt: {key: strings for key, strings in memo.items() if key[0] == 0}
+                               for nt, memo in self.derivable_memo.items()}
+        self.template_cache = {}
+
+    def begin_trial(self):
+        """
+        Starts recording the trees replaced (or relabeled), so that revert_trial can
+        put them back. The trees of the list are copied before they are relabeled in
+        the trial, so the trees it began with are never mutated.
+        """
+        self.trial = {}
+        self.owned = set()
+
+    def commit_trial(self):
+        """
+        Keeps the changes of the trial. Returns the indices of the trees it changed.
+        """
+        changed, self.trial = set(self.trial), None
+        return changed
+
+    def revert_trial(self):
+        """
+        Puts back the trees the trial began with (with their indexes, so without
+        visiting them again). Returns the indices of the trees it had changed.
+        """
+        trial, self.trial = self.trial, None
+        for tree_idx, (tree, index) in trial.items():
+            self.__replace(tree_idx, tree, index)
+            self.owned.discard(tree_idx)
+        if trial:
+            self.trees_changed()
+        return set(trial)
+
+    def __replace(self, tree_idx, tree, index):
+        self.__record(tree_idx)
+        self.__unindex(tree_idx)
+        self.inner_list[tree_idx] = tree
+        self.__index(tree_idx, index)
+
+    def __record(self, tree_idx):
+        if self.trial is not None and tree_idx not in self.trial:
+            self.trial[tree_idx] = (self.inner_list[tree_idx], self.tree_indexes[tree_idx])
+
+    def __index(self, tree_idx, index: 'TreeIndex'):
+        """
+        Adds the TreeIndex `index` of the tree at `tree_idx` to the indices.
+        """
+        self.tree_indexes[tree_idx] = index
+        self.__update_indices(tree_idx, index, 1)
+
+    def __unindex(self, tree_idx):
+        """
+        Removes the TreeIndex of the tree at `tree_idx` from the indices (before the
+        tree is replaced or mutated).
+        """
+        self.__update_indices(tree_idx, self.tree_indexes[tree_idx], -1)
+        self.tree_indexes[tree_idx] = None
+
+    def __update_indices(self, tree_idx, index: 'TreeIndex', count: int):
+        """
+        Adds (`count` 1) or removes (-1) the tree at `tree_idx`, with TreeIndex `index`,
+        to the indices and the numbers of nodes deriving each string, and drops what was
+        computed from the occurrences of its nonterminals.
+        """
+        update = set.add if count > 0 else set.discard
+        for nt in index.occurrences:
+            update(self.trees_of_nt[nt], tree_idx)
+            if not self.trees_of_nt[nt]:
+                del self.trees_of_nt[nt]
+            self.occurrences_of_nt.pop(nt, None)
+            self.nodes_of_nt.pop(nt, None)
+            self.fingerprints.pop(nt, None)
+            self.derivable_memo.pop(nt, None)
+        for expansion in index.expansions:
+            update(self.trees_of_expansion[expansion], tree_idx)
+            if not self.trees_of_expansion[expansion]:
+                del self.trees_of_expansion[expansion]
+        for nt in index.parents:
+            update(self.trees_of_child[nt], tree_idx)
+            if not self.trees_of_child[nt]:
+                del self.trees_of_child[nt]
+        for nt, derivable in index.derivables:
+            counts = self.derivables_from_nt[nt]
+            counts[derivable] = counts.get(derivable, 0) + count
+            if not counts[derivable]:
+                del counts[derivable]
+                if not counts:
+                    del self.derivables_from_nt[nt]
+
+    def occurrences(self, nt):
+        """
+        Returns the (tree index, path) of the nodes labeled `nt`, in preorder.
+        >>> leaf = ParseNode('"1"', True, [])
+        >>> trees = ParseTreeList([ParseNode('t0', False, [ParseNode('t1', False, [leaf]), ParseNode('t1', False, [leaf])]),
+        ...                        ParseNode('t0', False, [leaf])])
+        >>> trees.occurrences('t1')
+        [(0, (0,)), (0, (1,))]
+        >>> trees.trees_with_occurrences('t1')
+        [(0, [(0,), (1,)])]
+        >>> trees.expansion_occurrences('t0', ['"1"'])
+        [(1, ())]
+        """
+        if nt not in self.occurrences_of_nt:
+            self.occurrences_of_nt[nt] = [(tree_idx, occurrence[0]) for tree_idx in sorted(self.trees_of_nt.get(nt, ()))
+                                          for occurrence in self.tree_indexes[tree_idx].occurrences[nt]]
+        return self.occurrences_of_nt[nt]
+
+    def nodes(self, nt):
+        """
+        Returns the nodes labeled `nt`, in the same order as occurrences(nt).
+        """
+        if nt not in self.nodes_of_nt:
+            self.nodes_of_nt[nt] = [occurrence[1] for tree_idx in sorted(self.trees_of_nt.get(nt, ()))
+                                    for occurrence in self.tree_indexes[tree_idx].occurrences[nt]]
+        return self.nodes_of_nt[nt]
+
+    def expansion_occurrences(self, rule_start, body):
+        """
+        Returns the (tree index, path) of the nodes where `rule_start` is expanded
+        to `body`, in preorder.
+        """
+        key = (rule_start, tuple(fixup_terminal(elem) for elem in body))
+        return [(tree_idx, path) for tree_idx in sorted(self.trees_of_expansion.get(key, ()))
+                for path in self.tree_indexes[tree_idx].expansions[key]]
+
+    def trees_with_occurrences(self, nt):
+        """
+        Returns (tree index, paths) for each tree where `nt` occurs, with the paths
+        to its occurrences in that tree.
+        """
+        return group_by_tree(self.occurrences(nt))
+
+    def trees_with_expansion(self, rule_start, body):
+        """
+        Returns (tree index, paths) for each tree where `rule_start` is expanded to
+        `body`, with the paths to these expansions in that tree.
+        """
+        return group_by_tree(self.expansion_occurrences(rule_start, body))
+
+    def fingerprint(self, nt):
+        """
+        Returns a fingerprint of the occurrences of `nt`: the trees it occurs in, with
+        the spans of its occurrences. None if `nt` does not occur. The fingerprints do
+        not depend on the names of the nonterminals (see verdicts.py).
+        >>> def leaf(c): return ParseNode(c, True, [])
+        >>> trees = ParseTreeList([ParseNode('t0', False, [ParseNode('t1', False, [leaf('1')]), leaf('+'), ParseNode('t2', False, [leaf('2')])]),
+        ...                        ParseNode('t0', False, [ParseNode('t7', False, [leaf('1')]), leaf('+'), ParseNode('t2', False, [leaf('2')])])])
+        >>> trees.fingerprint('t1') == trees.fingerprint('t7') != trees.fingerprint('t2')
+        True
+        >>> trees.level_fingerprint('t0') == ParseTreeList(list(trees)).level_fingerprint('t0')
+        True
+        >>> trees.fingerprint('t9') is None
+        True
+        """
+        if nt not in self.fingerprints:
+            spans = sorted((self.tree_indexes[tree_idx].string, start, end)
+                           for tree_idx in sorted(self.trees_of_nt.get(nt, ()))
+                           for _, _, start, end, _ in self.tree_indexes[tree_idx].occurrences[nt])
+            self.fingerprints[nt] = digest(tuple(spans)) if spans else None
+        return self.fingerprints[nt]
+
+    def level_fingerprint(self, nt):
+        """
+        Returns a fingerprint of the occurrences of `nt` and of how they split among
+        their children, with the fingerprint of each child nonterminal (on which the
+        level-1 derivable strings of `nt` depend).
+        """
+        if nt not in self.level_fingerprints:
+            spans = sorted((self.tree_indexes[tree_idx].string, start, end,
+                            tuple((child_start, child_end, self.fingerprint(label) or '')
+                                  for child_start, child_end, label in children))
+                           for tree_idx in sorted(self.trees_of_nt.get(nt, ()))
+                           for _, _, start, end, children in self.tree_indexes[tree_idx].occurrences[nt])
+            self.level_fingerprints[nt] = digest(tuple(spans)) if spans else None
+        return self.level_fingerprints[nt]
+
+    def rule_fingerprint(self, nt):
+        """
+        Returns a fingerprint of the rule expansions in which `nt` occurs: for each
+        occurrence of a parent of `nt`, its span, and the fingerprints of its children.
+        """
+        if nt not in self.rule_fingerprints:
+            parents = []
+            for tree_idx in sorted(self.trees_of_child.get(nt, ())):
+                tree_string = self.tree_indexes[tree_idx].string
+                for parent, start, end, children in self.tree_indexes[tree_idx].parents[nt]:
+                    body = tuple((child_start, child_end, label == nt, self.fingerprint(label) or '')
+                                 for child_start, child_end, label in children)
+                    parents.append((self.fingerprint(parent), tree_string, start, end, body))
+            self.rule_fingerprints[nt] = digest(tuple(sorted(parents)))
+        return self.rule_fingerprints[nt]
 
     def represented_strings(self):
         return self.derivable_in_trees('t0')
 
     def derivable_in_trees(self, nt):
-        if self.derivable_cache_hash != hash(tuple(self.inner_list)):
-            self.__compute_derivables()
-            self.derivable_cache_hash = hash(tuple(self.inner_list))
-        return self.derivables_from_nt.get(nt, 0)
-
-    def __compute_derivables(self):
-        def __per_tree_helper(tree: ParseNode):
-            if tree.is_terminal:
-                return tree.payload
-            else:
-                derivable_here = "".join([__per_tree_helper(c) for c in tree.children])
-                self.derivables_from_nt[tree.payload].add(derivable_here)
-                return derivable_here
+        """
+        Returns the strings derived by the nodes labeled `nt` in the trees.
+        """
+        return self.derivables_from_nt.get(nt, {}).keys()
 
-        for tree in self.inner_list:
-            __per_tree_helper(tree)
+    def relabel(self, get_class: Dict[str, str]):
+        """
+        Relabels the nonterminals in `get_class` to their class nonterminal in the trees
+        (removing the expansions of the form tx -> tx this creates), updating the strings
+        derivable from each nonterminal. The trees are copied the first time they are
+        relabeled, so the trees the list was built from are never mutated.
+
+        Returns the indices of the trees which changed.
+        >>> leaf = ParseNode('"1"', True, [])
+        >>> tree = ParseNode('t0', False, [ParseNode('t1', False, [ParseNode('t2', False, [leaf])]), leaf])
+        >>> trees = ParseTreeList([tree, ParseNode('t0', False, [leaf])])
+        >>> trees.relabel({'t1': 't3', 't2': 't3'})
+        {0}
+        >>> trees[0].children[0].payload, trees[0].children[0].children, tree.children[0].payload
+        ('t3', ["1"], 't1')
+        >>> sorted(trees.derivable_in_trees('t3')), sorted(trees.derivable_in_trees('t1'))
+        (['"1"'], [])
+        """
+        changed = {tree_idx for nt in get_class for tree_idx in self.trees_of_nt.get(nt, ())}
+        for tree_idx in sorted(changed):
+            self.__record(tree_idx)
+            self.__unindex(tree_idx)
+            tree = self.inner_list[tree_idx]
+            if tree_idx not in self.owned:
+                tree = tree.copy()
+                self.inner_list[tree_idx] = tree
+                self.owned.add(tree_idx)
+            relabel_tree(tree, get_class)
+            tree.update_cache_info()
+            self.__index(tree_idx, TreeIndex(tree))
+        self.trees_changed()
+        return changed
 
     def represented_by_derived_grammar(self, candidates: Iterable[str]):
         """
@@ -78,7 +371,7 @@ class ParseTreeList:
         """
         candidates = set(candidates)
         represented_strings = self.represented_strings()
-        if candidates.issubset(represented_strings):
+        if all(candidate in represented_strings for candidate in candidates):
             return True
         else:
             grammar_parser = self.grammar.parser()
@@ -112,6 +405,197 @@ class ParseTreeList:
                 return False
 
 
+def preorder_nodes(tree: 'ParseNode'):
+    """
+    Returns the nodes of `tree` in preorder, without recursion.
+    >>> [node.payload for node in preorder_nodes(ParseNode('t0', False, [ParseNode('t1', False, [ParseNode('1', True, [])]), ParseNode('+', True, [])]))]
+    ['t0', 't1', '1', '+']
+    """
+    nodes = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(reversed(node.children))
+    return nodes
+
+
+def fold_tree(tree: 'ParseNode', leaf_value, combine, path=()):
+    """
+    Computes a value for `tree` bottom-up, without recursion: leaf_value(node, path)
+    is the value of a node computed without its children, or None if it depends on
+    them, in which case combine(node, values of its children) is its value. The
+    children are computed left to right, as a recursive function would.
+    >>> tree = ParseNode('t0', False, [ParseNode('t1', False, [ParseNode('1', True, [])]), ParseNode('+', True, [])])
+    >>> fold_tree(tree, lambda node, path: 1 if node.is_terminal else None, lambda node, values: sum(values) + 1)
+    4
+    """
+    # Explicit stack of [node, path, values of the children computed so far]
+    stack = [[tree, path, None]]
+    value = None
+    while stack:
+        frame = stack[-1]
+        node, node_path, values = frame
+        if values is None:
+            value = leaf_value(node, node_path)
+            if value is None:
+                frame[2] = values = []
+        if values is not None:
+            if len(values) < len(node.children):
+                child_idx = len(values)
+                stack.append([node.children[child_idx], node_path + (child_idx,), None])
+                continue
+            value = combine(node, values)
+        stack.pop()
+        if stack:
+            stack[-1][2].append(value)
+    return value
+
+
+def flatten_tree(tree: 'ParseNode'):
+    """
+    Returns the (payload, is_terminal, number of children) of the nodes of `tree`,
+    in preorder, from which unflatten_tree builds the tree back.
+    """
+    return [(node.payload, node.is_terminal, len(node.children)) for node in preorder_nodes(tree)]
+
+
+def unflatten_tree(flat_nodes: List[Tuple[str, bool, int]]):
+    """
+    Builds back the tree flattened by flatten_tree, without recursion.
+    >>> import pickle
+    >>> deep = ParseNode('1', True, [])
+    >>> for _ in range(10000):
+    ...     deep = ParseNode('t1', False, [ParseNode('(', True, []), deep, ParseNode(')', True, [])])
+    >>> copied = pickle.loads(pickle.dumps(deep))
+    >>> copied == deep == deep.copy(), hash(copied) == hash(deep), len(copied.derived_string())
+    (True, True, 20001)
+    """
+    root = None
+    # Explicit stack of (node, number of children still to add)
+    stack = []
+    for payload, is_terminal, num_children in flat_nodes:
+        node = ParseNode(payload, is_terminal, [])
+        if stack:
+            parent, missing = stack[-1]
+            parent.children.append(node)
+            if missing == 1:
+                stack.pop()
+            else:
+                stack[-1] = (parent, missing - 1)
+        else:
+            root = node
+        if num_children:
+            stack.append((node, num_children))
+    return root
+
+
+def derivables_of(tree: 'ParseNode'):
+    """
+    Returns (nonterminal, derived string) for each nonterminal node of `tree`.
+    >>> derivables_of(ParseNode('t0', False, [ParseNode('t1', False, [ParseNode('1', True, [])]), ParseNode('+', True, [])]))
+    [('t1', '1'), ('t0', '1+')]
+    """
+    derivables = []
+    # Explicit stack of (node, whether its children have been visited), and the
+    # strings derived by the children visited so far
+    stack, strings = [(tree, False)], []
+    while stack:
+        node, visited = stack.pop()
+        if node.is_terminal:
+            strings.append(node.payload)
+        elif not visited:
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(node.children))
+        else:
+            num_children = len(node.children)
+            derivable = ''.join(strings[len(strings) - num_children:]) if num_children else ''
+            del strings[len(strings) - num_children:]
+            strings.append(derivable)
+            derivables.append((node.payload, derivable))
+    return derivables
+
+
+def relabel_tree(tree: 'ParseNode', get_class: Dict[str, str]):
+    """
+    Mutative: relabels the nonterminals of `tree` in `get_class` to their class, and
+    removes the expansions of the form tx -> tx this creates.
+    """
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if node.is_terminal:
+            continue
+        node.payload = get_class.get(node.payload, node.payload)
+        node.cache_valid = False
+        # Won't go on forever because eventually length of children will be not 1,
+        # or the children's payload will not be the same as the top node (e.g. if
+        # the child is a terminal)
+        while len(node.children) == 1 and \
+                (node.children[0].payload if node.children[0].is_terminal
+                 else get_class.get(node.children[0].payload, node.children[0].payload)) == node.payload:
+            node.children = node.children[0].children
+        stack.extend(node.children)
+
+
+def group_by_tree(occurrences):
+    """
+    Groups a list of (tree index, path) occurrences by tree, keeping the order.
+    """
+    grouped = []
+    for tree_idx, path in occurrences:
+        if grouped and grouped[-1][0] == tree_idx:
+            grouped[-1][1].append(path)
+        else:
+            grouped.append((tree_idx, [path]))
+    return grouped
+
+
+class TreeIndex():
+    """
+    The nonterminal nodes of a tree, by label and by expansion, with their spans in
+    the string of the tree (see ParseTreeList).
+    >>> def leaf(c): return ParseNode(c, True, [])
+    >>> index = TreeIndex(ParseNode('t0', False, [ParseNode('t1', False, [leaf('1')]), leaf('+'), ParseNode('t1', False, [leaf('2')])]))
+    >>> [(path, start, end) for path, _, start, end, _ in index.occurrences['t1']], index.expansions[('t0', ('t1', '+', 't1'))]
+    ([((0,), 0, 1), ((2,), 2, 3)], [()])
+    >>> index.parents['t1']
+    [('t0', 0, 3, [(0, 1, 't1'), (1, 2, None), (2, 3, 't1')])]
+    """
+    def __init__(self, tree: 'ParseNode'):
+        self.string = tree.derived_string()
+        # (nt, derived string) of the nodes, see derivables_of
+        self.derivables = derivables_of(tree)
+        # nt -> [(path, node, start, end, children)] of the nodes labeled nt, in preorder,
+        # where children are the (start, end, label) of their children (label None for
+        # terminals)
+        self.occurrences = defaultdict(list)
+        # (nt, labels of the children, terminals unquoted) -> [path] of the nodes
+        # expanded so, in preorder
+        self.expansions = defaultdict(list)
+        # nt -> [(label, start, end, children)] of the nodes with a child labeled nt
+        self.parents = defaultdict(list)
+        # Explicit stack of (node, path, start offset)
+        stack = [(tree, (), 0)]
+        while stack:
+            node, path, start = stack.pop()
+            if node.is_terminal:
+                continue
+            children = []
+            offset = start
+            for child in node.children:
+                child_len = len(child.derived_string())
+                children.append((offset, offset + child_len, None if child.is_terminal else child.payload))
+                offset += child_len
+            body = tuple(fixup_terminal(child.payload) for child in node.children)
+            self.occurrences[node.payload].append((path, node, start, offset, children))
+            self.expansions[(node.payload, body)].append(path)
+            for label in dict.fromkeys(label for _, _, label in children if label is not None):
+                self.parents[label].append((node.payload, start, offset, children))
+            for child_idx in reversed(range(len(node.children))):
+                stack.append((node.children[child_idx], path + (child_idx,), children[child_idx][0]))
+
+
 class ParseTree():
 
     """
@@ -229,22 +713,66 @@ class ParseNode():
         self.cache_valid = False
         self.cached_string = None
         self.cached_nts = None
+        # The rules this tree defines, see build_grammar. Like the other caches,
+        # only valid while cache_valid is.
+        self.cached_rules = None
 
     def update_cache_info(self):
-        for child in self.children:
-            child.update_cache_info()
-        self.cached_string = self.derived_string()
-        self.cached_nts = self.all_nts()
-        self.cache_valid = True
+        # Children before their parents
+        for node in reversed(preorder_nodes(self)):
+            if node.is_terminal:
+                node.cached_string = fixup_terminal(node.payload)
+                node.cached_nts = set()
+            else:
+                node.cached_string = ''.join([child.cached_string for child in node.children])
+                node.cached_nts = {node.payload}
+                for child in node.children:
+                    node.cached_nts.update(child.cached_nts)
+            node.cached_rules = None
+            node.cache_valid = True
+
+    def rules(self):
+        """
+        Returns the (rule start, rule body) of the rules defined by this tree's
+        nodes, in preorder. Cached while the tree is.
+        >>> tree = ParseNode('t0', False, [ParseNode('t1', False, [ParseNode('a', True, [])]),
+        ...                                ParseNode('b', True, [])])
+        >>> tree.rules()
+        [('t0', ['t1', '"b"']), ('t1', ['"a"'])]
+        """
+        if self.cache_valid and self.cached_rules is not None:
+            return self.cached_rules
+        rules = []
+        # Explicit stack, children pushed in reverse for a preorder
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            # Terminals and nodes with no children do not define rules
+            if node.is_terminal or len(node.children) == 0:
+                continue
+            # E.g. the ParseNode t0 with children t1 a b defines the rule t0 -> t1 a b
+            rules.append((node.payload, [clean_terminal(child.payload) if child.is_terminal else child.payload
+                                         for child in node.children]))
+            stack.extend(reversed(node.children))
+        if self.cache_valid:
+            self.cached_rules = rules
+        return rules
 
     def all_nts(self):
         if self.cache_valid:
             return self.cached_nts
-        if self.is_terminal:
-            return set()
-        my_nts = {self.payload}
-        for child in self.children:
-            my_nts.update(child.all_nts())
+        my_nts = set()
+        # Explicit stack, stopping at the subtrees whose nonterminals are cached
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.is_terminal:
+                continue
+            if node.cache_valid:
+                my_nts.update(node.cached_nts)
+                continue
+            my_nts.add(node.payload)
+            stack.extend(node.children)
         return my_nts
 
     def add_child(self, child):
@@ -262,8 +790,18 @@ class ParseNode():
 
         if self.is_terminal:
             return fixup_terminal(self.payload)
-        else:
-            return ''.join([c.derived_string() for c in self.children])
+        # The strings of the leaves, in order, stopping at the cached subtrees
+        strings = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.cache_valid:
+                strings.append(node.cached_string)
+            elif node.is_terminal:
+                strings.append(fixup_terminal(node.payload))
+            else:
+                stack.extend(reversed(node.children))
+        return ''.join(strings)
 
     def copy(self):
         """
@@ -273,26 +811,53 @@ class ParseNode():
         if self.is_terminal:
             assert (len(self.children) == 0)
             return ParseNode(self.payload, True, [])
-        else:
-            copy_children: List[ParseNode] = [child.copy() for child in self.children]
-            return ParseNode(self.payload, False, copy_children)
+        new_root = ParseNode(self.payload, False, [])
+        # Explicit stack of (node, its copy), whose children are copied when popped
+        stack = [(self, new_root)]
+        while stack:
+            node, new_node = stack.pop()
+            for child in node.children:
+                if child.is_terminal:
+                    assert (len(child.children) == 0)
+                    new_node.children.append(ParseNode(child.payload, True, []))
+                else:
+                    new_child = ParseNode(child.payload, False, [])
+                    new_node.children.append(new_child)
+                    stack.append((child, new_child))
+        return new_root
 
     def __eq__(self, other):
         if not isinstance(other, ParseNode):
             return False
-        if self.payload != other.payload or self.is_terminal != other.is_terminal or len(self.children) != len(
-                other.children):
-            return False
-        for idx in range(len(self.children)):
-            if not self.children[idx] == other.children[idx]:
+        # Explicit stack of the pairs of nodes left to compare
+        stack = [(self, other)]
+        while stack:
+            node, other_node = stack.pop()
+            if node is other_node:
+                continue
+            if node.payload != other_node.payload or node.is_terminal != other_node.is_terminal \
+                    or len(node.children) != len(other_node.children):
                 return False
+            stack.extend(zip(node.children, other_node.children))
         return True
 
     def __ne__(self, other):
         return not self == other
 
     def __hash__(self):
-        return hash((self.payload, self.is_terminal, tuple(self.children)))
+        # Children before their parents, combining the hashes of the children
+        hashes = {}
+        for node in reversed(preorder_nodes(self)):
+            hashes[id(node)] = hash((node.payload, node.is_terminal,
+                                     tuple([hashes[id(child)] for child in node.children])))
+        return hashes[id(self)]
+
+    def __reduce__(self):
+        """
+        Pickles the tree as the flat list of its nodes, so that trees deeper than
+        the recursion limit can be pickled (e.g. sent to other processes or saved).
+        """
+        return unflatten_tree, (flatten_tree(self),)
 
     def __str__(self):
         def place_in_middle(s: str, strlen: int):
@@ -337,42 +902,99 @@ def build_grammar(trees):
     TREES is a list of fully constructed parse trees. This method builds a
     GrammarNode that is the disjunction of the parse trees, and returns it.
     """
+    return InducedGrammar(trees).grammar()
+
 
-    def build_rules(grammar_node, parse_node, rule_map):
+class InducedGrammar():
+    """
+    The grammar induced by a list of parse trees (the disjunction of the rules their
+    nodes define), kept up to date as the trees of the list are replaced.
+
+    Each rule counts the nodes which define it in each tree, so replacing a tree only
+    updates the counts of the rules of the old and new trees, and the rules whose count
+    drops to zero are dropped. Trees are told apart by identity: a tree must not be
+    mutated once passed to the InducedGrammar (copy it instead, as apply and coalesce do).
+
+    The rules are ordered by their first definition in the trees, as build_grammar
+    always did, so the grammar is the same as one built from scratch.
+    >>> def leaf(c): return ParseNode(c, True, [])
+    >>> trees = [ParseNode('t0', False, [ParseNode('t1', False, [leaf('1')]), leaf('+'), ParseNode('t1', False, [leaf('2')])]),
+    ...          ParseNode('t0', False, [ParseNode('t2', False, [leaf('3')])])]
+    >>> induced = InducedGrammar(trees)
+    >>> induced.counts[('t1', ('"1"',))]
+    {0: 1}
+    >>> induced.update([trees[0], ParseNode('t0', False, [ParseNode('t1', False, [leaf('1')])])])
+    >>> print(induced.grammar())
+    start: t0
+    t0: t1 "+" t1
+        | t1
+    t1: "1"
+        | "2"
+    >>> induced.counts[('t1', ('"1"',))]
+    {0: 1, 1: 1}
+    """
+    def __init__(self, trees: List['ParseNode']):
+        self.trees = []
+        # (rule start, rule body) -> {tree idx: number of nodes of the tree defining it}
+        self.counts = {}
+        # (rule start, rule body) -> (tree idx, position in the tree's rules) of its first definition
+        self.first = {}
+        # For each tree, the position of the first definition of each of its rules
+        self.positions = []
+        for tree in trees:
+            self.trees.append(None)
+            self.positions.append({})
+            self.__set_tree(len(self.trees) - 1, tree)
+
+    def update(self, trees: List['ParseNode'], tree_idxs: Iterable[int] = None):
         """
-        Adds the rules defined in PARSE_NODE and all of its subtrees to the
-        GRAMMAR_NODE via recursion. RULE_MAP is used to keep track of duplicate
-        rules, so they are not added multiple times to the grammar.
+        Updates the counts to the rules of `trees`, only visiting the trees which are
+        not those the grammar was last updated with. If `tree_idxs` is given, only the
+        trees at these indices may have changed.
         """
-        # Terminals and nodes with no children do not define rules
-        if parse_node.is_terminal or len(parse_node.children) == 0:
+        if len(trees) != len(self.trees):
+            self.__init__(trees)
             return
-
-        # The current ParseNode defines a rule. Add this rule to the grammar.
-        #        t0
-        #       / | \
-        #     t1  a  b
-        #    / |
-        #    ...
-        # E.g. the ParseNode t0 defines the rule t0 -> t1 a b
-        rule_body = [clean_terminal(child.payload) if child.is_terminal
-                     else child.payload
-                     for child in parse_node.children]
-        rule = Rule(parse_node.payload)
-        rule.add_body(rule_body)
-        rule_str = ''.join([elem for elem in rule_body])
-        if rule.start not in rule_map: rule_map[rule.start] = set()
-        if rule_str not in rule_map[rule.start]:
-            grammar_node.add_rule(rule)
-            rule_map[rule.start].add(rule_str)
-
-        # Recurse on the children of this ParseNode so the rule they define
-        # are also added to the grammar.
-        for child in parse_node.children:
-            build_rules(grammar_node, child, rule_map)
-
-    # Construct the initial grammar node without children, then fill them.
-    grammar, rule_map = Grammar(START), {}
-    for tree in trees:
-        build_rules(grammar, tree, rule_map)
-    return grammar
+        for tree_idx in range(len(trees)) if tree_idxs is None else sorted(tree_idxs):
+            if trees[tree_idx] is not self.trees[tree_idx]:
+                self.__set_tree(tree_idx, trees[tree_idx])
+
+    def __set_tree(self, tree_idx: int, tree: 'ParseNode'):
+        # Rules whose first definition was in the old tree
+        stale = set()
+        for rule in self.positions[tree_idx]:
+            tree_counts = self.counts[rule]
+            del tree_counts[tree_idx]
+            if not tree_counts:
+                del self.counts[rule]
+                del self.first[rule]
+            elif self.first[rule][0] == tree_idx:
+                stale.add(rule)
+        positions = {}
+        for position, (rule_start, rule_body) in enumerate(tree.rules()):
+            rule = (rule_start, tuple(rule_body))
+            if rule not in positions:
+                positions[rule] = position
+                self.counts.setdefault(rule, {})[tree_idx] = 0
+            self.counts[rule][tree_idx] += 1
+        self.trees[tree_idx] = tree
+        self.positions[tree_idx] = positions
+        for rule, position in positions.items():
+            if rule not in self.first or (tree_idx, position) < self.first[rule]:
+                self.first[rule] = (tree_idx, position)
+            stale.discard(rule)
+        for rule in stale:
+            first_tree = min(self.counts[rule])
+            self.first[rule] = (first_tree, self.positions[first_tree][rule])
+
+    def grammar(self) -> Grammar:
+        """
+        Returns the grammar of the rules currently defined by the trees.
+        """
+        grammar = Grammar(START)
+        for rule_start, rule_body in sorted(self.first, key=self.first.__getitem__):
+            if rule_start not in grammar.rules:
+                grammar.rules[rule_start] = Rule(rule_start)
+            grammar.rules[rule_start].add_body(list(rule_body))
+        grammar.cache_hash = grammar._rule_hash()
+        return grammar
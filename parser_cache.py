@@ -0,0 +1,337 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+from collections import OrderedDict
+
+import lark
+from lark import Lark
+from lark.exceptions import GrammarError
+from lark.grammar import Rule as LarkRule
+from lark.lexer import TerminalDef
+from lark.parsers.lalr_analysis import IntParseTable
+
+"""
+Content-addressed cache of compiled Lark parsers, shared by search.py, eval.py and
+any worker processes they start.
+
+A parser is looked up by a fingerprint of the normalized grammar text and the Lark
+options used to build it. Parsers are kept in a small in-memory LRU, and LALR parsers
+are also stored on disk so that a later run (or another process) building the same
+grammar can skip the compilation:
+  - LALR parsers are stored serialized (the data Lark.save would pickle, as JSON), so
+    loading them skips all grammar analysis.
+  - Grammars that Lark rejects (e.g. reduce/reduce conflicts) are stored with their
+    error, so that trying them again fails fast.
+LALR parsers have a `shift_reduce_conflicts` attribute, telling whether Lark resolved
+shift/reduce conflicts of the grammar (as shifts), in which case the parser may
+reject strings of the language.
+Earley parsers cannot be serialized by Lark, so they are only cached in memory.
+
+The entries are JSON rather than pickles, so a planted entry cannot run code, and the
+cache directory must belong to the user and not be writable by others, or the disk
+cache is not used.
+"""
+
+# Directory of the on-disk cache. Set to None to only cache in memory. Worker
+# processes pick up the directory through the environment variable.
+CACHE_DIR_ENV_VAR = 'ARVADA_PARSER_CACHE'
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                                 'arvada', 'parsers')
+PARSER_CACHE_DIR = os.environ.get(CACHE_DIR_ENV_VAR, DEFAULT_CACHE_DIR)
+MAX_MEMORY_ENTRIES = 32
+MAX_DISK_ENTRIES = 1000
+
+CACHE_SUFFIX = '.larkcache.json'
+# Bumped when the format of the entries changes
+FORMAT_VERSION = 2
+
+# Cache directory -> whether it is safe to use, see cache_dir_usable
+checked_dirs = {}
+
+memory_cache = OrderedDict()
+
+CACHE_HITS = 0
+CACHE_MISSES = 0
+
+
+def set_cache_dir(cache_dir):
+    """
+    Sets the on-disk cache directory to `cache_dir` (None disables the disk cache).
+    Exported to the environment so that worker processes share the same cache.
+    """
+    global PARSER_CACHE_DIR
+    PARSER_CACHE_DIR = cache_dir
+    if cache_dir is None:
+        os.environ.pop(CACHE_DIR_ENV_VAR, None)
+    else:
+        os.environ[CACHE_DIR_ENV_VAR] = cache_dir
+
+
+def normalize_grammar_text(grammar_text: str):
+    """
+    Normalizes a Lark grammar so that grammars which only differ in the order of
+    their rules or in whitespace get the same fingerprint.
+    >>> normalize_grammar_text('t1: "b"\\nstart: t0  \\nt0: t1\\n    | "a"')
+    'start: t0\\nt0: t1\\n    | "a"\\nt1: "b"'
+    """
+    rules = []
+    for line in grammar_text.split('\n'):
+        line = line.rstrip()
+        if not line:
+            continue
+        if line[0].isspace() and rules:
+            rules[-1].append(line)
+        else:
+            rules.append([line])
+    rules.sort(key=lambda rule: (not rule[0].startswith('start:'), rule[0].split(':')[0]))
+    return '\n'.join(line for rule in rules for line in rule)
+
+
+def grammar_fingerprint(grammar_text: str, options: dict):
+    """
+    Returns the key of the grammar `grammar_text` compiled with the Lark `options`.
+    The Lark and python versions are part of the key, as the serialized parsers are
+    not portable between them.
+    """
+    options_str = ','.join(f'{k}={options[k]!r}' for k in sorted(options))
+    key_str = '\n'.join([grammar_text, options_str, lark.__version__, str(sys.version_info[:2])])
+    return hashlib.sha256(key_str.encode('utf-8')).hexdigest()
+
+
+def get_parser(grammar_text: str, **options):
+    """
+    Returns a Lark parser for `grammar_text` built with `options`, from the cache
+    if it has been built before. Raises whatever Lark raises if the grammar does
+    not compile.
+    """
+    global CACHE_HITS, CACHE_MISSES
+    grammar_text = normalize_grammar_text(grammar_text)
+    key = grammar_fingerprint(grammar_text, options)
+
+    if key in memory_cache:
+        memory_cache.move_to_end(key)
+        CACHE_HITS += 1
+        parser = memory_cache[key]
+    else:
+        parser = load_from_disk(key, options)
+        if parser is not None:
+            CACHE_HITS += 1
+        else:
+            CACHE_MISSES += 1
+            parser = build_and_store(key, grammar_text, options)
+
+        memory_cache[key] = parser
+        while len(memory_cache) > MAX_MEMORY_ENTRIES:
+            memory_cache.popitem(last=False)
+
+    if isinstance(parser, GrammarError):
+        raise GrammarError(str(parser))
+    return parser
+
+
+def cache_path(key):
+    return os.path.join(PARSER_CACHE_DIR, key + CACHE_SUFFIX)
+
+
+def cache_dir_usable():
+    """
+    Whether the disk cache is enabled and PARSER_CACHE_DIR is safe to use: it is
+    created (with mode 0700) if needed, and must belong to the current user and not
+    be writable by the group or others. Warns once if it is not.
+    """
+    if PARSER_CACHE_DIR is None:
+        return False
+    if PARSER_CACHE_DIR in checked_dirs:
+        return checked_dirs[PARSER_CACHE_DIR]
+    problem = None
+    try:
+        os.makedirs(PARSER_CACHE_DIR, mode=0o700, exist_ok=True)
+        stat = os.stat(PARSER_CACHE_DIR)
+        if hasattr(os, 'getuid') and stat.st_uid != os.getuid():
+            problem = 'it belongs to another user'
+        elif stat.st_mode & 0o022:
+            problem = 'it is writable by other users'
+    except OSError as e:
+        problem = str(e)
+    if problem is not None:
+        print(f"WARNING: not using the parser cache directory {PARSER_CACHE_DIR}: {problem}", file=sys.stderr)
+    checked_dirs[PARSER_CACHE_DIR] = problem is None
+    return problem is None
+
+
+def to_json(value):
+    """
+    Encodes the serialized data of a Lark parser (dicts, possibly with int keys,
+    lists, tuples and scalars) to JSON-compatible values, reversed by from_json.
+    >>> data = {'rules': [{'@': 0}], 'memo': {0: ('a', 1.5, None)}}
+    >>> from_json(json.loads(json.dumps(to_json(data)))) == data
+    True
+    """
+    if isinstance(value, dict):
+        if all(isinstance(key, str) for key in value):
+            return {key: to_json(item) for key, item in value.items()}
+        return {'__items__': [[to_json(key), to_json(item)] for key, item in value.items()]}
+    if isinstance(value, tuple):
+        return {'__tuple__': [to_json(item) for item in value]}
+    if isinstance(value, list):
+        return [to_json(item) for item in value]
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    raise TypeError(f"cannot store a {type(value).__name__} in the parser cache")
+
+
+def from_json(value):
+    if isinstance(value, dict):
+        if list(value) == ['__items__']:
+            return {from_json(key): from_json(item) for key, item in value['__items__']}
+        if list(value) == ['__tuple__']:
+            return tuple(from_json(item) for item in value['__tuple__'])
+        return {key: from_json(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [from_json(item) for item in value]
+    return value
+
+
+def load_from_disk(key, options):
+    """
+    Loads the parser stored under `key` (or the GrammarError it failed with),
+    or returns None if it is not on disk. Entries that fail to load are treated
+    as misses and removed.
+    """
+    if options.get('parser', 'earley') != 'lalr' or not cache_dir_usable():
+        return None
+    path = cache_path(key)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+        if entry.get('format_version') != FORMAT_VERSION:
+            # Written by another version of arvada, and overwritten once rebuilt
+            return None
+        if entry['kind'] == 'parser':
+            parser = Lark.load(from_json(entry['payload']))
+            parser.shift_reduce_conflicts = entry['conflicts']
+        elif entry['kind'] == 'error':
+            parser = GrammarError(entry['payload'])
+        else:
+            raise ValueError(f"unknown entry kind {entry['kind']!r}")
+        # Refresh the modification time, which eviction uses as a last-use time.
+        os.utime(path)
+        return parser
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"WARNING: could not load cached parser {path}: {e}", file=sys.stderr)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+
+
+def build_lalr(grammar_text, options):
+    """
+    Builds the LALR parser for `grammar_text` with `options`. Returns its serialized
+    data, and whether Lark resolved shift/reduce conflicts, which it only reports (as
+    warnings of its logger) when debugging.
+    >>> build_lalr('start: t0 "a" "b" | "a"\\nt0: "a" t0?', {'parser': 'lalr'})[1]
+    True
+    >>> build_lalr('start: t0 "b" | "a"\\nt0: "a" t0?', {'parser': 'lalr'})[1]
+    False
+    """
+    conflicts = []
+    handler = logging.Handler()
+    handler.emit = lambda record: conflicts.append(record.getMessage().startswith('Shift/Reduce'))
+    saved_handlers, saved_level = lark.logger.handlers, lark.logger.level
+    lark.logger.handlers = [handler]
+    lark.logger.setLevel(logging.WARNING)
+    try:
+        parser = Lark(grammar_text, **dict(options, debug=True))
+    finally:
+        lark.logger.handlers = saved_handlers
+        lark.logger.setLevel(saved_level)
+    # Debugging also keeps the sets of items of the states, as Lark would without it
+    # keep their numbers
+    lalr_parser = parser.parser.parser
+    lalr_parser._parse_table = IntParseTable.from_ParseTable(lalr_parser._parse_table)
+    data, memo = parser.memo_serialize([TerminalDef, LarkRule])
+    # The parser is used without debugging, which would print on some errors
+    data['options']['debug'] = False
+    return {'data': data, 'memo': memo}, any(conflicts)
+
+
+def build_and_store(key, grammar_text, options):
+    """
+    Builds the parser for `grammar_text` and writes it to disk under `key`.
+    If the LALR parser cannot be built, the error is stored and returned (as a
+    GrammarError) instead.
+    """
+    if options.get('parser', 'earley') != 'lalr':
+        return Lark(grammar_text, **options)
+
+    try:
+        payload, conflicts = build_lalr(grammar_text, options)
+        parser = Lark.load(payload)
+        parser.shift_reduce_conflicts = conflicts
+        entry = {'kind': 'parser', 'payload': payload, 'conflicts': conflicts}
+    except Exception as e:
+        # Not only LarkErrors: Lark can fail on some grammars with other errors
+        parser = GrammarError(str(e))
+        entry = {'kind': 'error', 'payload': str(e)}
+
+    if cache_dir_usable():
+        try:
+            entry = dict(entry, format_version=FORMAT_VERSION, payload=to_json(entry['payload']))
+        except TypeError as e:
+            print(f"WARNING: could not cache parser: {e}", file=sys.stderr)
+            return parser
+        write_atomically(cache_path(key), entry)
+        evict_disk_entries()
+    return parser
+
+
+def write_atomically(path, entry):
+    """
+    Writes the JSON `entry` to `path` through a temporary file and a rename, so
+    concurrent readers never see a partially written entry.
+    """
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"WARNING: could not write cached parser {path}: {e}", file=sys.stderr)
+
+
+def evict_disk_entries():
+    """
+    Removes the least recently used entries from the disk cache until at most
+    MAX_DISK_ENTRIES remain.
+    """
+    try:
+        entries = [e for e in os.scandir(PARSER_CACHE_DIR) if e.name.endswith(CACHE_SUFFIX)]
+    except OSError:
+        return
+    if len(entries) <= MAX_DISK_ENTRIES:
+        return
+
+    def last_use(entry):
+        try:
+            return entry.stat().st_mtime
+        except OSError:
+            return 0
+
+    entries.sort(key=last_use)
+    for entry in entries[:len(entries) - MAX_DISK_ENTRIES]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            # Another process may have evicted it first.
+            pass
+
+
+def clear_memory_cache():
+    memory_cache.clear()
@@ -0,0 +1,125 @@
+import heapq
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+from parse_tree import ParseNode
+
+"""
+Pre-screening of the training examples (search.py --prescreen), before learning.
+
+Every example becomes a parse tree taking part in every grouping and coalescing
+pass, so the cost of each iteration grows with the number of examples, while many
+examples of a corpus are duplicates, or differ only inside token classes (other
+numbers, other identifiers), and teach nothing the others do not. The examples are
+deduplicated after pretokenization and clustered by their skeleton: their leaves
+with the runs of characters of a same class (see search.get_category) replaced by
+the class. At most MAX_PER_SKELETON examples, the shortest ones, are kept per
+skeleton, and if that is more than MAX_EXAMPLES, the ones kept cover as many
+different pairs of adjacent skeleton symbols as possible, which favors the
+examples with structures no other kept example shows. Without pretokenization,
+there are no classes, and the examples are only deduplicated.
+"""
+
+# Number of examples kept per skeleton (the shortest ones), None for all
+MAX_PER_SKELETON = 1
+
+# Number of examples kept overall, None for no cap
+MAX_EXAMPLES = None
+
+
+def skeleton(leaves: List[ParseNode], get_category: Callable[[str], Optional[str]]):
+    """
+    Returns the skeleton of the example with leaves `leaves`: the characters with a
+    category, by `get_category`, are replaced by it, and runs of a same category are
+    collapsed.
+    >>> category = lambda c: 'DIGIT' if c.isdigit() else None
+    >>> leaves = [ParseNode(c, True, []) for c in '[12,3]']
+    >>> skeleton(leaves, category) == skeleton([ParseNode('[7,45]', True, [])], category)
+    True
+    >>> skeleton(leaves, category)
+    ('[', 'DIGIT', ',', 'DIGIT', ']')
+    """
+    symbols = []
+    for leaf in leaves:
+        for c in leaf.payload:
+            category = get_category(c)
+            symbol = c if category is None else category
+            if category is not None and symbols and symbols[-1] == symbol:
+                continue
+            symbols.append(symbol)
+    return tuple(symbols)
+
+
+def bigrams(symbols):
+    return set(zip((None,) + symbols, symbols + (None,)))
+
+
+def prescreen(examples: List[List[ParseNode]], get_category: Callable[[str], Optional[str]]):
+    """
+    Returns the indices (in order) of the `examples` (lists of leaves) to learn from,
+    and a summary of the pre-screening: the number of examples, of duplicates, of
+    skeletons, and of examples dropped by MAX_PER_SKELETON and MAX_EXAMPLES. If
+    `get_category` is None, the skeleton of an example is the example itself.
+    >>> category = lambda c: 'DIGIT' if c.isdigit() else None
+    >>> examples = [[ParseNode(c, True, []) for c in ex] for ex in ['[1]', '[1]', '[22]', '[1,2]', '(3)']]
+    >>> kept, summary = prescreen(examples, category)
+    >>> kept
+    [0, 3, 4]
+    >>> summary['duplicates'], summary['skeletons'], summary['over_skeleton_cap']
+    (1, 3, 1)
+    >>> prescreen(examples, None)[0]
+    [0, 2, 3, 4]
+    """
+    if MAX_PER_SKELETON is not None and MAX_PER_SKELETON < 1 or MAX_EXAMPLES is not None and MAX_EXAMPLES < 1:
+        raise ValueError('MAX_PER_SKELETON and MAX_EXAMPLES must be positive (or None)')
+    if get_category is None:
+        get_category = lambda c: None
+    summary = OrderedDict(examples=len(examples), duplicates=0, skeletons=0,
+                          over_skeleton_cap=0, over_size_cap=0)
+
+    # Exact duplicates after pretokenization
+    seen = set()
+    unique_idxs = []
+    for idx, leaves in enumerate(examples):
+        key = tuple(leaf.payload for leaf in leaves)
+        if key in seen:
+            summary['duplicates'] += 1
+            continue
+        seen.add(key)
+        unique_idxs.append(idx)
+
+    # Clusters by skeleton, each sorted shortest first
+    clusters = OrderedDict()
+    for idx in unique_idxs:
+        clusters.setdefault(skeleton(examples[idx], get_category), []).append(idx)
+    summary['skeletons'] = len(clusters)
+    def length(idx):
+        return sum(len(leaf.payload) for leaf in examples[idx])
+
+    # (rank in its cluster, length, idx, skeleton) of the examples under MAX_PER_SKELETON
+    candidates = []
+    for skel, idxs in clusters.items():
+        idxs.sort(key=length)
+        kept = idxs if MAX_PER_SKELETON is None else idxs[:MAX_PER_SKELETON]
+        summary['over_skeleton_cap'] += len(idxs) - len(kept)
+        candidates.extend((rank, length(idx), idx, skel) for rank, idx in enumerate(kept))
+
+    if MAX_EXAMPLES is None or len(candidates) <= MAX_EXAMPLES:
+        return sorted(idx for _, _, idx, _ in candidates), summary
+
+    # Greedy cover of the skeleton bigrams, lazily re-evaluating the gains (which
+    # only decrease): heap of (-gain, rank, length, idx, skeleton)
+    covered = set()
+    heap = [(-len(bigrams(skel)), rank, size, idx, skel) for rank, size, idx, skel in candidates]
+    heapq.heapify(heap)
+    chosen = []
+    while heap and len(chosen) < MAX_EXAMPLES:
+        neg_gain, rank, size, idx, skel = heapq.heappop(heap)
+        gain = len(bigrams(skel) - covered)
+        if heap and (-gain, rank, size, idx) > heap[0][:4]:
+            heapq.heappush(heap, (-gain, rank, size, idx, skel))
+            continue
+        covered.update(bigrams(skel))
+        chosen.append(idx)
+    summary['over_size_cap'] = len(candidates) - len(chosen)
+    return sorted(chosen), summary
@@ -0,0 +1,683 @@
+import random
+import string
+from typing import Dict, List, Set
+
+"""
+Detection and compilation of the regular parts of a grammar.
+
+Many of the nonterminals Arvada learns (integers, identifiers, whitespace, ...) are
+not self-embedding, so each of them derives a regular language. This file finds the
+nonterminals whose whole subgrammar is left- or right-linear, and compiles each of
+them to a Regex, which can be turned into a python regex, matched exactly with a
+lazily-built DFA, or sampled from.
+
+The functions here work on the `rules` dictionary of a Grammar (rule start -> Rule),
+where terminals are wrapped in double quotes and the empty string is epsilon.
+"""
+
+# Regexes larger than this (in number of nodes) are not worth compiling; the
+# elimination of a big linear system can blow up the size of the regex.
+MAX_REGEX_SIZE = 500
+
+# Max number of repetitions of a star/plus when sampling from a Regex.
+MAX_SAMPLE_REPEATS = 10
+
+CONTROL_ESCAPES = {'\n': '\\n', '\t': '\\t', '\r': '\\r', '\f': '\\f', '\v': '\\v'}
+
+
+def regex_escape(c: str):
+    """
+    Escapes the character `c` for use in a regex, both in python and in a Lark
+    grammar (where the regex is delimited by slashes, and \\x escapes are
+    evaluated before the regex is compiled).
+    >>> regex_escape('a')
+    'a'
+    >>> print(regex_escape('/'), regex_escape('['), regex_escape('\\n'), regex_escape('\\x00'))
+    \\/ \\[ \\n \\x00
+    >>> print(regex_escape('\\u00e9'), regex_escape('\\u20ac'), regex_escape('\\U0001f600'))
+    \\xe9 \\u20ac \\U0001f600
+    """
+    if c.isalnum() and c.isascii():
+        return c
+    if c in CONTROL_ESCAPES:
+        return CONTROL_ESCAPES[c]
+    if c.isascii() and c in string.punctuation:
+        return '\\' + c
+    if ord(c) < 0x100:
+        return '\\x%02x' % ord(c)
+    # \u only takes 4 hex digits, the characters outside the BMP need \U
+    return '\\u%04x' % ord(c) if ord(c) <= 0xFFFF else '\\U%08x' % ord(c)
+
+
+class Regex():
+    """
+    A regular expression, as a tree of nodes of the following kinds:
+     - EPS: the empty string
+     - LIT: the literal string `value`
+     - CLASS: any single character in the set `value`
+     - CAT/ALT: the concatenation/alternation of `children`
+     - STAR/PLUS: zero/one or more repetitions of `children[0]`
+    Build them with the helper functions below (eps, lit, char_class, cat, alt, star,
+    plus), which keep the tree simplified.
+    """
+    EPS, LIT, CLASS, CAT, ALT, STAR, PLUS = range(7)
+
+    def __init__(self, kind, value=None, children=()):
+        self.kind = kind
+        self.value = value
+        self.children = tuple(children)
+        self.size = 1 + sum(child.size for child in self.children)
+        self.key = (kind, value if kind != Regex.CLASS else tuple(sorted(value)),
+                    tuple(child.key for child in self.children))
+
+    def __eq__(self, other):
+        return isinstance(other, Regex) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __str__(self):
+        return self.pattern()
+
+    def __repr__(self):
+        return f"Regex({self.pattern()})"
+
+    def is_infinite(self):
+        if self.kind in (Regex.STAR, Regex.PLUS):
+            return True
+        return any(child.is_infinite() for child in self.children)
+
+    def pattern(self):
+        """
+        Returns a python regex pattern for this regex. Alternatives are ordered
+        longest first, as regex alternation is not longest-match and the pattern
+        may be used by a lexer.
+        >>> alt([lit('a'), cat([lit('b'), plus(char_class('0123456789'))]), eps()]).pattern()
+        '(?:b[0-9]+|a)?'
+        >>> star(lit('ab')).pattern()
+        '(?:ab)*'
+        """
+        if self.kind == Regex.EPS:
+            return ''
+        if self.kind == Regex.LIT:
+            return ''.join(regex_escape(c) for c in self.value)
+        if self.kind == Regex.CLASS:
+            return '[' + class_ranges(self.value) + ']'
+        if self.kind == Regex.CAT:
+            return ''.join(child.pattern() for child in self.children)
+        if self.kind == Regex.ALT:
+            alternatives = [child for child in self.children if child.kind != Regex.EPS]
+            if self.is_optional() and len(alternatives) == 1:
+                return alternatives[0].grouped_pattern() + '?'
+            patterns = sorted([child.pattern() for child in alternatives], key=lambda a: (-len(a), a))
+            return '(?:' + '|'.join(patterns) + ')' + ('?' if self.is_optional() else '')
+        op = '*' if self.kind == Regex.STAR else '+'
+        return self.children[0].grouped_pattern() + op
+
+    def is_optional(self):
+        return self.kind == Regex.ALT and any(child.kind == Regex.EPS for child in self.children)
+
+    def is_atomic(self):
+        return self.kind == Regex.CLASS or (self.kind == Regex.LIT and len(self.value) == 1)
+
+    def grouped_pattern(self):
+        """
+        Returns the pattern of this regex, grouped so a quantifier can be applied to it.
+        """
+        if self.is_atomic() or (self.kind == Regex.ALT and not self.is_optional()):
+            return self.pattern()
+        return '(?:' + self.pattern() + ')'
+
+    def sample(self):
+        """
+        Returns a random string matched by this regex. The number of repetitions of
+        a star or plus is geometrically distributed (like choosing between the base
+        and recursive case of a linear rule), capped at MAX_SAMPLE_REPEATS.
+        """
+        if self.kind == Regex.EPS:
+            return ''
+        if self.kind == Regex.LIT:
+            return self.value
+        if self.kind == Regex.CLASS:
+            return random.choice(sorted(self.value))
+        if self.kind == Regex.CAT:
+            return ''.join(child.sample() for child in self.children)
+        if self.kind == Regex.ALT:
+            return random.choice(self.children).sample()
+        repeats = 0 if self.kind == Regex.STAR else 1
+        while repeats < MAX_SAMPLE_REPEATS and random.random() < 0.5:
+            repeats += 1
+        return ''.join(self.children[0].sample() for _ in range(repeats))
+
+
+def class_ranges(chars):
+    """
+    Returns the inside of a character class matching `chars`, with runs of
+    consecutive characters written as ranges.
+    >>> class_ranges(set('0123456789abcx'))
+    '0-9a-cx'
+    """
+    codes = sorted(ord(c) for c in chars)
+    ret = ''
+    i = 0
+    while i < len(codes):
+        j = i
+        while j + 1 < len(codes) and codes[j + 1] == codes[j] + 1:
+            j += 1
+        if j - i >= 2:
+            ret += regex_escape(chr(codes[i])) + '-' + regex_escape(chr(codes[j]))
+        else:
+            ret += ''.join(regex_escape(chr(code)) for code in codes[i:j + 1])
+        i = j + 1
+    return ret
+
+
+def eps():
+    return Regex(Regex.EPS)
+
+
+def lit(string):
+    if len(string) == 0:
+        return eps()
+    return Regex(Regex.LIT, string)
+
+
+def char_class(chars):
+    chars = frozenset(chars)
+    if len(chars) == 1:
+        return lit(next(iter(chars)))
+    return Regex(Regex.CLASS, chars)
+
+
+def cat_parts(regex: Regex):
+    if regex.kind == Regex.EPS:
+        return []
+    return list(regex.children) if regex.kind == Regex.CAT else [regex]
+
+
+def cat(parts: List[Regex]):
+    flat = []
+    for part in parts:
+        for child in cat_parts(part):
+            if child.kind == Regex.LIT and flat and flat[-1].kind == Regex.LIT:
+                flat[-1] = lit(flat[-1].value + child.value)
+            # X* X and X X* are X+
+            elif child.kind == Regex.STAR and flat and flat[-1] == child.children[0]:
+                flat[-1] = plus(child.children[0])
+            elif flat and flat[-1].kind == Regex.STAR and flat[-1].children[0] == child:
+                flat[-1] = plus(child)
+            else:
+                flat.append(child)
+    if len(flat) == 0:
+        return eps()
+    if len(flat) == 1:
+        return flat[0]
+    return Regex(Regex.CAT, children=flat)
+
+
+def alt(parts: List[Regex]):
+    """
+    Returns the alternation of `parts`, factoring out common prefixes/suffixes and
+    merging single characters into character classes.
+    >>> alt([cat([lit('-'), plus(lit('1'))]), plus(lit('1'))]).pattern()
+    '\\\\-?1+'
+    >>> alt([lit('a'), lit('b'), lit('c')]).pattern()
+    '[a-c]'
+    """
+    flat = []
+    seen = set()
+    for part in parts:
+        children = part.children if part.kind == Regex.ALT else [part]
+        for child in children:
+            if child not in seen:
+                seen.add(child)
+                flat.append(child)
+    if len(flat) == 1:
+        return flat[0]
+    # Factor out a common suffix or prefix, e.g. "-" X | X  ==>  "-"? X
+    flat_parts = [cat_parts(child) for child in flat]
+    if all(flat_parts):
+        if all(p[-1] == flat_parts[0][-1] for p in flat_parts):
+            return cat([alt([cat(p[:-1]) for p in flat_parts]), flat_parts[0][-1]])
+        if all(p[0] == flat_parts[0][0] for p in flat_parts):
+            return cat([flat_parts[0][0], alt([cat(p[1:]) for p in flat_parts])])
+    # Merge single characters into a character class
+    single_chars = [child for child in flat if child.is_atomic()]
+    if len(single_chars) > 1:
+        chars = set()
+        for child in single_chars:
+            chars.update(child.value)
+        flat = [child for child in flat if not child.is_atomic()] + [char_class(chars)]
+        if len(flat) == 1:
+            return flat[0]
+    return Regex(Regex.ALT, children=flat)
+
+
+def star(regex: Regex):
+    if regex.kind == Regex.EPS:
+        return regex
+    if regex.kind in (Regex.STAR, Regex.PLUS):
+        return Regex(Regex.STAR, children=regex.children)
+    if regex.is_optional():
+        return star(alt([child for child in regex.children if child.kind != Regex.EPS]))
+    return Regex(Regex.STAR, children=[regex])
+
+
+def plus(regex: Regex):
+    if regex.kind in (Regex.EPS, Regex.STAR, Regex.PLUS):
+        return regex
+    if regex.is_optional():
+        return star(regex)
+    return Regex(Regex.PLUS, children=[regex])
+
+
+class LazyDFA():
+    """
+    Exact matcher for a Regex. The regex is compiled to a Thompson NFA, whose subset
+    construction is built lazily, one transition at a time, as strings are matched.
+    Matching takes time linear in the length of the string, with no backtracking.
+    >>> dfa = LazyDFA(cat([plus(char_class('0123456789')), alt([eps(), cat([lit('.'), plus(char_class('0123456789'))])])]))
+    >>> [dfa.matches(s) for s in ['12', '1.5', '1.', '.5', '']]
+    [True, True, False, False, False]
+    """
+
+    def __init__(self, regex: Regex):
+        # For each NFA state: the epsilon successors, and the (character set, successor)
+        # of its (at most one) character transition.
+        self.eps_edges: List[List[int]] = []
+        self.char_edges: List = []
+        self.start_nfa, self.final_nfa = self.build(regex)
+        self.start = self.closure({self.start_nfa})
+        self.transitions = {}
+
+    def new_state(self):
+        self.eps_edges.append([])
+        self.char_edges.append(None)
+        return len(self.eps_edges) - 1
+
+    def build(self, regex: Regex):
+        """
+        Adds the NFA fragment for `regex`, and returns its (start, final) states.
+        """
+        start = self.new_state()
+        if regex.kind == Regex.EPS:
+            return start, start
+        if regex.kind == Regex.LIT:
+            cur = start
+            for c in regex.value:
+                nxt = self.new_state()
+                self.char_edges[cur] = (frozenset(c), nxt)
+                cur = nxt
+            return start, cur
+        if regex.kind == Regex.CLASS:
+            final = self.new_state()
+            self.char_edges[start] = (regex.value, final)
+            return start, final
+        if regex.kind == Regex.CAT:
+            cur = start
+            for child in regex.children:
+                child_start, child_final = self.build(child)
+                self.eps_edges[cur].append(child_start)
+                cur = child_final
+            return start, cur
+        final = self.new_state()
+        if regex.kind == Regex.ALT:
+            for child in regex.children:
+                child_start, child_final = self.build(child)
+                self.eps_edges[start].append(child_start)
+                self.eps_edges[child_final].append(final)
+            return start, final
+        child_start, child_final = self.build(regex.children[0])
+        self.eps_edges[start].append(child_start)
+        self.eps_edges[child_final].append(child_start)
+        self.eps_edges[child_final].append(final)
+        if regex.kind == Regex.STAR:
+            self.eps_edges[start].append(final)
+        return start, final
+
+    def closure(self, states):
+        stack = list(states)
+        closed = set(states)
+        while stack:
+            state = stack.pop()
+            for nxt in self.eps_edges[state]:
+                if nxt not in closed:
+                    closed.add(nxt)
+                    stack.append(nxt)
+        return frozenset(closed)
+
+    def step(self, states, c):
+        key = (states, c)
+        if key not in self.transitions:
+            successors = set()
+            for state in states:
+                edge = self.char_edges[state]
+                if edge is not None and c in edge[0]:
+                    successors.add(edge[1])
+            self.transitions[key] = self.closure(successors)
+        return self.transitions[key]
+
+    def matches(self, string: str):
+        states = self.start
+        for c in string:
+            states = self.step(states, c)
+            if not states:
+                return False
+        return self.final_nfa in states
+
+    def next_chars(self, states):
+        """
+        Returns the characters on which `states` have a transition.
+        """
+        chars = set()
+        for state in states:
+            if self.char_edges[state] is not None:
+                chars.update(self.char_edges[state][0])
+        return chars
+
+    def continuation_chars(self):
+        """
+        Returns the characters c such that some string w of the language is followed
+        by c in another string of the language (w c is a prefix of it). Every NFA
+        state leads to the final state, so these are the transitions out of the
+        reachable sets of states containing the final state.
+        >>> sorted(LazyDFA(plus(char_class('01'))).continuation_chars()), LazyDFA(lit('ab')).continuation_chars()
+        (['0', '1'], set())
+        """
+        chars = set()
+        seen, to_visit = {self.start}, [self.start]
+        while to_visit:
+            states = to_visit.pop()
+            next_chars = self.next_chars(states)
+            if self.final_nfa in states:
+                chars.update(next_chars)
+            for c in next_chars:
+                successors = self.step(states, c)
+                if successors not in seen:
+                    seen.add(successors)
+                    to_visit.append(successors)
+        return chars
+
+    def prefix_matches(self, string: str):
+        """
+        Returns the lengths of the non-empty prefixes of `string` in the language, and
+        whether `string` is a prefix of a string of the language.
+        >>> LazyDFA(plus(lit('ab'))).prefix_matches('abab')
+        ([2, 4], True)
+        """
+        lengths = []
+        states = self.start
+        for i, c in enumerate(string):
+            states = self.step(states, c)
+            if not states:
+                return lengths, False
+            if self.final_nfa in states:
+                lengths.append(i + 1)
+        return lengths, True
+
+
+def nullable(regex: Regex):
+    if regex.kind in (Regex.EPS, Regex.STAR):
+        return True
+    if regex.kind == Regex.CAT:
+        return all(nullable(child) for child in regex.children)
+    if regex.kind == Regex.ALT:
+        return any(nullable(child) for child in regex.children)
+    if regex.kind == Regex.PLUS:
+        return nullable(regex.children[0])
+    return False
+
+
+def non_nullable(regex: Regex):
+    """
+    Returns a regex for the non-empty strings of `regex`, None if it has none.
+    >>> non_nullable(cat([star(lit('a')), alt([eps(), lit('b')])])).pattern()
+    '(?:a+b?|b)'
+    """
+    if not nullable(regex):
+        return regex
+    if regex.kind == Regex.EPS:
+        return None
+    if regex.kind == Regex.STAR:
+        return plus(non_nullable(regex.children[0]) or regex.children[0])
+    if regex.kind == Regex.PLUS:
+        return non_nullable(regex.children[0]) and plus(non_nullable(regex.children[0]))
+    if regex.kind == Regex.ALT:
+        parts = [part for part in map(non_nullable, regex.children) if part is not None]
+        return alt(parts) if parts else None
+    # A nullable concatenation X Y: its non-empty strings are X' Y | Y'
+    head, rest = regex.children[0], cat(regex.children[1:])
+    parts = [part for part in [non_nullable(head) and cat([non_nullable(head), rest]), non_nullable(rest)]
+             if part is not None]
+    return alt(parts) if parts else None
+
+
+def prefix_overlap(first: Regex, second: Regex):
+    """
+    Whether a non-empty string of `first` is a prefix of (or equal to) a string of
+    `second`, i.e. whether a lexer may match `first` where `second` should be.
+    >>> prefix_overlap(plus(char_class('0123456789')), lit('1.5')), prefix_overlap(lit('a'), plus(char_class('0123456789')))
+    (True, False)
+    """
+    if first.kind == Regex.LIT:
+        return LazyDFA(second).prefix_matches(first.value)[1]
+    if second.kind == Regex.LIT:
+        return len(LazyDFA(first).prefix_matches(second.value)[0]) > 0
+    # Explore the pairs of sets of states reached by the same strings
+    first_dfa, second_dfa = LazyDFA(first), LazyDFA(second)
+    start = (first_dfa.start, second_dfa.start)
+    seen, to_visit = {start}, [start]
+    while to_visit:
+        first_states, second_states = to_visit.pop()
+        for c in first_dfa.next_chars(first_states) & second_dfa.next_chars(second_states):
+            pair = (first_dfa.step(first_states, c), second_dfa.step(second_states, c))
+            if first_dfa.final_nfa in pair[0]:
+                return True
+            if pair not in seen:
+                seen.add(pair)
+                to_visit.append(pair)
+    return False
+
+
+def lexer_pattern(regex: Regex, continuation_chars):
+    """
+    Returns the pattern of `regex` for a lexer token, which cannot stop before one of
+    the `continuation_chars` of the token (see LazyDFA.continuation_chars): python
+    regexes do not always match the longest string, but when no continuation of a
+    token can follow it, its only match is the right one.
+    >>> lexer_pattern(plus(char_class('0123456789')), set('0123456789'))
+    '(?:[0-9]+)(?![0-9])'
+    """
+    if not continuation_chars:
+        return regex.pattern()
+    return f'(?:{regex.pattern()})(?![{class_ranges(continuation_chars)}])'
+
+
+def nonterminal_sccs(rules) -> List[List[str]]:
+    """
+    Returns the strongly connected components of the graph where each nonterminal
+    points to the nonterminals in its rule's bodies. Components are returned in
+    dependency order: each component comes after every component it refers to.
+    >>> from grammar import Rule
+    >>> rules = {'a': Rule('a').add_body(['b', 'c']), 'b': Rule('b').add_body(['"x"', 'b']).add_body(['c']), 'c': Rule('c').add_body(['"y"'])}
+    >>> nonterminal_sccs(rules)
+    [['c'], ['b'], ['a']]
+    """
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    sccs = []
+    counter = 0
+    for root in rules:
+        if root in index:
+            continue
+        # Iterative Tarjan: each work item is a nonterminal and an iterator on its successors
+        work = [(root, iter([elem for body in rules[root].bodies for elem in body if elem in rules]))]
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            nt, successors = work[-1]
+            advanced = False
+            for succ in successors:
+                if succ not in index:
+                    index[succ] = lowlink[succ] = counter
+                    counter += 1
+                    stack.append(succ)
+                    on_stack.add(succ)
+                    work.append((succ, iter([elem for body in rules[succ].bodies for elem in body if elem in rules])))
+                    advanced = True
+                    break
+                elif succ in on_stack:
+                    lowlink[nt] = min(lowlink[nt], index[succ])
+            if advanced:
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[nt])
+            if lowlink[nt] == index[nt]:
+                scc = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    scc.append(member)
+                    if member == nt:
+                        break
+                sccs.append(sorted(scc))
+    return sccs
+
+
+def regular_nonterminals(rules) -> Dict[str, Regex]:
+    """
+    Returns a map from each nonterminal in `rules` whose subgrammar is regular (every
+    strongly connected component it reaches is all left-linear or all right-linear)
+    to a Regex matching exactly the strings it derives.
+    >>> from grammar import Rule
+    >>> rules = {}
+    >>> rules['tdigit'] = Rule('tdigit')
+    >>> for i in range(10): _ = rules['tdigit'].add_body([f'"{i}"'])
+    >>> rules['tdigits'] = Rule('tdigits').add_body(['tdigit']).add_body(['tdigit', 'tdigits'])
+    >>> rules['t1'] = Rule('t1').add_body(['"-"', 'tdigits']).add_body(['tdigits'])
+    >>> rules['t2'] = Rule('t2').add_body(['"("', 't2', '")"']).add_body(['t1'])
+    >>> regexes = regular_nonterminals(rules)
+    >>> sorted(regexes)
+    ['t1', 'tdigit', 'tdigits']
+    >>> regexes['t1'].pattern()
+    '\\\\-?[0-9]+'
+    >>> rules['t3'] = Rule('t3').add_body(['t1', 't9'])
+    >>> 't3' in regular_nonterminals(rules)
+    False
+    """
+    regexes = {}
+    for scc in nonterminal_sccs(rules):
+        solved = solve_scc(rules, scc, regexes)
+        if solved is None:
+            continue
+        if any(regex.size > MAX_REGEX_SIZE for regex in solved.values()):
+            continue
+        regexes.update(solved)
+    return regexes
+
+
+def solve_scc(rules, scc: List[str], regexes: Dict[str, Regex]):
+    """
+    Solves the rules of the strongly connected component `scc` as a system of linear
+    equations over regexes, given the `regexes` of the (regular) nonterminals below it.
+    Returns the regex of each nonterminal in `scc`, or None if the component is not
+    all left-linear or all right-linear, or refers to non-regular nonterminals.
+    """
+    members = set(scc)
+    is_right_linear, is_left_linear = True, True
+    for nt in scc:
+        for body in rules[nt].bodies:
+            member_posns = [i for i, elem in enumerate(body) if elem in members]
+            if len(member_posns) > 1:
+                return None
+            if member_posns:
+                is_right_linear = is_right_linear and member_posns[0] == len(body) - 1
+                is_left_linear = is_left_linear and member_posns[0] == 0
+    if not is_right_linear and not is_left_linear:
+        return None
+
+    def elems_regex(elems):
+        parts = []
+        for elem in elems:
+            if elem in rules:
+                if elem not in regexes:
+                    return None
+                parts.append(regexes[elem])
+            elif elem == '':
+                parts.append(lit(''))
+            elif len(elem) >= 2 and elem.startswith('"') and elem.endswith('"'):
+                parts.append(lit(elem[1:-1]))
+            else:
+                # A nonterminal without rules
+                return None
+        return cat(parts)
+
+    # Each nonterminal X gets an equation X = sum_Y coefs[X][Y] Y + consts[X] (right-linear),
+    # or X = sum_Y Y coefs[X][Y] + consts[X] (left-linear).
+    def join(outer, inner):
+        return cat([outer, inner]) if is_right_linear else cat([inner, outer])
+
+    coefs = {nt: {} for nt in scc}
+    consts = {nt: [] for nt in scc}
+    for nt in scc:
+        coef_parts = {}
+        for body in rules[nt].bodies:
+            member = [elem for elem in body if elem in members]
+            rest = [elem for elem in body if elem not in members]
+            rest_regex = elems_regex(rest)
+            if rest_regex is None:
+                return None
+            if member:
+                coef_parts.setdefault(member[0], []).append(rest_regex)
+            else:
+                consts[nt].append(rest_regex)
+        coefs[nt] = {other: alt(parts) for other, parts in coef_parts.items()}
+    consts = {nt: alt(parts) if parts else None for nt, parts in consts.items()}
+
+    # Gaussian elimination, using Arden's lemma (X = aX + b  ==>  X = a*b) to remove self-references.
+    for nt in scc:
+        if nt in coefs[nt]:
+            loop = star(coefs[nt].pop(nt))
+            coefs[nt] = {other: join(loop, c) for other, c in coefs[nt].items()}
+            consts[nt] = join(loop, consts[nt]) if consts[nt] is not None else None
+        for other in scc:
+            if other == nt or nt not in coefs[other]:
+                continue
+            c = coefs[other].pop(nt)
+            for target, d in coefs[nt].items():
+                combined = join(c, d)
+                coefs[other][target] = alt([coefs[other][target], combined]) if target in coefs[other] else combined
+            if consts[nt] is not None:
+                combined = join(c, consts[nt])
+                consts[other] = alt([consts[other], combined]) if consts[other] is not None else combined
+            if consts[other] is not None and consts[other].size > MAX_REGEX_SIZE:
+                return None
+
+    solved = {}
+    for nt in scc:
+        # A nonterminal that never terminates derives nothing, so we don't compile it.
+        if consts[nt] is None:
+            return None
+        solved[nt] = consts[nt]
+    return solved
+
+
+def maximal_regular_nonterminals(rules, regexes: Dict[str, Regex]) -> Set[str]:
+    """
+    Returns the regular nonterminals (keys of `regexes`) that are not only used inside
+    the rules of other regular nonterminals, i.e. the roots of the largest regular
+    subgrammars.
+    """
+    used_by_non_regular = set()
+    for nt, rule in rules.items():
+        if nt in regexes:
+            continue
+        for body in rule.bodies:
+            used_by_non_regular.update(elem for elem in body if elem in regexes)
+    return used_by_non_regular | {nt for nt in regexes if nt == 'start'}
@@ -2,11 +2,11 @@ import functools
 import itertools
 import random
 import time
-from typing import Tuple, List, Set
+from typing import Dict, Tuple, List, Set
 import sys
 
 from grammar import Grammar
-from parse_tree import ParseNode, fixup_terminal
+from parse_tree import ParseNode, ParseTreeList, fixup_terminal, fold_tree
 REPLACE_CONST = '[[:REPLACEME]]'
 MAX_SAMPLES = 10
 
@@ -95,7 +95,6 @@ def muh_product(lst):
         prod *= e
     return prod
 
-#@functools.lru_cache()
 def lvl_n_derivable(trees, target_nt, n, max_samples=1000):
     """
     Get the strings that are level-n derivable from the nonterminal `target_nt` in `trees`.
@@ -103,6 +102,12 @@ def lvl_n_derivable(trees, target_nt, n, max_samples=1000):
       literally occur in `trees`
     - Level-n derivable: product of Level-(n-1) derivable strings for each child of `target_nt`
 
+    At most `max_samples` strings are returned, sampled uniformly from the stream of
+    derivable strings (each expansion of `target_nt` contributing its whole product,
+    or `max_samples` samples of it if it is larger). The results are memoized in
+    `trees` (a ParseTreeList) until its trees change, so the level-0 strings of
+    the children are computed once for all the level-1 calls.
+
     tree_1:
        t0
        |
@@ -142,23 +147,55 @@ def lvl_n_derivable(trees, target_nt, n, max_samples=1000):
     >>> lvl_n_derivable([tree_1, tree_2], 't0', 2)
     ['3', '(3)', '((3))', '(((3)))']
     """
-    ret_strs = set()
-    for tree in trees:
-        def process_tree(tree: ParseNode):
-             if tree.payload == target_nt:
-                if n == 0 or tree.is_terminal:
-                    ret_strs.add(tree.derived_string())
-                else:
-                    child_strs = [lvl_n_derivable(trees, c.payload, n-1, max_samples) for c in tree.children]
-                    ret_strs.update(sample_from_product_ext(child_strs, max_samples))
-             else:
-                 for c in tree.children:
-                    process_tree(c)
-        process_tree(tree)
-    if len(ret_strs) > max_samples:
-        return random.sample(list(ret_strs), max_samples)
+    if not isinstance(trees, ParseTreeList):
+        trees = ParseTreeList(list(trees))
+    memo, key = trees.derivable_memo.setdefault(target_nt, {}), (n, max_samples)
+    if key in memo:
+        return list(memo[key])
+
+    if n == 0:
+        strings = (node.derived_string() for node in trees.nodes(target_nt))
+    else:
+        def expansion_strings():
+            expansions = set()
+            for node in trees.nodes(target_nt):
+                expansion = tuple(c.payload for c in node.children)
+                if expansion in expansions:
+                    continue
+                expansions.add(expansion)
+                child_strs = [[c.derived_string()] if c.is_terminal else lvl_n_derivable(trees, c.payload, n - 1, max_samples)
+                              for c in node.children]
+                yield from sample_from_product_ext(child_strs, max_samples)
+        strings = expansion_strings()
+
+    ret_strs = reservoir_sample(strings, max_samples)
+    memo[key] = ret_strs
     return list(ret_strs)
 
+
+def reservoir_sample(strings, k):
+    """
+    Returns the distinct elements of the iterable `strings` in order, or k of them
+    sampled uniformly at random if there are more.
+    >>> reservoir_sample(['a', 'b', 'a', 'c'], 5)
+    ['a', 'b', 'c']
+    >>> len(reservoir_sample(map(str, range(100)), 10))
+    10
+    """
+    reservoir = []
+    seen = set()
+    for string in strings:
+        if string in seen:
+            continue
+        seen.add(string)
+        if len(reservoir) < k:
+            reservoir.append(string)
+        else:
+            idx = random.randrange(len(seen))
+            if idx < k:
+                reservoir[idx] = string
+    return reservoir
+
 def sample_from_product_ext(strings_per_child, num_samples):
     lens_per_child = [len(spc) for spc in strings_per_child]
     prod_size = muh_product(lens_per_child)
@@ -200,11 +237,25 @@ def sample_from_product(strings_per_child, num_samples, lens_per_child, prod_siz
     return ret_strings
 
 
-def get_all_replacement_strings(tree: ParseNode, nt_to_replace: str):
+def ancestor_paths(paths: List[Tuple[int]]):
+    """
+    Returns the paths to the nodes on the way from the root to the nodes at `paths`
+    (included), i.e. the paths to the subtrees which contain one of these nodes.
+    >>> sorted(ancestor_paths([(0, 1), (2,)]))
+    [(), (0,), (0, 1), (2,)]
+    """
+    return {path[:i] for path in paths for i in range(len(path) + 1)}
+
+
+def get_all_replacement_strings(tree: ParseNode, nt_to_replace: str, ancestors: Set[Tuple[int]] = None, path=()):
     """
     Get all the possible strings derived from `tree` where all possible combinations
     (including the combination of len 0) of instances of `nt_to_replace` are replaced
     by REPLACE_CONST.
+
+    If `ancestors` (the ancestor_paths of the occurrences of `nt_to_replace` in
+    `tree`) is given, only the subtrees on these paths are explored, instead of
+    looking for `nt_to_replace` in every subtree. `path` is the path to `tree`.
     >>> left_l3 = [ParseNode('t2', False, [ParseNode('"4"', True, [])]), ParseNode('t2', False, [ParseNode('"4"', True, [])])]
     >>> right_l3 = [ParseNode('t2', False, [ParseNode('"4"', True, [])])]
     >>> left_l2 = [ParseNode('t2', False, left_l3)]
@@ -226,35 +277,39 @@ def get_all_replacement_strings(tree: ParseNode, nt_to_replace: str):
     >>> sorted(get_all_replacement_strings(big_tree,  't2'))
     ['44*4', '44*[[:REPLACEME]]', '4[[:REPLACEME]]*4', '4[[:REPLACEME]]*[[:REPLACEME]]', '[[:REPLACEME]]*4', '[[:REPLACEME]]*[[:REPLACEME]]', '[[:REPLACEME]]4*4', '[[:REPLACEME]]4*[[:REPLACEME]]', '[[:REPLACEME]][[:REPLACEME]]*4', '[[:REPLACEME]][[:REPLACEME]]*[[:REPLACEME]]']
     """
-    replacement_strings = []
-    if tree.is_terminal:
-        return [fixup_terminal(tree.payload)]
-
-    if not nt_in_tree(tree, nt_to_replace):
-        return [tree.derived_string()]
-
-    if tree.payload == nt_to_replace:
-        replacement_strings.append(REPLACE_CONST)
-
-
-
-    strings_per_child = [get_all_replacement_strings(c, nt_to_replace) for c in tree.children]
-    lens_per_child = [len(spc) for spc in strings_per_child]
-    prod_size = muh_product(lens_per_child)
-    if prod_size > MAX_SAMPLES:
-        replacement_strings.extend(sample_from_product(strings_per_child, MAX_SAMPLES, lens_per_child, prod_size))
-    else:
-        replacement_strings.extend([''.join(p) for p in itertools.product(*strings_per_child)])
+    def leaf_value(node: ParseNode, node_path):
+        if node.is_terminal:
+            return [fixup_terminal(node.payload)]
+        if (node_path not in ancestors) if ancestors is not None else not nt_in_tree(node, nt_to_replace):
+            return [node.derived_string()]
+        return None
+
+    def combine(node: ParseNode, strings_per_child):
+        replacement_strings = []
+        if node.payload == nt_to_replace:
+            replacement_strings.append(REPLACE_CONST)
+        lens_per_child = [len(spc) for spc in strings_per_child]
+        prod_size = muh_product(lens_per_child)
+        if prod_size > MAX_SAMPLES:
+            replacement_strings.extend(sample_from_product(strings_per_child, MAX_SAMPLES, lens_per_child, prod_size))
+        else:
+            replacement_strings.extend([''.join(p) for p in itertools.product(*strings_per_child)])
+        return list(set(replacement_strings))
 
-    return list(set(replacement_strings))
+    # Iterative, so that deep trees do not hit the recursion limit
+    return fold_tree(tree, leaf_value, combine, path)
 
 
 
-def get_all_rule_replacement_strs(tree: ParseNode, replacee_rule: Tuple[str, List[str]], replacee_posn: int):
+def get_all_rule_replacement_strs(tree: ParseNode, replacee_rule: Tuple[str, List[str]], replacee_posn: int,
+                                  ancestors: Set[Tuple[int]] = None, path=()):
     """
     Get all the possible strings derived from `tree` where all possible combinations
     (including the combination of len 0) of instances of the nonterminal at position
     `replacee_posn` in `replacee_rule` are replaced by REPLACE_CONST.
+
+    If `ancestors` (the ancestor_paths of the expansions of `replacee_rule` in `tree`)
+    is given, only the subtrees on these paths are explored. `path` is the path to `tree`.
     >>> left_l3 = [ParseNode('t2', False, [ParseNode('"4"', True, [])]), ParseNode('t2', False, [ParseNode('"4"', True, [])])]
     >>> right_l3 = [ParseNode('t2', False, [ParseNode('"4"', True, [])])]
     >>> left_l2 = [ParseNode('t2', False, left_l3)]
@@ -280,31 +335,149 @@ def get_all_rule_replacement_strs(tree: ParseNode, replacee_rule: Tuple[str, Lis
     """
     start = replacee_rule[0]
     body = [fixup_terminal(elem) for elem in replacee_rule[1]]
-    if tree.is_terminal:
-        return [fixup_terminal(tree.payload)]
-    if not nt_in_tree(tree, start):
-        return [tree.derived_string()]
-    strings_per_child = [get_all_rule_replacement_strs(c, replacee_rule, replacee_posn) for c in tree.children]
-    if tree.payload == start:
-        tree_body = [fixup_terminal(c.payload) for c in tree.children]
-        if tree_body == body:
-            strings_per_child[replacee_posn].append(REPLACE_CONST)
 
-    lens_per_child = [len(spc) for spc in strings_per_child]
-    prod_size = muh_product(lens_per_child)
-    if prod_size > MAX_SAMPLES:
-        ret_list = sample_from_product(strings_per_child, MAX_SAMPLES, lens_per_child, prod_size)
+    def leaf_value(node: ParseNode, node_path):
+        if node.is_terminal:
+            return [fixup_terminal(node.payload)]
+        if (node_path not in ancestors) if ancestors is not None else not nt_in_tree(node, start):
+            return [node.derived_string()]
+        return None
+
+    def combine(node: ParseNode, strings_per_child):
+        if node.payload == start:
+            tree_body = [fixup_terminal(c.payload) for c in node.children]
+            if tree_body == body:
+                strings_per_child[replacee_posn].append(REPLACE_CONST)
+
+        lens_per_child = [len(spc) for spc in strings_per_child]
+        prod_size = muh_product(lens_per_child)
+        if prod_size > MAX_SAMPLES:
+            ret_list = sample_from_product(strings_per_child, MAX_SAMPLES, lens_per_child, prod_size)
+        else:
+            ret_list = [''.join(p) for p in itertools.product(*strings_per_child)]
+        return list(set(ret_list))
+
+    # Iterative, so that deep trees do not hit the recursion limit
+    return fold_tree(tree, leaf_value, combine, path)
+
+def placeholder_spans(tree: ParseNode, is_placeholder, explore, path=()):
+    """
+    Returns the string derived from `tree`, and the spans of the placeholder nodes of
+    `tree` in it, in preorder: (start, end, index of the closest enclosing span or -1).
+    is_placeholder(node, parent, child_idx) tells if a node is a placeholder, and
+    explore(node, node_path) if a nonterminal node can contain one. `path` is the path
+    to `tree`. Nothing is sampled: all the ways of replacing placeholders follow from
+    the spans (see fill_templates).
+    >>> tree = ParseNode('t0', False, [ParseNode('t2', False, [ParseNode('t2', False, [ParseNode('"4"', True, [])])]),
+    ...                                ParseNode('"*"', True, []), ParseNode('t2', False, [ParseNode('"5"', True, [])])])
+    >>> placeholder_spans(tree, lambda node, parent, idx: node.payload == 't2', lambda node, path: True)
+    ('4*5', [(0, 1, -1), (0, 1, 0), (2, 3, -1)])
+    """
+    strings, spans = [], []
+    pos = 0
+    # Nodes to visit as (node, path, parent, child index, enclosing span), and the
+    # indices of the spans to close once their subtrees are visited
+    stack = [(tree, path, None, None, -1)]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, int):
+            spans[item] = (spans[item][0], pos, spans[item][2])
+            continue
+        node, node_path, parent, child_idx, enclosing = item
+        if is_placeholder(node, parent, child_idx):
+            spans.append((pos, None, enclosing))
+            enclosing = len(spans) - 1
+            stack.append(enclosing)
+        if node.is_terminal or not explore(node, node_path):
+            string = node.derived_string()
+            strings.append(string)
+            pos += len(string)
+            continue
+        for idx in reversed(range(len(node.children))):
+            stack.append((node.children[idx], node_path + (idx,), node, idx, enclosing))
+    return ''.join(strings), spans
+
+
+def fill_templates(placeholders: Tuple[str, List[Tuple[int, int, int]]], replacement_strs: Set[str]):
+    """
+    Returns the strings obtained by replacing, in the string of `placeholders` (see
+    placeholder_spans), a non-empty set of placeholders not inside one another with
+    a replacement string (the same one for all of them), for each replacement string.
+    If there are more than MAX_SAMPLES of them, MAX_SAMPLES (template, replacement)
+    pairs are sampled uniformly at random, anew at each call.
+    >>> fill_templates(('4*5', [(0, 1, -1), (0, 1, 0), (2, 3, -1)]), ['2'])
+    ['2*5', '4*2', '2*2']
+    """
+    string, spans = placeholders
+    nested = [[] for _ in spans]
+    top_level = []
+    for idx, (_, _, enclosing) in enumerate(spans):
+        (top_level if enclosing < 0 else nested[enclosing]).append(idx)
+    # Number of ways to choose placeholders within each span, including none
+    # (the nested spans come after their enclosing span)
+    choices = [0] * len(spans)
+    for idx in reversed(range(len(spans))):
+        choices[idx] = muh_product([choices[child] for child in nested[idx]]) + 1
+
+    def template(rank):
+        # Mixed radix over the spans of a level: the last digit of a span replaces it
+        # whole, the others choose within its nested spans. Rank 0 replaces nothing.
+        chosen = []
+        to_visit = [(top_level, rank)]
+        while to_visit:
+            idxs, rank = to_visit.pop()
+            for idx in idxs:
+                rank, digit = divmod(rank, choices[idx])
+                if digit == choices[idx] - 1:
+                    chosen.append(idx)
+                elif nested[idx]:
+                    to_visit.append((nested[idx], digit))
+        chosen.sort()
+        segments, prev = [], 0
+        for idx in chosen:
+            segments.append(string[prev:spans[idx][0]])
+            prev = spans[idx][1]
+        segments.append(string[prev:])
+        return segments
+
+    replacement_strs = list(replacement_strs)
+    num_templates = muh_product([choices[idx] for idx in top_level]) - 1
+    num_strings = num_templates * len(replacement_strs)
+    if num_strings <= MAX_SAMPLES:
+        pairs = [(rank, replacement_str) for replacement_str in replacement_strs
+                 for rank in range(1, num_templates + 1)]
     else:
-        ret_list = [''.join(p) for p in itertools.product(*strings_per_child)]
+        pairs = [(idx // len(replacement_strs) + 1, replacement_strs[idx % len(replacement_strs)])
+                 for idx in sample_indices(num_strings, MAX_SAMPLES)]
+    # Different choices of placeholders can give the same string
+    return list(dict.fromkeys(replacement_str.join(template(rank)) for rank, replacement_str in pairs))
+
+
+def sample_indices(n, k):
+    """
+    Returns k distinct integers sampled uniformly from range(n), which may not fit
+    in a machine integer.
+    >>> len(set(sample_indices(2 ** 100, 5)))
+    5
+    """
+    if n <= sys.maxsize:
+        return random.sample(range(n), k)
+    indices = set()
+    while len(indices) < k:
+        indices.add(random.randrange(n))
+    return list(indices)
 
-    return list(set(ret_list))
 
-def get_strings_with_replacement(tree: ParseNode, nt_to_replace: str, replacement_strs: Set[str]):
+def get_strings_with_replacement(tree: ParseNode, nt_to_replace: str, replacement_strs: Set[str],
+                                 paths: List[Tuple[int]] = None, template_cache: Dict = None):
     """
     Get all the possible strings derived from `tree` where all possible combinations
     (not including the empty combo) of instances of `nt_to_replace` are replaced
     with one of the replacement strings in `replacement_strs`. Does not combine different
     strings from `replacement_strs` in the same instance.
+    `paths`, if given, are the paths to the instances of `nt_to_replace` in `tree`
+    (see ParseTreeList.trees_with_occurrences). The placeholder spans of `tree` are
+    kept in `template_cache`, if given (see ParseTreeList.template_cache).
     >>> global MAX_SAMPLES; MAX_SAMPLES = 100
     >>> left_l3 = [ParseNode('t2', False, [ParseNode('"4"', True, [])]), ParseNode('t2', False, [ParseNode('"4"', True, [])])]
     >>> right_l3 = [ParseNode('t2', False, [ParseNode('"4"', True, [])])]
@@ -320,27 +493,34 @@ def get_strings_with_replacement(tree: ParseNode, nt_to_replace: str, replacemen
     """
     global TIME_GENERATING_EXAMPLES_INTERNAL
     s = time.time()
-    placeholder_strings = get_all_replacement_strings(tree, nt_to_replace)
-    placeholder_strings = [s for s in placeholder_strings if REPLACE_CONST in s]
-
-    ret_strings = []
-    for replacement_str in replacement_strs:
-        ret_strings.extend([ps.replace(REPLACE_CONST, replacement_str) for ps in placeholder_strings])
-
-    if len(ret_strings) > MAX_SAMPLES:
-        random.shuffle(ret_strings)
-        ret_strings = ret_strings[:MAX_SAMPLES]
+    key = (id(tree), nt_to_replace)
+    if template_cache is None or key not in template_cache:
+        ancestors = None if paths is None else ancestor_paths(paths)
+        def is_placeholder(node, parent, child_idx):
+            return not node.is_terminal and node.payload == nt_to_replace
+        def explore(node, node_path):
+            return (node_path in ancestors) if ancestors is not None else nt_in_tree(node, nt_to_replace)
+        placeholders = placeholder_spans(tree, is_placeholder, explore)
+        if template_cache is not None:
+            template_cache[key] = placeholders
+    else:
+        placeholders = template_cache[key]
+    ret_strings = fill_templates(placeholders, replacement_strs)
     TIME_GENERATING_EXAMPLES_INTERNAL += time.time() - s
     return ret_strings
 
 
-def get_strings_with_replacement_in_rule(tree: ParseNode, replacee_rule: Tuple[str, List[str]], replacee_posn: int, replacement_strs: Set[str]):
+def get_strings_with_replacement_in_rule(tree: ParseNode, replacee_rule: Tuple[str, List[str]], replacee_posn: int, replacement_strs: Set[str],
+                                         paths: List[Tuple[int]] = None, template_cache: Dict = None):
     """
     Get all the possible strings derived from `tree` where all possible combinations
     (not including the empty combo) of instances of the nonterminal at position
     `replacee_posn` in `replacee_rule` are replaced with one of the replacement strings
     in `replacement_strs`. Does not combine differentstrings from `replacement_strs`
     in the same instance.
+    `paths`, if given, are the paths to the expansions of `replacee_rule` in `tree`
+    (see ParseTreeList.trees_with_expansion). The placeholder spans of `tree` are
+    kept in `template_cache`, if given.
     >>> left_l3 = [ParseNode('t2', False, [ParseNode('"4"', True, [])]), ParseNode('t2', False, [ParseNode('"4"', True, [])])]
     >>> right_l3 = [ParseNode('t2', False, [ParseNode('"4"', True, [])])]
     >>> left_l2 = [ParseNode('t2', False, left_l3)]
@@ -355,16 +535,22 @@ def get_strings_with_replacement_in_rule(tree: ParseNode, replacee_rule: Tuple[s
     """
     global TIME_GENERATING_EXAMPLES_INTERNAL
     s = time.time()
-    placeholder_strings = get_all_rule_replacement_strs(tree, replacee_rule, replacee_posn)
-    placeholder_strings = [s for s in placeholder_strings if REPLACE_CONST in s]
-
-    ret_strings = []
-    for replacement_str in replacement_strs:
-        ret_strings.extend([ps.replace(REPLACE_CONST, replacement_str) for ps in placeholder_strings])
-
-    if len(ret_strings) > MAX_SAMPLES:
-        random.shuffle(ret_strings)
-        ret_strings = ret_strings[:MAX_SAMPLES]
+    key = (id(tree), replacee_rule[0], tuple(replacee_rule[1]), replacee_posn)
+    if template_cache is None or key not in template_cache:
+        ancestors = None if paths is None else ancestor_paths(paths)
+        start = replacee_rule[0]
+        body = [fixup_terminal(elem) for elem in replacee_rule[1]]
+        def is_placeholder(node, parent, child_idx):
+            return (child_idx == replacee_posn and parent.payload == start
+                    and [fixup_terminal(c.payload) for c in parent.children] == body)
+        def explore(node, node_path):
+            return (node_path in ancestors) if ancestors is not None else nt_in_tree(node, start)
+        placeholders = placeholder_spans(tree, is_placeholder, explore)
+        if template_cache is not None:
+            template_cache[key] = placeholders
+    else:
+        placeholders = template_cache[key]
+    ret_strings = fill_templates(placeholders, replacement_strs)
     TIME_GENERATING_EXAMPLES_INTERNAL += time.time() - s
     return ret_strings
 
@@ -0,0 +1,389 @@
+import random
+from bisect import bisect_right
+from typing import Dict, List
+
+"""
+Table-driven sampling of random strings from a grammar.
+
+The grammar is compiled once to integer tables: nonterminals are numbered from 0,
+terminals are stored as ~index into a list of terminal strings, and each body is
+a tuple of these ids. For every nonterminal (and body) we precompute the minimum
+derivation depth and the minimum length of the strings it derives, like
+sample_lark.GrammarStats does. Expansion then uses an explicit stack, so deep or
+very recursive grammars never hit python's recursion limit, and the minimum
+lengths let us enforce a length budget while the string is generated, instead of
+throwing overlong samples away once they are built.
+"""
+
+INFINITY = 1_000_000
+
+
+class GrammarSampler():
+    """
+    Samples strings from the grammar whose `rules` (rule start -> Rule) are given.
+    Nonterminals in `regexes` (nonterminal -> Regex, see Grammar.regexes) are
+    sampled from their regex whenever the result fits in the length budget.
+    >>> from grammar import Rule
+    >>> rules = {'start': Rule('start').add_body(['t0']),
+    ...          't0': Rule('t0').add_body(['"("', 't0', '")"']).add_body(['"x"'])}
+    >>> sampler = GrammarSampler(rules)
+    >>> sampler.min_lengths[sampler.nt_ids['t0']], sampler.min_depths[sampler.nt_ids['start']]
+    (1, 1)
+    >>> sampler.sample(max_depth=0)
+    'x'
+    >>> random.seed(0)
+    >>> all(len(sampler.sample(10, max_length=7)) <= 7 for _ in range(100))
+    True
+    >>> sampler.sample(10, max_length=0) is None
+    True
+    """
+    def __init__(self, rules, regexes=None):
+        self.nonterminals : List[str] = list(rules)
+        self.nt_ids : Dict[str, int] = {nt: i for i, nt in enumerate(self.nonterminals)}
+        self.terminals : List[str] = []
+        self.regexes = [None] * len(self.nonterminals)
+        for nt, regex in (regexes or {}).items():
+            self.regexes[self.nt_ids[nt]] = regex
+
+        terminal_ids = {}
+        self.bodies = []
+        for nt in self.nonterminals:
+            nt_bodies = []
+            for body in rules[nt].bodies:
+                ids = []
+                for elem in body:
+                    if elem in self.nt_ids:
+                        ids.append(self.nt_ids[elem])
+                    elif len(elem) > 2:
+                        terminal = elem[1:-1]
+                        if terminal not in terminal_ids:
+                            terminal_ids[terminal] = len(self.terminals)
+                            self.terminals.append(terminal)
+                        ids.append(~terminal_ids[terminal])
+                nt_bodies.append(tuple(ids))
+            self.bodies.append(nt_bodies)
+
+        self.calculate_min_depths_and_lengths()
+        self.build_choice_tables()
+
+    def body_depth(self, body):
+        nt_depths = [self.min_depths[elem] for elem in body if elem >= 0]
+        if not nt_depths:
+            return 0
+        return min(INFINITY, max(nt_depths) + 1)
+
+    def body_length(self, body):
+        length = sum(self.min_lengths[elem] if elem >= 0 else len(self.terminals[~elem]) for elem in body)
+        return min(INFINITY, length)
+
+    def calculate_min_depths_and_lengths(self):
+        """
+        Computes, for every nonterminal, the minimum depth of a derivation tree and
+        the minimum length of a string it derives, by iterating to a fixpoint.
+        Nonterminals which derive no string at all keep an INFINITY depth.
+        """
+        self.min_depths = [INFINITY] * len(self.nonterminals)
+        self.min_lengths = [INFINITY] * len(self.nonterminals)
+        updated = True
+        while updated:
+            updated = False
+            for nt, bodies in enumerate(self.bodies):
+                depth = min([self.body_depth(body) for body in bodies], default=INFINITY)
+                length = min([self.body_length(body) for body in bodies], default=INFINITY)
+                if depth < self.min_depths[nt] or length < self.min_lengths[nt]:
+                    self.min_depths[nt] = min(depth, self.min_depths[nt])
+                    self.min_lengths[nt] = min(length, self.min_lengths[nt])
+                    updated = True
+
+    def build_choice_tables(self):
+        """
+        For every nonterminal, stores the bodies that can be chosen when expanding it,
+        sorted by minimum length (with those lengths alongside), so the bodies fitting
+        in a length budget are a prefix found by bisection:
+          - `choices`: all the bodies that derive some string;
+          - `shallow_choices`: the bodies of minimum depth, used past the max depth
+            so that the expansion terminates.
+        """
+        self.choices, self.choice_lengths = [], []
+        self.shallow_choices, self.shallow_choice_lengths = [], []
+        for nt, bodies in enumerate(self.bodies):
+            productive = [(self.body_length(body), body) for body in bodies
+                          if self.body_depth(body) < INFINITY]
+            productive.sort(key=lambda length_body: length_body[0])
+            shallow = [(length, body) for length, body in productive
+                       if self.body_depth(body) == self.min_depths[nt]]
+            self.choices.append([body for _, body in productive])
+            self.choice_lengths.append([length for length, _ in productive])
+            self.shallow_choices.append([body for _, body in shallow])
+            self.shallow_choice_lengths.append([length for length, _ in shallow])
+
+    def sample(self, max_depth, max_length=None, start='start'):
+        """
+        Samples a random string derived from `start`. Bodies are chosen uniformly among
+        those that keep the string within `max_length` characters; past `max_depth`,
+        only the bodies of minimum depth are chosen. Returns None if `start` derives no
+        string within the budget.
+        """
+        if max_length is None:
+            max_length = INFINITY
+        start_id = self.nt_ids[start]
+        if self.min_depths[start_id] == INFINITY or self.min_lengths[start_id] > max_length:
+            return None
+
+        output = []
+        length = 0
+        # Sum of the minimum lengths of the symbols on the stack
+        pending = self.min_lengths[start_id]
+        stack = [(start_id, 0)]
+        while stack:
+            elem, depth = stack.pop()
+            if elem < 0:
+                terminal = self.terminals[~elem]
+                output.append(terminal)
+                length += len(terminal)
+                pending -= len(terminal)
+                continue
+
+            pending -= self.min_lengths[elem]
+            slack = max_length - length - pending
+            regex = self.regexes[elem]
+            if regex is not None:
+                sample = regex.sample()
+                if len(sample) <= slack:
+                    output.append(sample)
+                    length += len(sample)
+                    continue
+
+            if depth >= max_depth:
+                bodies, lengths = self.shallow_choices[elem], self.shallow_choice_lengths[elem]
+            else:
+                bodies, lengths = self.choices[elem], self.choice_lengths[elem]
+            num_fitting = bisect_right(lengths, slack)
+            # If no body fits, any body is taken: the string goes over the budget and is
+            # rejected below, and the shallow bodies past the max depth keep it finite
+            choice = random.randrange(num_fitting if num_fitting > 0 else len(bodies))
+            body = bodies[choice]
+            pending += lengths[choice]
+            stack.extend((body_elem, depth + 1) for body_elem in reversed(body))
+
+        if length > max_length:
+            return None
+        return ''.join(output)
+
+
+class DerivationCounter():
+    """
+    Counts the derivations of each length from the nonterminals of a compiled
+    GrammarSampler, with a dynamic program over (nonterminal, length) using python's
+    big integers. This gives exact uniform sampling among the strings of a given
+    length, the enumeration of all the strings up to some length, and the number of
+    strings of each length (e.g. to size a precision set in advance).
+
+    Derivations are counted in the epsilon- and unit-free form of the grammar: all
+    the ways of deriving the empty string from a nonterminal count as one, and a chain
+    of unit expansions A => ... => B counts once per pair (A, B). So the counts are
+    always finite, and for an unambiguous grammar they are exactly the number of
+    strings. Sampling is uniform among derivations, and enumeration skips duplicates.
+    >>> from grammar import Rule
+    >>> rules = {'start': Rule('start').add_body(['t0']),
+    ...          't0': Rule('t0').add_body(['t1', '"+"', 't0']).add_body(['t1']),
+    ...          't1': Rule('t1').add_body(['"1"']).add_body(['"("', 't0', '")"']).add_body([''])}
+    >>> counter = DerivationCounter(GrammarSampler(rules))
+    >>> [counter.count(n) for n in range(6)]
+    [1, 2, 4, 9, 21, 51]
+    >>> list(counter.enumerate(2))
+    ['', '+', '1', '1+', '++', '+1', '()']
+    >>> random.seed(0)
+    >>> all(len(counter.sample(12)) == 12 for _ in range(10))
+    True
+    """
+    def __init__(self, sampler: GrammarSampler):
+        self.sampler = sampler
+        self.bodies = sampler.bodies
+        self.terminals = sampler.terminals
+        num_nts = len(self.bodies)
+        self.nullable = [sampler.min_lengths[nt] == 0 for nt in range(num_nts)]
+        self.calculate_unit_closures()
+
+        # counts[nt][n]: the number of derivations of length n from nt.
+        self.counts = [[1 if self.nullable[nt] else 0] for nt in range(num_nts)]
+        # suffix_counts[nt][b][i][n]: the number of derivations of length n from the
+        # elements i.. of the b-th body of nt. nonunit_counts is the same, but without
+        # the derivations where a single nonterminal derives the whole string, which
+        # are the unit expansions.
+        self.suffix_counts = []
+        self.nonunit_counts = []
+        for bodies in self.bodies:
+            self.suffix_counts.append([[[1 if all(elem >= 0 and self.nullable[elem] for elem in body[i:]) else 0]
+                                        for i in range(len(body) + 1)] for body in bodies])
+            self.nonunit_counts.append([[[0] for _ in range(len(body) + 1)] for body in bodies])
+        self.max_length = 0
+
+    def calculate_unit_closures(self):
+        """
+        Computes, for every nonterminal A, the nonterminals B (including A) such that
+        A derives B alone by expanding some of its nonterminals to epsilon.
+        """
+        units = [set() for _ in self.bodies]
+        for nt, bodies in enumerate(self.bodies):
+            for body in bodies:
+                if any(elem < 0 for elem in body):
+                    continue
+                for i, elem in enumerate(body):
+                    if all(self.nullable[other] for other in body[:i] + body[i+1:]):
+                        units[nt].add(elem)
+        self.unit_closures = []
+        for nt in range(len(self.bodies)):
+            closure, to_visit = [], [nt]
+            while to_visit:
+                cur = to_visit.pop()
+                if cur in closure:
+                    continue
+                closure.append(cur)
+                to_visit.extend(units[cur])
+            self.unit_closures.append(closure)
+
+    def elem_count(self, elem, n):
+        if elem < 0:
+            return 1 if len(self.terminals[~elem]) == n else 0
+        return self.counts[elem][n]
+
+    def extend(self, length):
+        """
+        Extends the counts up to derivations of `length` characters.
+        """
+        for n in range(self.max_length + 1, length + 1):
+            # Derivations of length n which are not unit expansions only use
+            # counts of smaller lengths.
+            for nt, bodies in enumerate(self.bodies):
+                for b, body in enumerate(bodies):
+                    suffix, nonunit = self.suffix_counts[nt][b], self.nonunit_counts[nt][b]
+                    nonunit[len(body)].append(0)
+                    for i in reversed(range(len(body))):
+                        elem = body[i]
+                        if elem < 0:
+                            terminal_length = len(self.terminals[~elem])
+                            count = suffix[i + 1][n - terminal_length] if terminal_length <= n else 0
+                        else:
+                            count = sum(self.counts[elem][j] * suffix[i + 1][n - j] for j in range(1, n))
+                            if self.nullable[elem]:
+                                count += nonunit[i + 1][n]
+                        nonunit[i].append(count)
+            for nt in range(len(self.bodies)):
+                self.counts[nt].append(sum(nonunit[0][n] for other in self.unit_closures[nt]
+                                           for nonunit in self.nonunit_counts[other]))
+            for nt, bodies in enumerate(self.bodies):
+                for b, body in enumerate(bodies):
+                    suffix = self.suffix_counts[nt][b]
+                    suffix[len(body)].append(0)
+                    for i in reversed(range(len(body))):
+                        elem = body[i]
+                        suffix[i].append(sum(self.elem_count(elem, j) * suffix[i + 1][n - j] for j in range(n + 1)))
+            self.max_length = n
+
+    def count(self, length, start='start'):
+        """
+        Returns the number of derivations of strings of exactly `length` characters.
+        """
+        self.extend(length)
+        return self.counts[self.sampler.nt_ids[start]][length]
+
+    def expansions(self, nt, n):
+        """
+        Returns the (weight, nonterminal, body index) of the non-unit expansions
+        deriving strings of length n > 0 from `nt`.
+        """
+        return [(nonunit[0][n], other, b) for other in self.unit_closures[nt]
+                for b, nonunit in enumerate(self.nonunit_counts[other]) if nonunit[0][n] > 0]
+
+    def splits(self, nt, b, i, n, unit_free):
+        """
+        Returns the (weight, length, unit_free) of the possible lengths of the i-th
+        element of the b-th body of nt, given the elements i.. derive n characters.
+        `unit_free` is whether the rest of the body must not be a unit expansion.
+        """
+        elem = self.bodies[nt][b][i]
+        suffix, nonunit = self.suffix_counts[nt][b], self.nonunit_counts[nt][b]
+        if elem < 0:
+            length = len(self.terminals[~elem])
+            return [(suffix[i + 1][n - length], length, False)] if length <= n else []
+        if not unit_free:
+            splits = [(self.counts[elem][j] * suffix[i + 1][n - j], j, False) for j in range(n + 1)]
+        else:
+            splits = [(self.counts[elem][j] * suffix[i + 1][n - j], j, False) for j in range(1, n)]
+            if self.nullable[elem]:
+                splits.append((nonunit[i + 1][n], 0, True))
+        return [split for split in splits if split[0] > 0]
+
+    def sample(self, length, start='start'):
+        """
+        Samples a derivation of exactly `length` characters uniformly at random, and
+        returns its string, or None if there is none.
+        """
+        if self.count(length, start) == 0:
+            return None
+        output = []
+        stack = [(self.sampler.nt_ids[start], length)]
+        while stack:
+            elem, n = stack.pop()
+            if elem < 0:
+                output.append(self.terminals[~elem])
+                continue
+            if n == 0:
+                continue
+            _, nt, b = weighted_choice(self.expansions(elem, n))
+            children, unit_free = [], True
+            for i, child in enumerate(self.bodies[nt][b]):
+                _, child_length, unit_free = weighted_choice(self.splits(nt, b, i, n, unit_free))
+                children.append((child, child_length))
+                n -= child_length
+            stack.extend(reversed(children))
+        return ''.join(output)
+
+    def enumerate(self, max_length, start='start'):
+        """
+        Yields all the distinct strings of at most `max_length` characters, by
+        increasing length.
+        """
+        self.extend(max_length)
+        start_id = self.sampler.nt_ids[start]
+        for length in range(max_length + 1):
+            seen = set()
+            for string in self.enumerate_nonterminal(start_id, length):
+                if string not in seen:
+                    seen.add(string)
+                    yield string
+
+    def enumerate_nonterminal(self, nt, n):
+        if n == 0:
+            if self.counts[nt][0]:
+                yield ''
+            return
+        for _, other, b in self.expansions(nt, n):
+            yield from self.enumerate_body(other, b, 0, n, True)
+
+    def enumerate_body(self, nt, b, i, n, unit_free):
+        body = self.bodies[nt][b]
+        if i == len(body):
+            yield ''
+            return
+        for _, length, rest_unit_free in self.splits(nt, b, i, n, unit_free):
+            if body[i] < 0:
+                heads = [self.terminals[~body[i]]]
+            else:
+                heads = self.enumerate_nonterminal(body[i], length)
+            for head in heads:
+                for tail in self.enumerate_body(nt, b, i + 1, n - length, rest_unit_free):
+                    yield head + tail
+
+
+def weighted_choice(weighted):
+    """
+    Chooses one of the tuples in `weighted` with probability proportional to its
+    first element (an int, possibly big).
+    """
+    r = random.randrange(sum(item[0] for item in weighted))
+    for item in weighted:
+        if r < item[0]:
+            return item
+        r -= item[0]
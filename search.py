@@ -3,9 +3,16 @@ import random, sys, os, time
 from input import parse_input
 from parse_tree import ParseTree, ParseNode
 from grammar import Grammar, Rule
+import start
 from start import build_start_grammar, get_times
 from lark import Lark
 from oracle import CachingOracle, ExternalOracle
+import parser_cache
+import checkpoint
+import prescreen
+import shard
+import signature
+from warm_start import load_gramdict, warm_start_trees
 import string
 
 """
@@ -19,22 +26,33 @@ USE_PRETOKENIZATION = True
 GROUP_PUNCTUATION = False
 SPLIT_UPPER_AND_LOWER = True
 
+# .gramdict of a grammar learned before, to warm start the search from (see warm_start.py)
+WARM_START = None
+
+# Whether to deduplicate the examples and drop redundant ones before learning (see prescreen.py)
+PRESCREEN = False
+
+def get_category(c):
+    """
+    The category of the character `c` for pretokenization, None if it is a token
+    on its own.
+    """
+    if not SPLIT_UPPER_AND_LOWER and c in string.ascii_letters:
+        return "LETTER"
+    if SPLIT_UPPER_AND_LOWER and c in string.ascii_uppercase:
+        return "UPPER"
+    if SPLIT_UPPER_AND_LOWER and c in string.ascii_lowercase:
+        return "LOWER"
+    if c in string.digits:
+        return "DIGIT"
+    if GROUP_PUNCTUATION and c in string.punctuation:
+        return "PUNCTUATION"
+    if c in string.whitespace:
+        return "WHITESPACE"
+    else:
+        return None
+
 def approx_tokenize(guide_raw:str):
-    def get_category(c):
-        if not SPLIT_UPPER_AND_LOWER and c in string.ascii_letters:
-            return "LETTER"
-        if SPLIT_UPPER_AND_LOWER and c in string.ascii_uppercase:
-            return "UPPER"
-        if SPLIT_UPPER_AND_LOWER and c in string.ascii_lowercase:
-            return "LOWER"
-        if c in string.digits:
-            return "DIGIT"
-        if GROUP_PUNCTUATION and c in string.punctuation:
-            return "PUNCTUATION"
-        if c in string.whitespace:
-            return "WHITESPACE"
-        else:
-            return None
     prev_category = None
     cur_token = ""
     start = True
@@ -82,6 +100,7 @@ def main(oracle_cmd, guide_examples_folder,  log_file_name):
        print("Using approximate pre-tokenization stage")
 
     guide_examples = []
+    guide_filenames = []
     for filename in os.listdir(guide_examples_folder):
         full_filename = os.path.join(guide_examples_folder, filename)
         guide_raw = open(full_filename).read()
@@ -90,21 +109,47 @@ def main(oracle_cmd, guide_examples_folder,  log_file_name):
         else:
             guide = [ParseNode(c, True, []) for c in guide_raw]
         guide_examples.append(guide)
+        guide_filenames.append(filename)
 
+    dropped_filenames = []
+    if PRESCREEN:
+        # Without pretokenization, the examples are only deduplicated
+        kept_idxs, summary = prescreen.prescreen(guide_examples, get_category if USE_PRETOKENIZATION else None)
+        dropped_filenames = sorted(set(guide_filenames) - {guide_filenames[idx] for idx in kept_idxs})
+        guide_examples = [guide_examples[idx] for idx in kept_idxs]
+        print(f'Pre-screening: kept {len(guide_examples)} of {summary["examples"]} examples '
+              f'({summary["duplicates"]} duplicates, {summary["skeletons"]} skeletons, '
+              f'{summary["over_skeleton_cap"]} over the per-skeleton cap, {summary["over_size_cap"]} over the size cap)')
+
+    if not guide_examples:
+        raise ValueError(f'No training examples to learn from in {guide_examples_folder}'
+                         + (' after pre-screening' if PRESCREEN else ''))
     average_guide_len = sum([len(g) for g in guide_examples])/len(guide_examples)
     if average_guide_len > 40:
         bbl_bounds = (6, 20)
     else:
         bbl_bounds = (3, 10)
 
+    fixed_trees = None
+    if WARM_START is not None:
+        print(f'Warm starting from {WARM_START}...'.ljust(50), end='\r')
+        fixed_trees, guide_examples = warm_start_trees(oracle, load_gramdict(WARM_START), guide_examples)
+        print(f'Warm start: {len(guide_examples)} examples not parsed by the grammar, {len(fixed_trees)} fixed trees')
+
     # Create the log file and write positive and negative examples to it
     # Also write the initial starting grammar to the file
     with open(log_file_name, 'w+') as f:
+        if PRESCREEN:
+            print(f'Pre-screening: {dict(summary)}', file=f)
+            print(f'Examples dropped by pre-screening: {dropped_filenames}', file=f)
 
         # Build the starting grammars and test them for compilation
         print('Building the starting grammar...'.ljust(50), end='\r')
         start_time = time.time()
-        start_grammar: Grammar = build_start_grammar(oracle, guide_examples, bbl_bounds)
+        if shard.NUM_SHARDS > 1:
+            start_grammar: Grammar = shard.build_sharded_grammar(oracle, guide_examples, bbl_bounds)
+        else:
+            start_grammar: Grammar = build_start_grammar(oracle, guide_examples, bbl_bounds, fixed_trees)
         build_time = time.time() - start_time
 
         oracle_time_spent = oracle.time_spent
@@ -114,6 +159,8 @@ def main(oracle_cmd, guide_examples_folder,  log_file_name):
         print(f'Pickling grammar...')
         import pickle
         pickle.dump(start_grammar.rules, open(log_file_name + ".gramdict", "wb"))
+        # The search is over, so its checkpoint is of no more use
+        checkpoint.remove_checkpoint()
 
 
         print(f'Time spent in oracle calls: {oracle_time_spent}', file=f)
@@ -123,10 +170,27 @@ def main(oracle_cmd, guide_examples_folder,  log_file_name):
         print(f'Scoring time: {time.time() - build_time - start_time}', file=f)
         print(f'Time breakdown: {get_times()}', file=f)
         print(f'Time breakdown: {get_times()}')
+        if shard.NUM_SHARDS > 1:
+            print(f'Time spent learning the shards: {shard.SHARD_TIME}s', file=f)
         print(f'Parse calls: {oracle_parse_calls}, {oracle_real_calls}')
         print(f'Parse calls: {oracle_parse_calls}, {oracle_real_calls}', file=f)
 
 
+def positive_int_or_none(value: str):
+    """
+    Type of the command-line options taking a positive number, or 'none' for no limit.
+    """
+    if value.lower() == 'none':
+        return None
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"expected a positive integer or 'none', got {value!r}")
+    return number
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     subparser = parser.add_subparsers(dest='mode', help='benchmark mode (probably external unless you match the internal format)')
@@ -143,11 +207,47 @@ if __name__ == '__main__':
     external_parser.add_argument('--group_punctuation', help=f'group sequences of punctuation during pretokenization', action='store_true')
     external_parser.add_argument('--group_upper_lower',
                                  help=f'group uppercase characters with lowerchase characters during pretokenization', action='store_true')
+    external_parser.add_argument('--parser_cache', help=f'directory of the on-disk cache of compiled parsers (default {parser_cache.PARSER_CACHE_DIR})', type=str)
+    external_parser.add_argument('--no-parser-cache', help='do not store compiled parsers on disk', action='store_true', dest='no_parser_cache')
+    external_parser.add_argument('--coalesce_workers', help='number of processes checking merges of nonterminals in parallel (the result does not depend on it)', type=int, default=1)
+    external_parser.add_argument('--batch_bubbles', help='accept all the successful non-overlapping bubbles of a grouping round before regrouping (faster, but may learn a different grammar)', action='store_true')
+    external_parser.add_argument('--rank_pairs', help='check the pairs of nonterminals to coalesce most similar first (faster, but may learn a different grammar)', action='store_true')
+    external_parser.add_argument('--min_pair_similarity', help=f'never check the pairs of nonterminals to coalesce less similar than this, from 0 to 1 (faster, but may miss merges; default {signature.MIN_PAIR_SIMILARITY})', type=float, default=signature.MIN_PAIR_SIMILARITY)
+    external_parser.add_argument('--checkpoint', help='checkpoint the search to this file (removed once the search completes)', type=str, metavar='CHECKPOINT')
+    external_parser.add_argument('--checkpoint_interval', help=f'checkpoint every this many seconds (default {checkpoint.CHECKPOINT_INTERVAL})', type=float, default=checkpoint.CHECKPOINT_INTERVAL)
+    external_parser.add_argument('--checkpoint_bubbles', help="also checkpoint every this many accepted bubbles, 'none' to only checkpoint by time (the default)", type=positive_int_or_none, default=checkpoint.CHECKPOINT_BUBBLES)
+    external_parser.add_argument('--resume', help='resume the search from this checkpoint, written by a run with the same examples and options, and keep checkpointing to it (unless --checkpoint is given). The checkpoint is unpickled: only resume from trusted checkpoints', type=str, metavar='CHECKPOINT')
+    external_parser.add_argument('--prescreen', help='drop duplicate examples, and keep the shortest examples of each token-class skeleton', action='store_true')
+    external_parser.add_argument('--max_per_skeleton', help=f"with --prescreen, examples kept per skeleton, 'none' for all (default {prescreen.MAX_PER_SKELETON})", type=positive_int_or_none, default=prescreen.MAX_PER_SKELETON)
+    external_parser.add_argument('--max_examples', help='with --prescreen, keep at most this many examples, covering the most different skeletons', type=positive_int_or_none)
+    external_parser.add_argument('--warm_start', help='learn from the grammar in this .gramdict (e.g. learned from part of the examples), bubbling only the examples it does not parse', type=str, metavar='GRAMDICT')
+    external_parser.add_argument('--shards', help='learn this many shards of the examples in parallel, then coalesce them together', type=int, default=shard.NUM_SHARDS)
+    external_parser.add_argument('--shard_workers', help='number of processes learning the shards (default: one per shard, up to the number of CPUs)', type=int)
     #TODO: what is this error?
     args = parser.parse_args()
     if args.mode == 'internal':
         main_internal(args.bench_folder, args.log_file, random_guides=False)
     elif args.mode == 'external':
+        if args.no_parser_cache:
+            parser_cache.set_cache_dir(None)
+        elif args.parser_cache is not None:
+            parser_cache.set_cache_dir(args.parser_cache)
+        start.COALESCE_WORKERS = args.coalesce_workers
+        start.BATCH_BUBBLES = args.batch_bubbles
+        signature.RANK_PAIRS = args.rank_pairs
+        signature.MIN_PAIR_SIMILARITY = args.min_pair_similarity
+        checkpoint.CHECKPOINT_FILE = args.checkpoint if args.checkpoint is not None else args.resume
+        checkpoint.CHECKPOINT_INTERVAL = args.checkpoint_interval
+        checkpoint.CHECKPOINT_BUBBLES = args.checkpoint_bubbles
+        checkpoint.RESUME_FROM = args.resume
+        WARM_START = args.warm_start
+        if args.shards > 1 and (args.warm_start is not None or args.resume is not None):
+            parser.error('--shards cannot be combined with --warm_start or --resume')
+        shard.NUM_SHARDS = args.shards
+        shard.SHARD_WORKERS = args.shard_workers
+        PRESCREEN = args.prescreen
+        prescreen.MAX_PER_SKELETON = args.max_per_skeleton
+        prescreen.MAX_EXAMPLES = args.max_examples
         if args.no_pretokenize:
             USE_PRETOKENIZATION = False
         if args.group_punctuation:
@@ -0,0 +1,182 @@
+import multiprocessing
+import time
+from typing import Dict, List
+
+import checkpoint
+import next_tid
+import start
+from next_tid import allocate_tid
+from parallel import ORACLE_COUNTERS, can_fork, run_seeded, seed_for
+from parse_tree import ParseNode, relabel_tree, START
+from verdicts import clear_verdicts
+
+"""
+Divide-and-conquer learning (search.py --shards N), for corpora too large for a
+single run of start.build_trees.
+
+The examples are split into shards of about the same total length, and the trees
+of each shard are bubbled and coalesced in its own forked process, as a whole run of
+build_start_grammar would (but for the token expansion and minimization), with the
+random state seeded by the shard. The processes start from a snapshot of the oracle's
+cache, and the answers they find are added to it. Nonterminal names are allocated per
+process, so the nonterminals of each shard are then renamed apart, and the trees of
+all the shards are coalesced together. The pairs of nonterminals of a same shard were
+already checked in the shard, so only the pairs across shards are checked again.
+The grammar is then expanded and minimized as usual.
+"""
+
+# Number of shards the examples are split into (1 to not shard)
+NUM_SHARDS = 1
+
+# Number of processes learning the shards (None for one per shard, up to the number of CPUs)
+SHARD_WORKERS = None
+
+# Time spent learning the shards, in parallel
+SHARD_TIME = 0
+
+# State of a worker: the oracle it queries, and how much of its cache was sent back
+worker_oracle = None
+worker_reported = 0
+
+
+def split_shards(leaves: List[List[ParseNode]], num_shards: int):
+    """
+    Splits the examples `leaves` into at most `num_shards` non-empty shards of about
+    the same total length (longest examples first, each to the shortest shard), each
+    keeping the order of its examples.
+    >>> examples = [[ParseNode(c, True, []) for c in ex] for ex in ['aaaa', 'b', 'cc', 'ddd']]
+    >>> [[''.join(leaf.payload for leaf in ex) for ex in shard] for shard in split_shards(examples, 2)]
+    [['aaaa', 'b'], ['cc', 'ddd']]
+    """
+    num_shards = max(1, min(num_shards, len(leaves)))
+    sizes = [0] * num_shards
+    assignment = [[] for _ in range(num_shards)]
+    for idx in sorted(range(len(leaves)), key=lambda idx: -len(leaves[idx])):
+        shard_idx = min(range(num_shards), key=lambda i: sizes[i])
+        sizes[shard_idx] += len(leaves[idx])
+        assignment[shard_idx].append(idx)
+    return [[leaves[idx] for idx in sorted(idxs)] for idxs in assignment]
+
+
+def learn_shard(leaves: List[List[ParseNode]]):
+    """
+    Bubbles and coalesces the trees of the shard `leaves`. Returns the trees.
+    """
+    # The nonterminals are renamed apart afterwards, so restarting the counter makes
+    # a shard learned the same in any process
+    next_tid.next_tid = 1
+    clear_verdicts()
+    trees, _ = start.build_trees(worker_oracle, leaves)
+    _, trees = start.coalesce_trees(worker_oracle, trees)
+    return list(trees)
+
+
+def run_shard_in_worker(task):
+    global worker_reported
+    shard_idx, leaves = task
+    # The shards do not fork processes of their own
+    start.COALESCE_WORKERS = 1
+    counters = {name: getattr(worker_oracle, name) for name in ORACLE_COUNTERS if hasattr(worker_oracle, name)}
+    trees = run_seeded(seed_for('shard', shard_idx), learn_shard, leaves)
+    counters = {name: getattr(worker_oracle, name) - value for name, value in counters.items()}
+    # The cache is a dict, so the new answers are the last ones inserted.
+    new_answers = list(worker_oracle.cache_set.items())[worker_reported:]
+    worker_reported = len(worker_oracle.cache_set)
+    return trees, new_answers, counters
+
+
+def rename_apart(shard_trees: List[List[ParseNode]]):
+    """
+    Mutative: renames the nonterminals (but START) of each list of trees in
+    `shard_trees` to fresh ones. Returns the nt_groups (see start.coalesce) mapping
+    each new nonterminal to the index of its list.
+    >>> shards = [[ParseNode('t0', False, [ParseNode('t1', False, [ParseNode('a', True, [])])])],
+    ...           [ParseNode('t0', False, [ParseNode('t1', False, [ParseNode('b', True, [])])])]]
+    >>> nt_groups = rename_apart(shards)
+    >>> [tree.children[0].payload in nt_groups for trees in shards for tree in trees]
+    [True, True]
+    >>> shards[0][0].children[0].payload != shards[1][0].children[0].payload
+    True
+
+    The operands and operators of two shards, named alike in each, are merged across
+    the shards once renamed apart:
+    >>> import random
+    >>> from lark import Lark
+    >>> from oracle import CachingOracle
+    >>> from parse_tree import build_grammar
+    >>> oracle = CachingOracle(Lark('start: e\\ne: t (("+"|"*") t)*\\nt: /[0-9]/ | "(" e ")"'))
+    >>> def leaf(c): return ParseNode(c, True, [])
+    >>> def shard_tree(left, op, right):
+    ...     return ParseNode('t0', False, [ParseNode('t1', False, [leaf(left)]), ParseNode('t2', False, [leaf(op)]),
+    ...                                    ParseNode('t1', False, [leaf(right)])])
+    >>> shards = [[shard_tree('1', '+', '2')], [shard_tree('3', '*', '(4)')]]
+    >>> random.seed(0); next_tid.next_tid = 3; clear_verdicts()
+    >>> nt_groups = rename_apart(shards)
+    >>> nt_groups
+    {'t3': 0, 't4': 0, 't5': 1, 't6': 1}
+    >>> trees = [tree for trees in shards for tree in trees]
+    >>> [[child.payload for child in tree.children] for tree in trees]
+    [['t3', 't4', 't3'], ['t5', 't6', 't5']]
+    >>> grammar, new_trees, _ = start.coalesce(oracle, trees, build_grammar(trees), nt_groups=nt_groups)
+    >>> operator = new_trees[0].children[1].payload
+    >>> [[child.payload for child in tree.children] == ['t0', operator, 't0'] for tree in new_trees]
+    [True, True]
+    >>> operator not in nt_groups, sorted(grammar.rules[operator].bodies)
+    (True, [['"*"'], ['"+"']])
+    """
+    nt_groups: Dict[str, int] = {}
+    for shard_idx, trees in enumerate(shard_trees):
+        shard_nts = set().union(*[tree.all_nts() for tree in trees]) - {START}
+        get_class = {nt: allocate_tid() for nt in sorted(shard_nts, key=lambda nt: (len(nt), nt))}
+        for tree in trees:
+            relabel_tree(tree, get_class)
+            tree.update_cache_info()
+        nt_groups.update({nt: shard_idx for nt in get_class.values()})
+    return nt_groups
+
+
+def build_sharded_grammar(oracle, leaves: List[List[ParseNode]], bbl_bounds=(3, 10), num_shards=None):
+    """
+    Like start.build_start_grammar, but learns the shards of `leaves` in parallel
+    before coalescing their trees together.
+    """
+    global SHARD_TIME, worker_oracle, worker_reported
+    num_shards = NUM_SHARDS if num_shards is None else num_shards
+    start.MIN_GROUP_LEN, start.MAX_GROUP_LEN = bbl_bounds
+    shards = split_shards(leaves, num_shards)
+    num_workers = SHARD_WORKERS or min(len(shards), multiprocessing.cpu_count())
+    print(f'Learning {len(shards)} shards with {num_workers} processes...'.ljust(50))
+
+    # The shards are not checkpointed (see checkpoint.py)
+    checkpoint.CHECKPOINT_FILE, checkpoint.RESUME_FROM = None, None
+    s = time.time()
+    first_tid = next_tid.next_tid
+    tasks = list(enumerate(shards))
+    if num_workers > 1 and len(shards) > 1 and can_fork():
+        # The workers see the oracle (and its cache) as it is now
+        worker_oracle, worker_reported = oracle, len(oracle.cache_set)
+        pool = multiprocessing.get_context('fork').Pool(num_workers)
+        try:
+            results = pool.map(run_shard_in_worker, tasks, chunksize=1)
+        finally:
+            pool.terminate()
+        shard_trees = []
+        for trees, new_answers, counters in results:
+            shard_trees.append(trees)
+            for string, answer in new_answers:
+                oracle.cache_set.setdefault(string, answer)
+            for name, value in counters.items():
+                setattr(oracle, name, getattr(oracle, name) + value)
+    else:
+        worker_oracle = oracle
+        shard_trees = [run_seeded(seed_for('shard', shard_idx), learn_shard, shard) for shard_idx, shard in tasks]
+    SHARD_TIME += time.time() - s
+
+    print('Coalescing the shards...'.ljust(50))
+    # The same names whether the shards were learned in this process or not
+    next_tid.next_tid = first_tid
+    nt_groups = rename_apart(shard_trees)
+    trees = [tree for trees in shard_trees for tree in trees]
+    clear_verdicts()
+    grammar, trees = start.coalesce_trees(oracle, trees, nt_groups)
+    return start.finish_grammar(oracle, grammar, trees)
@@ -0,0 +1,171 @@
+from typing import Dict, Iterable, List, Tuple
+
+from parse_tree import ParseNode, fixup_terminal
+
+"""
+Cheap signatures of the nonterminals occurring in a list of parse trees, used to
+prioritize and prune the pairs of nonterminals that coalesce checks with the
+oracle. Two nonterminals that can replace each other everywhere tend to derive
+similar strings (same kinds of characters, similar lengths) and to occur in
+similar places (same neighbouring tokens, same k-contexts), so we check the most
+similar pairs first, and skip the pairs whose similarity is below
+MIN_PAIR_SIMILARITY without asking the oracle at all.
+"""
+
+# Whether to check the pairs of nonterminals of coalesce and coalesce_partial most
+# similar first, rather than in the original order (search.py --rank_pairs).
+# Ranking may merge other nonterminals, so learn a different grammar.
+RANK_PAIRS = False
+
+# Pairs of nonterminals less similar than this are never checked (search.py
+# --min_pair_similarity). This trades recall for speed: 0 keeps every pair,
+# higher values skip more pairs.
+MIN_PAIR_SIMILARITY = 0.0
+
+# Number of tokens on each side of an occurrence in its k-context
+CONTEXT_K = 2
+
+# Marks the beginning/end of an example in contexts
+BOUNDARY = None
+
+
+def char_class(c: str):
+    if c.isdigit():
+        return 'digit'
+    if c.isalpha():
+        return 'upper' if c.isupper() else 'lower'
+    if c.isspace():
+        return 'space'
+    return 'other'
+
+
+class Signature():
+    """
+    The signature of a nonterminal, summarizing its occurrences in the trees.
+    """
+    def __init__(self):
+        self.char_classes = set()
+        self.min_length = None
+        self.max_length = None
+        self.contexts = set()
+        self.left_tokens = set()
+        self.right_tokens = set()
+
+    def add_occurrence(self, tokens: List[str], start: int, end: int):
+        """
+        Adds the occurrence deriving tokens[start:end] of an example's `tokens`.
+        """
+        derived = ''.join(tokens[start:end])
+        self.char_classes.update(char_class(c) for c in derived)
+        if self.min_length is None:
+            self.min_length, self.max_length = len(derived), len(derived)
+        else:
+            self.min_length = min(self.min_length, len(derived))
+            self.max_length = max(self.max_length, len(derived))
+        padded = [BOUNDARY] * CONTEXT_K + tokens + [BOUNDARY] * CONTEXT_K
+        left = tuple(padded[start:start + CONTEXT_K])
+        right = tuple(padded[end + CONTEXT_K:end + 2 * CONTEXT_K])
+        self.contexts.add((left, right))
+        self.left_tokens.add(left[-1])
+        self.right_tokens.add(right[0])
+
+
+def jaccard(a: set, b: set):
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def similarity(a: Signature, b: Signature):
+    """
+    Returns the similarity, between 0 and 1, of the nonterminals whose signatures
+    are `a` and `b`: the average of the similarities of their character classes,
+    length ranges, k-contexts and neighbouring tokens.
+    >>> a, b, c = Signature(), Signature(), Signature()
+    >>> a.add_occurrence(['1', '+', '2'], 0, 1)
+    >>> b.add_occurrence(['(', '3', ')'], 1, 2)
+    >>> c.add_occurrence(['(', '3', ')'], 0, 1)
+    >>> similarity(a, b) > similarity(a, c)
+    True
+    """
+    overlap = min(a.max_length, b.max_length) - max(a.min_length, b.min_length) + 1
+    span = max(a.max_length, b.max_length) - min(a.min_length, b.min_length) + 1
+    length_similarity = max(0, overlap) / span
+    neighbour_similarity = (jaccard(a.left_tokens, b.left_tokens) + jaccard(a.right_tokens, b.right_tokens)) / 2
+    return (jaccard(a.char_classes, b.char_classes) + length_similarity
+            + jaccard(a.contexts, b.contexts) + neighbour_similarity) / 4
+
+
+def compute_signatures(trees: Iterable[ParseNode]) -> Dict[str, Signature]:
+    """
+    Returns the signature of every nonterminal occurring in `trees`.
+    >>> tree = ParseNode('t0', False, [ParseNode('t1', False, [ParseNode('"1"', True, [])]),
+    ...                                ParseNode('"+"', True, []), ParseNode('"2"', True, [])])
+    >>> signatures = compute_signatures([tree])
+    >>> sorted(signatures['t1'].contexts)
+    [((None, None), ('+', '2'))]
+    >>> signatures['t0'].min_length, signatures['t0'].char_classes == {'digit', 'other'}
+    (3, True)
+    """
+    signatures = {}
+    for tree in trees:
+        tokens, occurrences = [], []
+        # Explicit stack of (node, whether its children have been visited)
+        stack = [(tree, False)]
+        starts = []
+        while stack:
+            node, visited = stack.pop()
+            if node.is_terminal:
+                tokens.append(fixup_terminal(node.payload))
+            elif not visited:
+                starts.append(len(tokens))
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(node.children))
+            else:
+                occurrences.append((node.payload, starts.pop(), len(tokens)))
+        for nt, start, end in occurrences:
+            if nt not in signatures:
+                signatures[nt] = Signature()
+            signatures[nt].add_occurrence(tokens, start, end)
+    return signatures
+
+
+def uses_signatures():
+    """
+    Whether rank_pairs needs the signatures of the nonterminals.
+    """
+    return RANK_PAIRS or MIN_PAIR_SIMILARITY > 0
+
+
+def rank_pairs(pairs: List[Tuple[str, str]], signatures: Dict[str, Signature]):
+    """
+    Returns the pairs of nonterminals in `pairs` whose similarity is at least
+    MIN_PAIR_SIMILARITY, most similar first if RANK_PAIRS (the order of `pairs`
+    breaks ties), else in their order. Pairs with a nonterminal that has no
+    signature are kept (last, if ranked).
+    >>> import signature
+    >>> signature.RANK_PAIRS = True
+    >>> signatures = compute_signatures([ParseNode('t0', False, [
+    ...     ParseNode('t1', False, [ParseNode('"1"', True, [])]), ParseNode('"+"', True, []),
+    ...     ParseNode('t2', False, [ParseNode('"2"', True, [])]), ParseNode('"+"', True, []),
+    ...     ParseNode('t3', False, [ParseNode('"+"', True, [])])])])
+    >>> rank_pairs([('t1', 't3'), ('t1', 't2'), ('t1', 't9')], signatures)
+    [('t1', 't2'), ('t1', 't3'), ('t1', 't9')]
+    >>> signature.RANK_PAIRS = False
+    >>> rank_pairs([('t1', 't3'), ('t1', 't2'), ('t1', 't9')], signatures)
+    [('t1', 't3'), ('t1', 't2'), ('t1', 't9')]
+    """
+    if not uses_signatures():
+        return pairs
+    scored = []
+    for pair in pairs:
+        if pair[0] in signatures and pair[1] in signatures:
+            score = similarity(signatures[pair[0]], signatures[pair[1]])
+            if score < MIN_PAIR_SIMILARITY:
+                continue
+        else:
+            score = -1
+        scored.append((score, pair))
+    if RANK_PAIRS:
+        scored.sort(key=lambda score_pair: -score_pair[0])
+    return [pair for _, pair in scored]
@@ -5,14 +5,21 @@ from typing import List, Tuple, Set, Dict, Optional, Union
 from bubble import Bubble
 from group import group
 from oracle import ParseException
-from parse_tree import ParseNode, ParseTreeList, build_grammar, START
+from parse_tree import ParseNode, ParseTreeList, InducedGrammar, build_grammar, fold_tree, preorder_nodes, START
 from grammar import *
 from token_expansion import expand_tokens
 from union import UnionFind
 from replacement_utils import get_strings_with_replacement, get_strings_with_replacement_in_rule, \
     lvl_n_derivable
 
+import replacement_utils
+from checkpoint import Checkpointer, capture_run_state, examples_fingerprint, load_checkpoint, restore_run_state
+import checkpoint
 from next_tid import allocate_tid
+from parallel import CheckPool, can_fork, run_seeded, seed_for
+from signature import compute_signatures, rank_pairs
+import signature
+from verdicts import clear_verdicts, lookup_verdict, store_verdict, verdict_memo
 
 """
 Bulk of the Arvada algorithm.
@@ -40,6 +47,18 @@ MAX_GROUP_LEN = 10
 MUST_EXPAND_IN_COALESCE = False
 MUST_EXPAND_IN_PARTIAL= False
 
+# Whether build_trees keeps trying the other bubbles of a grouping round once one
+# is accepted, committing all the successful ones which do not overlap it, before
+# regrouping. Otherwise it regroups after each accepted bubble, as originally.
+# Batching is faster, but may accept other bubbles (search.py --batch_bubbles).
+BATCH_BUBBLES = False
+
+# Number of processes checking pairs of nonterminals in parallel in coalesce, and
+# number of pairs each of them checks per batch. The learned grammar does not
+# depend on the number of processes.
+COALESCE_WORKERS = 1
+PAIRS_PER_WORKER = 4
+
 ORIGINAL_COALESCE_TIME = 0
 BUILD_TIME = 0
 LAST_COALESCE_TIME = 0
@@ -49,6 +68,9 @@ MINIMIZE_TIME = 0
 TIME_GENERATING_EXAMPLES = 0
 TIME_GROUPING = 0
 
+# Timing globals saved in checkpoints (see checkpoint.py)
+CHECKPOINTED_TIMES = ['ORIGINAL_COALESCE_TIME', 'TIME_GENERATING_EXAMPLES', 'TIME_GROUPING']
+
 
 def get_times():
     from replacement_utils import TIME_GENERATING_EXAMPLES_INTERNAL
@@ -69,32 +91,64 @@ def check_recall(oracle, grammar: Grammar):
             return False
     return True
 
-def build_start_grammar(oracle, leaves, bbl_bounds = (3,10)):
+def build_start_grammar(oracle, leaves, bbl_bounds = (3,10), fixed_trees: List[ParseNode] = None):
     """
     ORACLE is a CachingOracle or ExternalOracle with a .parse method, which
     returns True if the example given is in the ORACLE's language
 
     LEAVES is a list of positive examples, each  a list of characters.
 
+    FIXED_TREES are parse trees over the nonterminals of a grammar learned before
+    (see warm_start.py). They take part in coalescing, but are not bubbled, and only
+    the pairs involving a nonterminal which is not theirs are checked.
+
     Returns a grammar that maximally expands LEAVES w.r.t. ORACLE.
     """
-    global LAST_COALESCE_TIME
-    global EXPAND_TIME
-    global MINIMIZE_TIME
     global MIN_GROUP_LEN 
     global MAX_GROUP_LEN
     MIN_GROUP_LEN, MAX_GROUP_LEN = bbl_bounds
     print('Building the starting trees...'.ljust(50), end='\r')
-    trees, classes = build_trees(oracle, leaves)
+    clear_verdicts()
+    trees, classes = build_trees(oracle, leaves, fixed_trees)
+    grammar, trees = coalesce_trees(oracle, trees, fixed_nt_groups(fixed_trees))
+    return finish_grammar(oracle, grammar, trees)
+
+
+def fixed_nt_groups(fixed_trees: List[ParseNode]):
+    """
+    Returns the nt_groups (see coalesce) putting the nonterminals of FIXED_TREES, which
+    are known not to coalesce, in a same group.
+    """
+    if not fixed_trees:
+        return None
+    return {nt: 0 for tree in fixed_trees for nt in tree.all_nts() if nt != START}
+
+
+def coalesce_trees(oracle, trees: List[ParseNode], nt_groups: Dict[str, int] = None):
+    """
+    Coalesces (fully, then partially) the nonterminals of TREES, except the pairs
+    NT_GROUPS puts in a same group (see coalesce). Returns the grammar induced by the
+    resulting trees, and the trees.
+    """
+    global LAST_COALESCE_TIME
     print('Building initial grammar...'.ljust(50), end='\r')
     grammar = build_grammar(trees)
     print('Coalescing nonterminals...'.ljust(50), end='\r')
     s = time.time()
-    grammar, new_trees, coalesce_caused = coalesce(oracle, trees, grammar)
-    grammar, new_trees, partial_coalesces = coalesce_partial(oracle, new_trees, grammar)
+    grammar, new_trees, coalesce_caused = coalesce(oracle, trees, grammar, nt_groups=nt_groups)
+    grammar, new_trees, partial_coalesces = coalesce_partial(oracle, new_trees, grammar, nt_groups=nt_groups)
     LAST_COALESCE_TIME += time.time() - s
+    return grammar, new_trees
+
+
+def finish_grammar(oracle, grammar: Grammar, trees: List[ParseNode]):
+    """
+    Expands the tokens of GRAMMAR, induced by TREES, and minimizes it.
+    """
+    global EXPAND_TIME
+    global MINIMIZE_TIME
     s = time.time()
-    grammar = expand_tokens(oracle, grammar, new_trees)
+    grammar = expand_tokens(oracle, grammar, trees)
     EXPAND_TIME += time.time() - s
     print('Minimizing initial grammar...'.ljust(50), end='\r')
     s = time.time()
@@ -139,68 +193,128 @@ def build_naive_parse_trees_2(leaves: List[List[ParseNode]]):
     return trees
 
 
-def apply(grouping: Bubble, trees: List[ParseNode]):
+def prefix_function(pattern: List[str]):
+    """
+    KMP failure function of `pattern`: the length of the longest proper prefix of
+    pattern[:i+1] which is also a suffix of it, for each i.
+    >>> prefix_function(['a', 'b', 'a', 'a', 'b'])
+    [0, 0, 1, 1, 2]
+    """
+    failure = [0] * len(pattern)
+    k = 0
+    for i in range(1, len(pattern)):
+        while k > 0 and pattern[k] != pattern[i]:
+            k = failure[k - 1]
+        if pattern[k] == pattern[i]:
+            k += 1
+        failure[i] = k
+    return failure
+
+
+def find_matches(pattern: List[str], failure: List[int], layer: List[ParseNode]):
+    """
+    Returns the start indices of the leftmost non-overlapping occurrences of the
+    payloads `pattern` (with failure function `failure`) in `layer`, in one pass.
+    >>> layer = [ParseNode(c, True, []) for c in 'aabaabab']
+    >>> find_matches(['a', 'b'], prefix_function(['a', 'b']), layer)
+    [1, 4, 6]
+    >>> find_matches(['a', 'b', 'a'], prefix_function(['a', 'b', 'a']), layer)
+    [1, 4]
+    """
+    starts, k, m = [], 0, len(pattern)
+    for i, node in enumerate(layer):
+        payload = node.payload
+        while k > 0 and pattern[k] != payload:
+            k = failure[k - 1]
+        if pattern[k] == payload:
+            k += 1
+        if k == m:
+            starts.append(i - m + 1)
+            k = 0
+    return starts
+
+
+def apply(grouping: Union[Bubble, Tuple[Bubble, Bubble]], trees: List[ParseNode], tree_idxs: Set[int] = None):
     """
     `grouping` is a Bubble, i.e. a representation of a  contiguous
-    sequence of nonterminals that appears someplace in `trees`.
+    sequence of nonterminals that appears someplace in `trees`, or a pair of Bubbles.
 
     `trees` is a list of parse trees
 
     Returns a new list of trees consisting of  bubbling up the grouping
-    in `grouping` for each tree in `trees`
+    in `grouping` for each tree in `trees`. A pair of bubbles gives the same
+    trees as applying the first bubble, then the second, but in a single pass.
+
+    If `tree_idxs` is given, the bubbles only occur in the trees at these
+    indices, so the other trees are returned unchanged (the same objects).
+    >>> a, b, c = [ParseNode(x, True, []) for x in 'abc']
+    >>> tree = ParseNode('t0', False, [a, b, c, a, b])
+    >>> new_tree = apply(Bubble('t1', [a, b]), [tree])[0]
+    >>> [child.payload for child in new_tree.children], new_tree.children[0].derived_string()
+    (['t1', 'c', 't1'], 'ab')
+    >>> new_tree = apply((Bubble('t2', [a, b, c]), Bubble('t3', [b, c])), [tree])[0]
+    >>> [child.payload for child in new_tree.children], [child.payload for child in new_tree.children[0].children]
+    (['t2', 'a', 'b'], ['a', 't3'])
     """
+    bubbles = [grouping] if isinstance(grouping, Bubble) else list(grouping)
+    patterns = []
+    for bubble in bubbles:
+        pattern = [elem.payload for elem in bubble.bubbled_elems]
+        patterns.append((pattern, prefix_function(pattern), bubble.new_nt))
 
-    def matches(group_lst, layer):
+    def bubble_up(layer: List[ParseNode], patterns):
         """
-        GROUP_LST is a contiguous subarray of ParseNodes that are grouped together.
-        This method requires that len(GRP_LST) > 0.
-
-        LAYER another a list of ParseNodes.
-
-        Returns the index at which GROUP_LST appears in LAYER, and returns -1 if
-        the GROUP_LST does not appear in the LAYER. Does not mutate LAYER.
+        Groups the matches of the first pattern in LAYER, then those of the next
+        patterns in the new layer and in the new groups (which is what applying
+        the patterns one after the other does).
         """
-        ng, nl = len(group_lst), len(layer)
-        for i in range(nl):
-            layer_ind = i  # Index into layer
-            group_ind = 0  # Index into group
-            while group_ind < ng and layer_ind < nl and layer[layer_ind].payload == group_lst[group_ind].payload:
-                layer_ind += 1
-                group_ind += 1
-            if group_ind == ng: return i
-        return -1
+        if not patterns:
+            return layer
+        (pattern, failure, new_nt), rest = patterns[0], patterns[1:]
+        starts = find_matches(pattern, failure, layer)
+        if not starts:
+            return bubble_up(layer, rest)
+        new_layer, end = [], 0
+        for start in starts:
+            new_layer.extend(layer[end:start])
+            end = start + len(pattern)
+            new_layer.append(ParseNode(new_nt, False, bubble_up(layer[start:end], rest)))
+        new_layer.extend(layer[end:])
+        return bubble_up(new_layer, rest)
 
     def apply_single(tree: ParseNode):
         """
         TREE is a parse tree.
 
         Applies the GROUPING data structure to a single tree. Applies that
-        GROUPING to LAYER as many times as possible. Does not mutate TREE.
+        GROUPING to each layer as many times as possible. Does not mutate TREE.
 
-        Returns the new layer. If no updates can be made, do nothing.
+        Returns the new tree, which shares the subtrees of TREE that GROUPING does
+        not occur in (TREE itself if it does not occur at all).
         """
-        group_lst, id = grouping.bubbled_elems, grouping.new_nt
-        new_tree, ng = tree.copy(), len(group_lst)
+        def leaf_value(node: ParseNode, path):
+            return node if node.is_terminal else None
 
-        # Do replacments in all the children first
-        for index in range(len(new_tree.children)):
-            # (self, payload, is_terminal, children)
-            old_node = new_tree.children[index]
-            new_tree.children[index] = apply_single(old_node)
+        def combine(node: ParseNode, children: List[ParseNode]):
+            # The replacements in all the children are done first
+            new_children = bubble_up(children, patterns)
+            if new_children is children and all(new is old for new, old in zip(children, node.children)):
+                # Share the subtrees where the bubbles do not occur
+                return node
+            return ParseNode(node.payload, False, new_children)
 
-        ind = matches(group_lst, new_tree.children)
-        while ind != -1:
-            parent = ParseNode(id, False, new_tree.children[ind: ind + ng])
-            new_tree.children[ind: ind + ng] = [parent]
-            ind = matches(group_lst, new_tree.children)
+        return fold_tree(tree, leaf_value, combine)
 
-        new_tree.update_cache_info()
-        return new_tree
+    new_trees = []
+    for tree_idx, tree in enumerate(trees):
+        new_tree = apply_single(tree) if tree_idxs is None or tree_idx in tree_idxs else tree
+        if new_tree is not tree or not new_tree.cache_valid:
+            new_tree.update_cache_info()
+        new_trees.append(new_tree)
+    return new_trees
 
-    return [apply_single(tree) for tree in trees]
 
-
-def build_trees(oracle, leaves):
+def build_trees(oracle, leaves, fixed_trees: List[ParseNode] = None):
     """
     ORACLE is an oracle for the grammar we seek to find. We ask the oracle
     yes or no replacement questions in this method.
@@ -208,6 +322,10 @@ def build_trees(oracle, leaves):
     LEAVES should be a list of lists (one list for each input example), where
     each sublist contains the tokens that built that example, as ParseNodes.
 
+    FIXED_TREES, if given, are parse trees of other examples (over the nonterminals
+    of a grammar learned before), which are coalesced with the trees of LEAVES but
+    never bubbled. They come after the trees of LEAVES in the returned list.
+
     Iteratively builds parse trees by greedily choosing a substring to "bubble"
     up that passes replacement tests at each point in the algorithm, until no
     further bubble ups can be made.
@@ -225,70 +343,130 @@ def build_trees(oracle, leaves):
     global BUILD_TIME
     global TIME_GROUPING
 
-    def score(trees: List[ParseNode], new_bubble: Optional[Bubble]) \
-            -> Tuple[int, List[ParseNode]]:
+    def score(trees: List[ParseNode], tree_idxs: Optional[Set[int]], new_bubble: Optional[Bubble]) -> int:
         """
-        Tries to merge nonterminals in `trees`, and returns (1, the new trees with labels)
-        merged if a merge occurs. Score is 0 otherwise.
+        Tries to merge nonterminals in `trees`, the trees of `tree_list` with those at
+        `tree_idxs` (all if None) replaced, and returns 1 if a merge occurs, leaving
+        the trees with labels merged in `tree_list`. Score is 0 otherwise, and
+        `tree_list` is left as it was.
 
         If `new_bubble` is not None, only checks mergings that involve
         the new bubble (against each existing nonterminal if it's a 1-bubble
         and between the two introduced nonterminals if it's a 2-bubble)
 
         """
-        # Convert LAYERS into a grammar
-        grammar = build_grammar(trees)
-
-        grammar, new_trees, coalesce_caused = coalesce(oracle, trees, grammar, new_bubble)
+        # Only the trees the bubble changed are replaced in the list, which updates
+        # what it computed from them
+        tree_list.begin_trial()
+        for tree_idx in range(len(trees)) if tree_idxs is None else sorted(tree_idxs):
+            if trees[tree_idx] is not tree_list[tree_idx]:
+                tree_list[tree_idx] = trees[tree_idx]
+        # Convert LAYERS into a grammar, only visiting the trees the bubble changed
+        induced_grammar.update(tree_list, tree_idxs)
+        grammar = induced_grammar.grammar()
+
+        grammar, _, coalesce_caused = coalesce(oracle, tree_list, grammar, new_bubble)
         if not coalesce_caused and not isinstance(new_bubble, tuple):
-            grammar, new_trees, partial_coalesces = coalesce_partial(oracle, trees, grammar, new_bubble)
+            grammar, _, partial_coalesces = coalesce_partial(oracle, tree_list, grammar, new_bubble)
             if partial_coalesces:
                 print("\n(partial)")
                 coalesce_caused = True
 
         # grammar = minimize(grammar)
-        new_size = grammar.size()
         if coalesce_caused:
-            return 1, new_trees
+            changed = tree_list.commit_trial()
         else:
-            return 0, trees
+            changed = tree_list.revert_trial()
+        induced_grammar.update(tree_list, changed)
+        return 1 if coalesce_caused else 0
 
 
-    best_trees = build_naive_parse_trees(leaves)
-    grammar = build_grammar(best_trees)
-    s = time.time()
-    print("Beginning coalescing...".ljust(50))
-    grammar, best_trees, _ = coalesce(oracle, best_trees, grammar)
-    grammar, best_trees, _ = coalesce_partial(oracle, best_trees, grammar)
-    ORIGINAL_COALESCE_TIME += time.time() - s
-
-
-    max_example_size = max([len(leaf_lst) for leaf_lst in leaves])
-
-    s = time.time()
+    def checkpoint_state(position):
+        """
+        Returns the state of the search at `position` in the main loop: (group size,
+        iteration) at the start of a grouping round, or None once bubbling is over.
+        """
+        global_times = globals()
+        state = capture_run_state(oracle)
+        state.update({'examples': examples_fingerprint(leaves), 'trees': best_trees, 'position': position,
+                      'build_time': time.time() - s,
+                      'times': {name: global_times[name] for name in CHECKPOINTED_TIMES},
+                      'internal_example_time': replacement_utils.TIME_GENERATING_EXAMPLES_INTERNAL})
+        return state
+
+    checkpointer = Checkpointer()
+    if checkpoint.RESUME_FROM is not None:
+        resumed = load_checkpoint(checkpoint.RESUME_FROM)
+        if resumed['examples'] != examples_fingerprint(leaves):
+            raise ValueError(f"{checkpoint.RESUME_FROM} is a checkpoint of a run on other examples")
+        print(f"Resuming from {checkpoint.RESUME_FROM}...".ljust(50))
+        restore_run_state(resumed, oracle)
+        globals().update(resumed['times'])
+        replacement_utils.TIME_GENERATING_EXAMPLES_INTERNAL = resumed['internal_example_time']
+        best_trees, position, build_time = resumed['trees'], resumed['position'], resumed['build_time']
+        for tree in best_trees:
+            tree.update_cache_info()
+    else:
+        # Only the pairs involving the nonterminals of the new trees need checking
+        nt_groups = fixed_nt_groups(fixed_trees)
+        best_trees = build_naive_parse_trees(leaves) + (fixed_trees if fixed_trees else [])
+        grammar = build_grammar(best_trees)
+        s = time.time()
+        print("Beginning coalescing...".ljust(50))
+        grammar, best_trees, _ = coalesce(oracle, best_trees, grammar, nt_groups=nt_groups)
+        grammar, best_trees, _ = coalesce_partial(oracle, best_trees, grammar, nt_groups=nt_groups)
+        ORIGINAL_COALESCE_TIME += time.time() - s
+        position, build_time = (MIN_GROUP_LEN, 1), 0
+    # The trees and their grammar, kept up to date across the bubbles tried (see score)
+    induced_grammar = InducedGrammar(best_trees)
+    tree_list = ParseTreeList(best_trees, induced_grammar.grammar())
+
+
+    max_example_size = max([len(leaf_lst) for leaf_lst in leaves], default=0)
+    # The trees of LEAVES come first, the fixed trees are never bubbled
+    num_bubbled = len(leaves)
+    bubbled_idxs = set(range(num_bubbled)) if fixed_trees else None
+
+    s = time.time() - build_time
     # Main algorithm loop. Iteratively increase the length of groups allowed from MIN_GROUP_LEN to MAX_GROUP_LEN
-    for group_size in range(MIN_GROUP_LEN, MAX_GROUP_LEN):
-        count = 1
+    # (starting from the position of the checkpoint when resuming)
+    for group_size in range(position[0], MAX_GROUP_LEN) if position is not None and leaves else []:
+        count = position[1] if group_size == position[0] else 1
         updated = True
         while updated:
+            if checkpointer.due():
+                checkpointer.save(checkpoint_state((group_size, count)))
             group_start = time.time()
-            all_groupings = group(best_trees, group_size)
+            all_groupings = group(best_trees[:num_bubbled], group_size)
             TIME_GROUPING += time.time() - group_start
             updated, nlg = False, len(all_groupings)
+            # Bubbles accepted in this round, and the nonterminals left in the trees
+            accepted, current_nts = [], None
             for i, (grouping, the_score) in enumerate(all_groupings):
+                bubbles = [grouping] if isinstance(grouping, Bubble) else list(grouping)
+                if accepted:
+                    # Skip the bubbles found over the elements of an accepted bubble, or
+                    # over nonterminals which have since been coalesced away
+                    if any(bubble.overlaps(other) for bubble in bubbles for other in accepted):
+                        continue
+                    if any(not elem.is_terminal and elem.payload not in current_nts
+                           for bubble in bubbles for elem in bubble.bubbled_elems):
+                        continue
                 print(('[Group len %d] Bubbling iteration %d (%d/%d)...' % (group_size, count, i + 1, nlg)).ljust(50), end='\r')
                 ### Perform the bubble
+                # Until a bubble is accepted, the trees are those the bubbles were found in,
+                # so only the trees their sources are in need to be rebuilt
+                tree_idxs = bubbled_idxs if accepted else set().union(*[bubble.source_trees() for bubble in bubbles])
                 if isinstance(grouping, Bubble):
-                    new_trees = apply(grouping, best_trees)
-                    new_score, new_trees = score(new_trees, grouping)
+                    new_trees = apply(grouping, best_trees, tree_idxs)
+                    new_score = score(new_trees, tree_idxs, grouping)
                     grouping_str = f"Successful grouping (single): {grouping.bubbled_elems}"#\n    (aka {[e.derived_string() for e in grouping.bubbled_elems]}"
                     grouping_str += f"\n     [score of {the_score}]"
                 else:
                     bubble_one = grouping[0]
                     bubble_two = grouping[1]
-                    new_trees = apply(bubble_one, best_trees)
-                    new_trees = apply(bubble_two, new_trees)
-                    new_score, new_trees = score(new_trees, grouping)
+                    new_trees = apply(grouping, best_trees, tree_idxs)
+                    new_score = score(new_trees, tree_idxs, grouping)
                     grouping_str = f"Successful grouping (double): {bubble_one.bubbled_elems}, {bubble_two.bubbled_elems}"
                     grouping_str += f"\n     (aka {[e.derived_string() for e in bubble_one.bubbled_elems]}, {[e.derived_string() for e in bubble_two.bubbled_elems]}))"
                     grouping_str += f"\n     [score of {the_score}]"
@@ -296,24 +474,43 @@ def build_trees(oracle, leaves):
                 if new_score > 0:
                     print()
                     print(grouping_str)
-                    best_trees = new_trees
+                    best_trees = list(tree_list)
                     updated = True
-                    break
+                    checkpointer.bubbles_accepted(1)
+                    if not BATCH_BUBBLES:
+                        break
+                    accepted.extend([grouping] if isinstance(grouping, Bubble) else grouping)
+                    current_nts = set().union(*[tree.all_nts() for tree in best_trees])
 
             count = count + 1
 
         if group_size > max_example_size:
             break
 
+    checkpointer.save(checkpoint_state(None))
     BUILD_TIME += time.time() - s
     return best_trees, {}
 
 
+def same_group(nt_groups: Dict[str, int], first: str, second: str):
+    """
+    Whether NT_GROUPS puts the nonterminals FIRST and SECOND in a same group.
+    >>> same_group({'t1': 0, 't2': 0, 't3': 1}, 't1', 't2'), same_group({'t1': 0, 't2': 0}, 't1', 't4')
+    (True, False)
+    """
+    return first in nt_groups and nt_groups[first] == nt_groups.get(second)
+
+
 def coalesce_partial(oracle, trees: List[ParseNode], grammar: Grammar,
-                     coalesce_target: Bubble = None):
+                     coalesce_target: Bubble = None, nt_groups: Dict[str, int] = None):
     """
     ASSUMES: `grammar` is the grammar induced by `trees`
 
+    If `trees` is a ParseTreeList, the replacements are made in it (see coalesce).
+
+    If `nt_groups` is given, the pairs of nonterminals it puts in a same group are
+    not checked (they are known not to coalesce, see coalesce).
+
     Performs partial coalesces on the grammar. That is, for pairs of nonterminals (nt1, nt2), checks whether:
        if nt1 can be replaced by nt2 everywhere, are there any occurrences of nt2 where nt1 can replace nt2.
     An "occurrence" of nt2 is a location in a rule in grammar. So even if there are two separate trees
@@ -364,9 +561,10 @@ def coalesce_partial(oracle, trees: List[ParseNode], grammar: Grammar,
 
         # Check whether `replaceable_everywhere` is replaceable by `replaceable_in_some_rules` everywhere.
         everywhere_by_some_candidates = []
-        for tree in trees:
+        for tree_idx, paths in trees.trees_with_occurrences(replaceable_everywhere):
             everywhere_by_some_candidates.extend(
-                get_strings_with_replacement(tree, replaceable_everywhere, in_some_derivable_strings))
+                get_strings_with_replacement(trees[tree_idx], replaceable_everywhere, in_some_derivable_strings, paths,
+                                             trees.template_cache))
 
 
         if len(everywhere_by_some_candidates) > MAX_SAMPLES_PER_COALESCE:
@@ -392,9 +590,10 @@ def coalesce_partial(oracle, trees: List[ParseNode], grammar: Grammar,
         for replacement_loc in partial_replacement_locs:
             rule, posn = replacement_loc
             candidate_strs = []
-            for tree in trees:
+            for tree_idx, paths in trees.trees_with_expansion(*rule):
                 candidate_strs.extend(
-                    get_strings_with_replacement_in_rule(tree, rule, posn, everywhere_derivable_strings))
+                    get_strings_with_replacement_in_rule(trees[tree_idx], rule, posn, everywhere_derivable_strings, paths,
+                                                     trees.template_cache))
             if len(candidate_strs) > MAX_SAMPLES_PER_COALESCE:
                 candidate_strs = random.sample(candidate_strs, MAX_SAMPLES_PER_COALESCE)
             else:
@@ -462,27 +661,34 @@ def coalesce_partial(oracle, trees: List[ParseNode], grammar: Grammar,
         Updates `new_tree` s.t. the locations in `partial_replacement_locs` are replaced by `new_nt`, and all
         occurrences of `full_relacement_nt` are replaced by `new_nt`.
         """
-        if new_tree.is_terminal:
-            return new_tree
-        my_body = tuple([child.payload for child in new_tree.children])
-        for c in new_tree.children:
-            update_tree(c, partial_replacement_locs, full_replacement_nt, new_nt)
-        if (new_tree.payload, my_body) in partial_replacement_locs:
-            posns = partial_replacement_locs[(new_tree.payload, my_body)]
-            for posn in posns:
-                prev_child = new_tree.children[posn]
-                prev_child.payload = new_nt
-        if new_tree.payload == full_replacement_nt:
-            new_tree.payload = new_nt
+        nodes = [node for node in preorder_nodes(new_tree) if not node.is_terminal]
+        # Each node is matched against the rules with the labels its children have
+        # before any is replaced
+        bodies = [tuple([child.payload for child in node.children]) for node in nodes]
+        # Children before their parents
+        for node, my_body in zip(reversed(nodes), reversed(bodies)):
+            if (node.payload, my_body) in partial_replacement_locs:
+                posns = partial_replacement_locs[(node.payload, my_body)]
+                for posn in posns:
+                    prev_child = node.children[posn]
+                    prev_child.payload = new_nt
+            if node.payload == full_replacement_nt:
+                node.payload = new_nt
 
     def get_updated_trees(trees: ParseTreeList, rules_to_replace: Dict[Tuple[str, Tuple[str]], List[int]],
                           replacer_orig: str, replacer: str):
-        rest = []
-        for tree in trees:
-            new_tree = tree.copy()
-            update_tree(new_tree, rules_to_replace, replacer_orig, replacer)
-            rest.append(new_tree)
-        return rest
+        """
+        Returns {tree index: tree updated by update_tree} for the trees in which
+        `replacer_orig` or a rule of `rules_to_replace` occurs; the others are unchanged.
+        """
+        changed = {tree_idx for tree_idx, _ in trees.trees_with_occurrences(replacer_orig)}
+        for rule_start, body in rules_to_replace:
+            changed.update(tree_idx for tree_idx, _ in trees.trees_with_expansion(rule_start, body))
+        updated = {}
+        for tree_idx in sorted(changed):
+            updated[tree_idx] = trees[tree_idx].copy()
+            update_tree(updated[tree_idx], rules_to_replace, replacer_orig, replacer)
+        return updated
 
     #################### END HELPERS ########################
 
@@ -506,63 +712,126 @@ def coalesce_partial(oracle, trees: List[ParseNode], grammar: Grammar,
     # The main work of the function.
     replacement_happened = False
     fully_replaced = {}
-    trees = ParseTreeList(trees, grammar)
-    for nt_to_fully_replace in fully_replaceable:
-        for nt_to_partially_replace in partially_replaceable:
-
-            # Fixups because we created the lists fully_replaceable and partially_replaceable
-            # before performing replacements. So we may have some out-dated labels.
-            while nt_to_fully_replace in fully_replaced and nt_to_fully_replace != START:
-                nt_to_fully_replace = fully_replaced[nt_to_fully_replace]
-            while nt_to_partially_replace in fully_replaced and nt_to_partially_replace != START:
-                nt_to_partially_replace = fully_replaced[nt_to_partially_replace]
-            if nt_to_fully_replace == nt_to_partially_replace:
-                continue
+    pairs = [(nt_to_fully_replace, nt_to_partially_replace) for nt_to_fully_replace in fully_replaceable
+             for nt_to_partially_replace in partially_replaceable]
+    if nt_groups is not None:
+        pairs = [pair for pair in pairs if not same_group(nt_groups, *pair)]
+    if coalesce_target is None and signature.uses_signatures():
+        # Check the most similar pairs first, skipping the implausible ones
+        pairs = rank_pairs(pairs, compute_signatures(trees))
+    if not isinstance(trees, ParseTreeList):
+        trees = ParseTreeList(trees, grammar)
+    trees.grammar = grammar
+    for nt_to_fully_replace, nt_to_partially_replace in pairs:
+
+        # Fixups because we created the lists fully_replaceable and partially_replaceable
+        # before performing replacements. So we may have some out-dated labels.
+        while nt_to_fully_replace in fully_replaced and nt_to_fully_replace != START:
+            nt_to_fully_replace = fully_replaced[nt_to_fully_replace]
+        while nt_to_partially_replace in fully_replaced and nt_to_partially_replace != START:
+            nt_to_partially_replace = fully_replaced[nt_to_partially_replace]
+        if nt_to_fully_replace == nt_to_partially_replace:
+            continue
 
-            # Delegate to helper to find of if (a) nt_to_fully_replace can be replaced by nt_to_partially_replace
-            # everywhere, and if so (b) return the positions at which nt_to_partially_replace can be replaced
-            # by nt_to_fully_replace
-            replacement_positions = partially_coalescable(nt_to_fully_replace, nt_to_partially_replace, trees)
+        # Skip the checks which failed before on the same occurrences
+        if MUST_EXPAND_IN_PARTIAL and coalesce_target is not None:
+            key = None
+        else:
+            key = ('partial', trees.fingerprint(nt_to_fully_replace), trees.fingerprint(nt_to_partially_replace),
+                   trees.rule_fingerprint(nt_to_partially_replace))
+        if lookup_verdict(key) is not None:
+            continue
 
-            if len(replacement_positions) > 0:
-                #print(f"we found that {nt_to_partially_replace} could replace {nt_to_fully_replace} everywhere, "
-                 #     f"and {nt_to_fully_replace} could replace {nt_to_partially_replace} at : {replacement_positions}")
+        # Delegate to helper to find of if (a) nt_to_fully_replace can be replaced by nt_to_partially_replace
+        # everywhere, and if so (b) return the positions at which nt_to_partially_replace can be replaced
+        # by nt_to_fully_replace
+        replacement_positions = partially_coalescable(nt_to_fully_replace, nt_to_partially_replace, trees)
+        if len(replacement_positions) == 0:
+            # Only failures are memoized, as successes are applied right away
+            store_verdict(key, False)
 
-                if nt_to_fully_replace == START:
-                    new_nt = START
-                else:
-                    new_nt = allocate_tid()
+        if len(replacement_positions) > 0:
+            #print(f"we found that {nt_to_partially_replace} could replace {nt_to_fully_replace} everywhere, "
+             #     f"and {nt_to_fully_replace} could replace {nt_to_partially_replace} at : {replacement_positions}")
+
+            if nt_to_fully_replace == START:
+                new_nt = START
+            else:
+                new_nt = allocate_tid()
 
-                grammar = get_updated_grammar(grammar, replacement_positions, nt_to_fully_replace,
-                                              nt_to_partially_replace, new_nt)
-                inner_trees = get_updated_trees(trees, replacement_positions, nt_to_fully_replace, new_nt)
-                trees = ParseTreeList(inner_trees, grammar)
-                fully_replaced[nt_to_fully_replace] = new_nt
-                replacement_happened = True
+            grammar = get_updated_grammar(grammar, replacement_positions, nt_to_fully_replace,
+                                          nt_to_partially_replace, new_nt)
+            for tree_idx, tree in get_updated_trees(trees, replacement_positions, nt_to_fully_replace, new_nt).items():
+                trees[tree_idx] = tree
+            trees.grammar = grammar
+            fully_replaced[nt_to_fully_replace] = new_nt
+            replacement_happened = True
 
     trees = trees.inner_list
     return grammar, trees, replacement_happened
 
 
 def coalesce(oracle, trees: List[ParseNode], grammar: Grammar,
-             coalesce_target: Bubble = None):
+             coalesce_target: Bubble = None, nt_groups: Dict[str, int] = None):
     """
     ORACLE is a Oracle for the grammar we seek to find. We ask the oracle
     yes or no replacement questions in this method.
 
-    TREES is a list of fully constructed parse trees.
+    TREES is a list of fully constructed parse trees. If it is a ParseTreeList, the
+    merges are made in it (and the list returned is its own), which saves building one
+    from scratch when it lives across calls (see build_trees).
 
     GRAMMAR is a GrammarNode that is the disjunction of the TREES.
 
     COALESCE_TARGET is the nonterminal we should be checking coalescing against,
     else due a quadratic check of all nonterminals against each other.
 
+    NT_GROUPS, if given, maps nonterminals to groups whose nonterminals are known not
+    to coalesce with each other (e.g. those of a grammar we warm start from, or those
+    learned from a same shard of the examples), so the quadratic check skips the
+    pairs in a same group. The nonterminals it does not map are checked against all.
+
     This method coalesces nonterminals that are equivalent to each other.
     Equivalence is determined by replacement.
 
     RETURNS: the grammar after coalescing, the parse trees after coalescing,
     and whether any nonterminals were actually coalesced with each other
     (found equivalent).
+
+    Each merge joins the classes of the nonterminals, so t1, t2, ... t5 end up in a
+    single class (START's), and the two operators in another:
+    >>> from lark import Lark
+    >>> from oracle import CachingOracle
+    >>> from parse_tree import build_grammar
+    >>> import next_tid, verdicts
+    >>> oracle = CachingOracle(Lark('start: e\\ne: t (("+"|"*") t)*\\nt: /[0-9]/ | "(" e ")"'))
+    >>> def leaf(c): return ParseNode(c, True, [])
+    >>> def toy_trees():
+    ...     plus = lambda: ParseNode('t6', False, [leaf('+')])
+    ...     return [ParseNode('t0', False, [ParseNode('t1', False, [leaf('1')]), plus(), ParseNode('t2', False, [leaf('2')]),
+    ...                                     plus(), ParseNode('t3', False, [leaf('(3)')])]),
+    ...             ParseNode('t0', False, [ParseNode('t4', False, [leaf('4')]), ParseNode('t7', False, [leaf('*')]),
+    ...                                     ParseNode('t5', False, [leaf('(5)')])])]
+    >>> random.seed(0); next_tid.next_tid = 8; verdicts.clear_verdicts()
+    >>> trees = toy_trees()
+    >>> grammar, new_trees, coalesce_caused = coalesce(oracle, trees, build_grammar(trees))
+    >>> operator = max(new_trees[0].all_nts())
+    >>> coalesce_caused, [tree.all_nts() == {'t0', operator} for tree in new_trees]
+    (True, [True, True])
+    >>> sorted(grammar.rules[operator].bodies), len(grammar.rules['t0'].bodies)
+    ([['"*"'], ['"+"']], 7)
+    >>> [tree.derived_string() for tree in trees], set(grammar.rules) == {'start', 't0', operator}
+    (['1+2+(3)', '4*(5)'], True)
+
+    The pairs checked in parallel by forked processes give the same grammar:
+    >>> import start
+    >>> start.COALESCE_WORKERS, start.PAIRS_PER_WORKER = 2, 1
+    >>> random.seed(0); next_tid.next_tid = 8; verdicts.clear_verdicts()
+    >>> trees = toy_trees()
+    >>> parallel_grammar, parallel_trees, _ = coalesce(oracle, trees, build_grammar(trees))
+    >>> start.COALESCE_WORKERS, start.PAIRS_PER_WORKER = 1, PAIRS_PER_WORKER
+    >>> str(parallel_grammar) == str(grammar), [str(tree) for tree in parallel_trees] == [str(tree) for tree in new_trees]
+    (True, True)
     """
 
     def replacement_valid(replacer_derivable_strings, replacee, trees : ParseTreeList) -> Tuple[bool, Set[str]]:
@@ -574,8 +843,9 @@ def coalesce(oracle, trees: List[ParseNode], grammar: Grammar,
         # Get the set of positive examples with strings derivable from replacer
         # replaced with strings derivable from replacee
         replaced_strings = set()
-        for tree in trees:
-            replaced_strings.update(get_strings_with_replacement(tree, replacee, replacer_derivable_strings))
+        for tree_idx, paths in trees.trees_with_occurrences(replacee):
+            replaced_strings.update(get_strings_with_replacement(trees[tree_idx], replacee, replacer_derivable_strings,
+                                                                 paths, trees.template_cache))
 
         if len(replaced_strings) == 0:
             # TODO: See the failing doctest in bubble.py. Pickle below for a "real" example
@@ -638,54 +908,14 @@ def coalesce(oracle, trees: List[ParseNode], grammar: Grammar,
         return True
 
 
-    def get_updated_trees(get_class: Dict[str, str], trees):
-
-        def replace_coalesced_nonterminals(node: ParseNode):
-            """
-                Rewrites node so that coalesced nonterminals point to their
-                class nonterminal. For non-coalesced nonterminals, get_class
-                just gives the original nonterminal
-                """
-            if node.is_terminal:
-                return
-            else:
-                node.payload = get_class.get(node.payload, node.payload)
-                for child in node.children:
-                    replace_coalesced_nonterminals(child)
-
-        def fix_double_indirection(node: ParseNode):
-            """
-                Fix parse trees that have an expansion of the for tx->tx (only one child)
-                since we've removed such double indirection while merging nonterminals
-                """
-            if node.is_terminal:
-                return
-
-            while len(node.children) == 1 and node.children[0].payload == node.payload:
-                # Won't go on forever because eventually length of children will be not 1,
-                # or the children's payload will not be the same as the top node (e.g. if
-                # the child is a terminal)
-                node.children = node.children[0].children
-
-            for child in node.children:
-                fix_double_indirection(child)
-
-        new_trees = []
-        for tree in trees:
-            new_tree = tree.copy()
-            replace_coalesced_nonterminals(new_tree)
-            fix_double_indirection(new_tree)
-            new_trees.append(new_tree)
-        return new_trees
-
-    def get_updated_grammar(classes: Dict[str, List[str]], get_class: Dict[str, str], grammar):
-        # Traverse through the grammar, and update each nonterminal to point to
-        # its class nonterminal
-        new_grammar = grammar.copy()
-        for nonterm in new_grammar.rules:
+    def update_grammar(classes: Dict[str, List[str]], get_class: Dict[str, str], grammar):
+        """
+        Mutative: points each coalesced nonterminal in `grammar` to its class nonterminal.
+        """
+        for nonterm in grammar.rules:
             if nonterm == "start":
                 continue
-            for body in new_grammar.rules[nonterm].bodies:
+            for body in grammar.rules[nonterm].bodies:
                 for i in range(len(body)):
                     # The keys of the rules determine the set of nonterminals
                     if body[i] in get_class:
@@ -694,20 +924,18 @@ def coalesce(oracle, trees: List[ParseNode], grammar: Grammar,
         for class_nt, nts in classes.items():
             rule = Rule(class_nt)
             for nt in nts:
-                old_rule = new_grammar.rules.pop(nt)
+                old_rule = grammar.rules.pop(nt)
                 for body in old_rule.bodies:
                     # Remove infinite recursions
                     if body == [class_nt]:
                         continue
                     rule.add_body(body)
-            new_grammar.add_rule(rule)
-        return new_grammar
+            grammar.add_rule(rule)
 
     # Define helpful data structures
     nonterminals = set(grammar.rules.keys())
     nonterminals.remove("start")
     nonterminals = list(nonterminals)
-    uf = UnionFind(nonterminals)
 
     # Get all unique pairs of nonterminals
     pairs = []
@@ -724,22 +952,85 @@ def coalesce(oracle, trees: List[ParseNode], grammar: Grammar,
         for i in range(len(nonterminals)):
             for j in range(i + 1, len(nonterminals)):
                 first, second = nonterminals[i], nonterminals[j]
+                if nt_groups is not None and same_group(nt_groups, first, second):
+                    continue
                 pairs.append((first, second))
+    if coalesce_target is None and signature.uses_signatures():
+        # Check the most similar pairs first, skipping the implausible ones
+        pairs = rank_pairs(pairs, compute_signatures(trees))
+
+    # Merges are recorded in a union-find structure, whose classes are named by
+    # class_names (the nonterminal the class was last coalesced into). The pairs
+    # were created before any merge, so they are checked against the current
+    # class of each nonterminal.
+    uf = UnionFind(set(nonterminals).union(*pairs))
+    class_names = {}
+
+    def current_class(nt):
+        return class_names.get(uf.find(nt), nt)
+
+    # Each pair is checked with the random state seeded by the pair, so that the checks
+    # give the same results whether they run serially or in parallel.
+    coalesce_seed = random.getrandbits(64)
+
+    def check_pair(first, second):
+        return replacement_valid_and_expanding(first, second, tree_list)
+
+    def verdict_key(first, second):
+        """
+        Returns the fingerprint of the check of (first, second) in the current trees,
+        or None if the check also depends on the grammar.
+        """
+        if MUST_EXPAND_IN_COALESCE and coalesce_target is not None:
+            return None
+        if isinstance(coalesce_target, tuple):
+            fingerprints = tree_list.level_fingerprint(first), tree_list.level_fingerprint(second)
+        else:
+            fingerprints = tree_list.fingerprint(first), tree_list.fingerprint(second)
+        return ('coalesce', isinstance(coalesce_target, tuple)) + fingerprints
+
+    def check_pairs_in_parallel(next_pairs):
+        """
+        Checks the pairs in `next_pairs` in the pool (forking it from the current
+        trees if needed), and stores their results in `prechecked`.
+        """
+        nonlocal pool
+        if pool is None:
+            pool = CheckPool(COALESCE_WORKERS, check_pair, oracle)
+        results = pool.map([(seed_for(coalesce_seed, first, second), (first, second))
+                            for first, second in next_pairs])
+        for (first, second), result in zip(next_pairs, results):
+            read_trees = {tree_idx for nt in (first, second) for tree_idx, _ in tree_list.occurrences(nt)}
+            prechecked[(first, second)] = (result, read_trees)
+
+    def next_unchecked_pairs(first, second, index):
+        """
+        Returns the pair (first, second) at `index` in `pairs`, followed by the next
+        pairs to check (up to a batch of them), with their current classes.
+        """
+        next_pairs = [(first, second)]
+        for pair in pairs[index + 1:]:
+            first, second = current_class(pair[0]), current_class(pair[1])
+            if first != second and (first, second) not in checked and (first, second) not in prechecked \
+                    and (first, second) not in next_pairs and verdict_key(first, second) not in verdict_memo:
+                next_pairs.append((first, second))
+                if len(next_pairs) == COALESCE_WORKERS * PAIRS_PER_WORKER:
+                    break
+        return next_pairs
+
+    # Only the full passes check enough pairs to be worth forking a pool for.
+    parallel = COALESCE_WORKERS > 1 and coalesce_target is None and can_fork()
+    pool = None
+    # Results of the pairs checked in parallel: (first, second) -> (whether they can
+    # be merged, indices of the trees the check depends on)
+    prechecked = {}
 
     coalesce_caused = False
-    coalesced_into = {}
     checked = set()
-    tree_list = ParseTreeList(trees, grammar)
-    for pair in pairs:
-        first, second = pair
-        # update the pair for the new grammar, because the pair was created before
-        # we performed any merges. If one of the labels was merged, replace it with
-        # its new label.
-        while first in coalesced_into and first != START:
-            first = coalesced_into[first]
-        while second in coalesced_into and second != START:
-            second = coalesced_into[second]
-        # and check that it's still valid
+    tree_list = trees if isinstance(trees, ParseTreeList) else ParseTreeList(trees, grammar)
+    tree_list.grammar = grammar
+    for pair_index, pair in enumerate(pairs):
+        first, second = current_class(pair[0]), current_class(pair[1])
         if first == second:
             continue
         if (first, second) in checked:
@@ -748,20 +1039,48 @@ def coalesce(oracle, trees: List[ParseNode], grammar: Grammar,
             checked.add((first, second))
 
         # If the nonterminals can replace each other in every context, they are replaceable
-        if replacement_valid_and_expanding(first, second, tree_list):
+        key = verdict_key(first, second)
+        can_merge = lookup_verdict(key)
+        if can_merge is not None:
+            prechecked.pop((first, second), None)
+        else:
+            if parallel and (first, second) not in prechecked:
+                check_pairs_in_parallel(next_unchecked_pairs(first, second, pair_index))
+            if parallel:
+                can_merge = prechecked.pop((first, second))[0]
+            else:
+                can_merge = run_seeded(seed_for(coalesce_seed, first, second), check_pair, first, second)
+            store_verdict(key, can_merge)
+        if can_merge:
             if first == START or second == START:
                 class_nt = START
             else:
                 class_nt = allocate_tid()
+            if not coalesce_caused:
+                # Copy the grammar once, then update it in place for each merge
+                grammar = grammar.copy()
+                tree_list.grammar = grammar
             classes = {class_nt: [first, second]}
             get_class = {first: class_nt, second: class_nt}
-            coalesced_into[first] = class_nt
-            coalesced_into[second] = class_nt
-            grammar = get_updated_grammar(classes, get_class, grammar)
-            new_inner_trees = get_updated_trees(get_class, tree_list.inner_list)
-            tree_list = ParseTreeList(new_inner_trees, grammar)
+            uf.connect(pair[0], pair[1])
+            class_names[uf.find(pair[0])] = class_nt
+            update_grammar(classes, get_class, grammar)
+            # Only the trees where first or second occur change (they are copied the
+            # first time, the other trees are shared with the caller's)
+            changed = tree_list.relabel(get_class)
             coalesce_caused = True
-
+            if parallel:
+                # The checks that read the changed trees must be redone, in a pool
+                # forked from the new trees.
+                for checked_pair, (_, read_trees) in list(prechecked.items()):
+                    if read_trees & changed or (MUST_EXPAND_IN_COALESCE and coalesce_target is not None):
+                        prechecked.pop(checked_pair)
+                if pool is not None:
+                    pool.close()
+                    pool = None
+
+    if pool is not None:
+        pool.close()
     trees = tree_list.inner_list
     return grammar, trees, coalesce_caused
 
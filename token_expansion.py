@@ -4,11 +4,11 @@ from typing import List
 
 from grammar import Grammar, Rule
 from oracle import ExternalOracle, ParseException
-from parse_tree import ParseNode, fixup_terminal
+from parse_tree import ParseNode, ParseTreeList, fixup_terminal
 
 import string
 
-from replacement_utils import get_strings_with_replacement, nt_in_tree
+from replacement_utils import get_strings_with_replacement
 
 """
 I'm sorry this code is so so so ugly. 
@@ -127,7 +127,7 @@ def try_strings(oracle: ExternalOracle, candidates: List[str]):
     return True
 
 
-def generalize_whitespace_in_rule(oracle: ExternalOracle, grammar: Grammar, trees: List[ParseNode], rule_start: str, body_idxs: List[int]):
+def generalize_whitespace_in_rule(oracle: ExternalOracle, grammar: Grammar, trees: ParseTreeList, rule_start: str, body_idxs: List[int]):
 
     existing_bodies = [fixup_terminal(body[0]) for idx, body in enumerate(grammar.rules[rule_start].bodies) if idx in body_idxs]
 
@@ -136,8 +136,9 @@ def generalize_whitespace_in_rule(oracle: ExternalOracle, grammar: Grammar, tree
 
     for c in other_chars:
         c_ok = True
-        for tree in [tree for tree in trees if nt_in_tree(tree, rule_start)]:
-            candidates = get_strings_with_replacement(tree, rule_start, c)
+        for tree_idx, paths in trees.trees_with_occurrences(rule_start):
+            tree = trees[tree_idx]
+            candidates = get_strings_with_replacement(tree, rule_start, c, paths, trees.template_cache)
             if not try_strings(oracle, candidates):
                 c_ok = False
                 break
@@ -152,8 +153,9 @@ def generalize_whitespace_in_rule(oracle: ExternalOracle, grammar: Grammar, tree
         longer_whitespaces.append(ws_str)
 
 
-    for tree in [tree for tree in trees if nt_in_tree(tree, rule_start)]:
-        candidates = get_strings_with_replacement(tree, rule_start, longer_whitespaces)
+    for tree_idx, paths in trees.trees_with_occurrences(rule_start):
+        tree = trees[tree_idx]
+        candidates = get_strings_with_replacement(tree, rule_start, longer_whitespaces, paths, trees.template_cache)
         if not try_strings(oracle, candidates):
             expand_ok = False
             break
@@ -175,7 +177,7 @@ def generalize_whitespace_in_rule(oracle: ExternalOracle, grammar: Grammar, tree
     return body_idxs, replace_str
 
 
-def generalize_digits_in_rule(oracle: ExternalOracle, grammar: Grammar, trees: List[ParseNode], rule_start: str, body_idxs: List[int]):
+def generalize_digits_in_rule(oracle: ExternalOracle, grammar: Grammar, trees: ParseTreeList, rule_start: str, body_idxs: List[int]):
 
     existing_bodies = [fixup_terminal(body[0]) for idx, body in enumerate(grammar.rules[rule_start].bodies) if idx in body_idxs]
 
@@ -197,21 +199,22 @@ def generalize_digits_in_rule(oracle: ExternalOracle, grammar: Grammar, trees: L
     ints_ok = True
     digits_ok = True
 
-    for tree in [tree for tree in trees if nt_in_tree(tree, rule_start)]:
+    for tree_idx, paths in trees.trees_with_occurrences(rule_start):
+        tree = trees[tree_idx]
         if digit_ok:
-            candidates = get_strings_with_replacement(tree, rule_start, single_digit_candidates)
+            candidates = get_strings_with_replacement(tree, rule_start, single_digit_candidates, paths, trees.template_cache)
             if not try_strings(oracle, candidates):
                 digit_ok = False
                 ints_ok = False
                 digits_ok = False
                 break
         if ints_ok:
-            candidates = get_strings_with_replacement(tree, rule_start, integer_candidates)
+            candidates = get_strings_with_replacement(tree, rule_start, integer_candidates, paths, trees.template_cache)
             if not try_strings(oracle, candidates):
                 ints_ok = False
                 digits_ok = False
         if digits_ok:
-            candidates = get_strings_with_replacement(tree, rule_start, digits_candidates)
+            candidates = get_strings_with_replacement(tree, rule_start, digits_candidates, paths, trees.template_cache)
             if not try_strings(oracle, candidates):
                 digits_ok = False
 
@@ -228,7 +231,7 @@ def generalize_digits_in_rule(oracle: ExternalOracle, grammar: Grammar, trees: L
         return body_idxs, replace_str
 
 
-def generalize_letters_in_rule(oracle: ExternalOracle, grammar: Grammar, trees: List[ParseNode], rule_start: str, body_idxs: List[int], expansion_type):
+def generalize_letters_in_rule(oracle: ExternalOracle, grammar: Grammar, trees: ParseTreeList, rule_start: str, body_idxs: List[int], expansion_type):
 
     existing_bodies = [fixup_terminal(body[0]) for idx, body in enumerate(grammar.rules[rule_start].bodies) if idx in body_idxs]
 
@@ -252,16 +255,17 @@ def generalize_letters_in_rule(oracle: ExternalOracle, grammar: Grammar, trees:
     expand_1_ok = True if single_candidates else False
     expand_multi_ok = True
 
-    for tree in [tree for tree in trees if nt_in_tree(tree, rule_start)]:
+    for tree_idx, paths in trees.trees_with_occurrences(rule_start):
+        tree = trees[tree_idx]
         if expand_1_ok:
             # we only get in here if we have
-            candidates = get_strings_with_replacement(tree, rule_start, single_candidates)
+            candidates = get_strings_with_replacement(tree, rule_start, single_candidates, paths, trees.template_cache)
             if not try_strings(oracle, candidates):
                 expand_1_ok = False
                 expand_multi_ok = False
                 break
         if expand_multi_ok:
-            candidates = get_strings_with_replacement(tree, rule_start, multi_candidates)
+            candidates = get_strings_with_replacement(tree, rule_start, multi_candidates, paths, trees.template_cache)
             if not try_strings(oracle, candidates):
                 expand_multi_ok = False
                 if not expand_1_ok: break
@@ -285,7 +289,7 @@ def generalize_letters_in_rule(oracle: ExternalOracle, grammar: Grammar, trees:
 
 
 
-def generalize_to_alphanum(oracle: ExternalOracle, grammar: Grammar, trees: List[ParseNode], rule_start: str, body_idxs: List[int]):
+def generalize_to_alphanum(oracle: ExternalOracle, grammar: Grammar, trees: ParseTreeList, rule_start: str, body_idxs: List[int]):
 
     existing_bodies = [fixup_terminal(body[0]) for idx, body in enumerate(grammar.rules[rule_start].bodies) if idx in body_idxs]
 
@@ -307,16 +311,17 @@ def generalize_to_alphanum(oracle: ExternalOracle, grammar: Grammar, trees: List
     expand_1_ok = True if single_candidates else False
     expand_multi_ok = True
 
-    for tree in [tree for tree in trees if nt_in_tree(tree, rule_start)]:
+    for tree_idx, paths in trees.trees_with_occurrences(rule_start):
+        tree = trees[tree_idx]
         if expand_1_ok:
             # we only get in here if we have
-            candidates = get_strings_with_replacement(tree, rule_start, single_candidates)
+            candidates = get_strings_with_replacement(tree, rule_start, single_candidates, paths, trees.template_cache)
             if not try_strings(oracle, candidates):
                 expand_1_ok = False
                 expand_multi_ok = False
                 break
         if expand_multi_ok:
-            candidates = get_strings_with_replacement(tree, rule_start, multi_candidates)
+            candidates = get_strings_with_replacement(tree, rule_start, multi_candidates, paths, trees.template_cache)
             if not try_strings(oracle, candidates):
                 expand_multi_ok = False
                 if not expand_1_ok: break
@@ -335,6 +340,8 @@ def expand_tokens(oracle : ExternalOracle, grammar : Grammar, trees: List[ParseN
 
     Currently only expands alphanumerics (not whitespace or punctuation)
     """
+    if not isinstance(trees, ParseTreeList):
+        trees = ParseTreeList(trees, grammar)
     rule_starts = set(grammar.rules.keys())
     def is_terminal(elem):
         return elem not in rule_starts
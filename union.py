@@ -1,5 +1,6 @@
 """
-No longer used.
+Union-find over nonterminals, used to record the classes of nonterminals
+merged by start.coalesce.
 """
 
 class UnionFind():
@@ -0,0 +1,63 @@
+import hashlib
+from typing import Dict, Tuple
+
+"""
+Memo of the verdicts of the checks done by start.coalesce and start.coalesce_partial,
+kept across bubbling iterations.
+
+A bubble rejected in one iteration of build_trees is usually tried again in the next
+ones, on trees that differ only where another bubble was accepted, and the checks it
+triggers are mostly the same as before. Each check is keyed by a fingerprint of what
+it depends on: for each nonterminal involved, the strings of the trees it occurs in
+and the spans of its occurrences there (which also give its derivable strings and the
+contexts of its occurrences). The fingerprints do not depend on the names of the
+nonterminals, which change every time a bubble is applied, so the verdict of a check
+whose inputs have not changed is found again and the check is skipped. The
+fingerprints are sha256 digests, so two different inputs do not share a verdict.
+They are computed by ParseTreeList.fingerprint (and level_fingerprint and
+rule_fingerprint), which keeps them until the trees of their nonterminal change.
+"""
+
+# Whether to memoize the verdicts of coalesce checks.
+MEMOIZE_VERDICTS = True
+
+verdict_memo: Dict[Tuple, object] = {}
+
+MEMO_HITS = 0
+MEMO_MISSES = 0
+
+
+def clear_verdicts():
+    """
+    Forgets all the verdicts (they are only valid for the same oracle).
+    """
+    global MEMO_HITS, MEMO_MISSES
+    verdict_memo.clear()
+    MEMO_HITS, MEMO_MISSES = 0, 0
+
+
+def lookup_verdict(key):
+    """
+    Returns the memoized verdict of the check with fingerprint `key`, or None.
+    """
+    global MEMO_HITS, MEMO_MISSES
+    if key is None or key not in verdict_memo:
+        MEMO_MISSES += 1
+        return None
+    MEMO_HITS += 1
+    return verdict_memo[key]
+
+
+def store_verdict(key, verdict):
+    if key is not None and MEMOIZE_VERDICTS:
+        verdict_memo[key] = verdict
+
+
+def digest(value):
+    """
+    Returns the sha256 digest of `value`, a tuple of strings, numbers, booleans,
+    None and digests, which repr encodes unambiguously.
+    >>> digest(('a', 1, None)) == digest(('a', 1, None)) != digest(('a', '1', None))
+    True
+    """
+    return hashlib.sha256(repr(value).encode('utf-8')).hexdigest()
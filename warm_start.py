@@ -0,0 +1,262 @@
+import pickle
+import re
+from collections import deque
+from typing import Dict, List, Tuple
+
+import next_tid
+import parser_cache
+from grammar import Grammar, Rule
+from parse_tree import ParseNode, fold_tree
+from start import START
+
+"""
+Warm start of a search from a grammar learned before (search.py --warm_start), so
+that a corpus which grows can be learned incrementally instead of from scratch.
+
+The examples the old grammar parses become parse trees over its nonterminals, and
+the rules of the old grammar that none of them uses get a witness tree each: a
+smallest derivation using the rule, kept if the oracle accepts its string. These
+trees are fixed: they are coalesced with the trees of the examples the old grammar
+does not parse, which are bubbled as usual, but never bubbled themselves, and only
+the merges involving a new nonterminal are checked. So the learning only pays for
+the new examples, and the rules of the old grammar are kept unless a merge with a
+new nonterminal generalizes them.
+
+The subtrees of the nonterminals added by token expansion (tdigits, tletter, ...)
+become single terminals, as the pretokenized examples were before the expansion,
+which is then redone at the end of the search.
+"""
+
+# Nonterminals allocated by next_tid, the others come from token expansion
+TID_RE = re.compile(r't([0-9]+)$')
+
+
+def load_gramdict(path: str) -> Grammar:
+    """
+    Returns the grammar pickled in the .gramdict file `path` by search.py.
+    """
+    grammar = Grammar(START)
+    with open(path, 'rb') as f:
+        grammar_dict: Dict[str, Rule] = pickle.load(f)
+    for rule in grammar_dict.values():
+        grammar.add_rule(rule)
+    return grammar
+
+
+def max_tid(grammar: Grammar):
+    """
+    Returns the largest number of a tN nonterminal of `grammar`.
+    >>> grammar = Grammar('t0')
+    >>> grammar.add_rule(Rule('t0').add_body(['t12', 'tdigits']))
+    >>> grammar.add_rule(Rule('t12').add_body(['"a"']))
+    >>> max_tid(grammar)
+    12
+    """
+    numbers = [int(match.group(1)) for match in map(TID_RE.match, grammar.rules) if match]
+    return max(numbers, default=0)
+
+
+def is_token_nt(nt: str):
+    return nt != 'start' and TID_RE.match(nt) is None
+
+
+def body_node(elem: str):
+    """
+    Returns the terminal ParseNode of the grammar element `elem` ("abc" or '' for
+    epsilon), None if `elem` is a nonterminal.
+    """
+    if elem == '':
+        return ParseNode('', True, [])
+    if len(elem) >= 2 and elem.startswith('"') and elem.endswith('"'):
+        return ParseNode(elem[1:-1], True, [])
+    return None
+
+
+def lark_to_parse_tree(lark_tree):
+    """
+    Converts the Lark parse tree `lark_tree` of a grammar's earley parser (built with
+    keep_all_tokens) to a ParseNode rooted at START, without recursion.
+    """
+    def leaf_value(node, path):
+        if not hasattr(node, 'data'):
+            return ParseNode(str(node), True, [])
+        if len(node.children) == 0:
+            return ParseNode(str(node.data), False, [ParseNode('', True, [])])
+        return None
+    def combine(node, children):
+        return ParseNode(str(node.data), False, children)
+    # fold_tree only needs the .children of the nodes, which Lark trees have
+    tree = fold_tree(lark_tree, leaf_value, combine)
+    # Skip the start -> t0 rule
+    return tree.children[0]
+
+
+def collapse_tokens(tree: ParseNode):
+    """
+    Replaces the subtrees of the nonterminals added by token expansion with single
+    terminals deriving the same string.
+    >>> tree = ParseNode('t0', False, [ParseNode('tdigits', False, [ParseNode('tdigit', False, [ParseNode('1', True, [])]),
+    ...                                                               ParseNode('tdigit', False, [ParseNode('2', True, [])])]),
+    ...                                 ParseNode('+', True, [])])
+    >>> [child.payload for child in collapse_tokens(tree).children]
+    ['12', '+']
+    """
+    def leaf_value(node, path):
+        if node.is_terminal:
+            return node
+        if is_token_nt(node.payload):
+            return ParseNode(node.derived_string(), True, [])
+        return None
+    def combine(node, children):
+        return ParseNode(node.payload, False, children)
+    return fold_tree(tree, leaf_value, combine)
+
+
+def smallest_derivations(grammar: Grammar):
+    """
+    Returns a map from each nonterminal of `grammar` deriving some string to a
+    smallest tree it derives (shortest string first, then lowest tree). The trees
+    share their subtrees.
+    >>> grammar = Grammar('t0')
+    >>> grammar.add_rule(Rule('t0').add_body(['t1', '"+"', 't0']).add_body(['t1']))
+    >>> grammar.add_rule(Rule('t1').add_body(['"(("', 't0', '"))"']).add_body(['"1"']))
+    >>> smallest_derivations(grammar)['t0'].derived_string()
+    '1'
+    """
+    rules = grammar.rules
+    # nt -> (string length, height, body), found by iterating to a fixpoint
+    best: Dict[str, Tuple[int, int, List[str]]] = {}
+    changed = True
+    while changed:
+        changed = False
+        for nt, rule in rules.items():
+            for body in rule.bodies:
+                length, height = 0, 0
+                for elem in body:
+                    node = body_node(elem)
+                    if node is not None:
+                        length += len(node.payload)
+                    elif elem in best:
+                        length += best[elem][0]
+                        height = max(height, best[elem][1])
+                    else:
+                        break
+                else:
+                    if nt not in best or (length, height + 1) < best[nt][:2]:
+                        best[nt] = (length, height + 1, body)
+                        changed = True
+
+    # The nonterminals of a smallest body are lower, so build the trees by height
+    trees: Dict[str, ParseNode] = {}
+    for nt in sorted(best, key=lambda nt: best[nt][1]):
+        body = best[nt][2]
+        trees[nt] = ParseNode(nt, False, [body_node(elem) or trees[elem] for elem in body])
+    return trees
+
+
+def witness_trees(grammar: Grammar, used_rules):
+    """
+    Returns, for the rules of `grammar` that are not in `used_rules` (a set of
+    (start, tuple(body))), smallest trees rooted at START using them. A tree is
+    built for each rule not used by the trees before it.
+    >>> grammar = Grammar('t0')
+    >>> grammar.add_rule(Rule('t0').add_body(['t1', '"+"', 't0']).add_body(['t1']))
+    >>> grammar.add_rule(Rule('t1').add_body(['"("', 't0', '")"']).add_body(['"1"']))
+    >>> [tree.derived_string() for tree in witness_trees(grammar, {('t0', ('t1',)), ('t1', ('"1"',))})]
+    ['1+1', '(1)']
+    """
+    smallest = smallest_derivations(grammar)
+    def expand(elem):
+        return body_node(elem) or smallest[elem]
+
+    def derivable(body):
+        return all(body_node(elem) is not None or elem in smallest for elem in body)
+    def body_length(body):
+        return sum(len(expand(elem).derived_string()) for elem in body)
+
+    # A shortest path of rule applications from START to each nonterminal, through
+    # the bodies deriving the shortest strings: nt -> (parent, body, index of nt in body)
+    parents = {START: None}
+    queue = deque([START])
+    while queue:
+        nt = queue.popleft()
+        if nt not in grammar.rules:
+            continue
+        for body in sorted(filter(derivable, grammar.rules[nt].bodies), key=body_length):
+            for idx, elem in enumerate(body):
+                if body_node(elem) is None and elem not in parents:
+                    parents[elem] = (nt, body, idx)
+                    queue.append(elem)
+
+    used_rules = set(used_rules)
+    witnesses = []
+    for rule_start, rule in grammar.rules.items():
+        # The rules of token expansion are redone anyway
+        if rule_start not in parents or is_token_nt(rule_start):
+            continue
+        for body in rule.bodies:
+            if (rule_start, tuple(body)) in used_rules:
+                continue
+            if not derivable(body):
+                continue
+            tree = ParseNode(rule_start, False, [expand(elem) for elem in body])
+            # Wrap the tree in the smallest context of its nonterminal
+            nt = rule_start
+            while parents[nt] is not None:
+                nt, parent_body, idx = parents[nt]
+                tree = ParseNode(nt, False, [tree if i == idx else expand(elem) for i, elem in enumerate(parent_body)])
+            used_rules.update((start, tuple(body)) for start, body in tree.rules())
+            witnesses.append(tree)
+    return witnesses
+
+
+def warm_start_trees(oracle, grammar: Grammar, leaves: List[List[ParseNode]]):
+    """
+    Splits the examples `leaves` into those parsed by `grammar`, whose parse trees are
+    returned, and the others, whose leaves are returned. Witness trees of the rules of
+    `grammar` no parse tree uses, whose strings `oracle` accepts, are added to the
+    parse trees. Makes sure the new nonterminals do not clash with the ones of `grammar`.
+    >>> import os, tempfile
+    >>> from lark import Lark
+    >>> from oracle import CachingOracle
+    >>> oracle = CachingOracle(Lark('start: e\\ne: t (("+"|"*") t)*\\nt: /[0-9]/ | "(" e ")"'))
+    >>> old = Grammar(START)
+    >>> old.add_rule(Rule('t0').add_body(['t1', '"+"', 't0']).add_body(['t1']))
+    >>> old.add_rule(Rule('t1').add_body(['"("', 't0', '")"']).add_body(['"1"']))
+    >>> path = os.path.join(tempfile.mkdtemp(), 'old.gramdict')
+    >>> with open(path, 'wb') as f:
+    ...     pickle.dump(old.rules, f)
+    >>> grammar = load_gramdict(path)
+    >>> sorted(grammar.rules) == sorted(old.rules)
+    True
+    >>> next_tid.next_tid = 1
+    >>> leaves = [[ParseNode(c, True, []) for c in ex] for ex in ['1+1', '1*1', '1']]
+    >>> fixed, new_leaves = warm_start_trees(oracle, grammar, leaves)
+    >>> [tree.derived_string() for tree in fixed], [''.join(leaf.payload for leaf in lst) for lst in new_leaves]
+    (['1+1', '1', '(1)'], ['1*1'])
+    >>> fixed[1].payload, fixed[1].children[0].payload, next_tid.next_tid
+    ('t0', 't1', 2)
+    """
+    next_tid.next_tid = max(next_tid.next_tid, max_tid(grammar) + 1)
+    parser = parser_cache.get_parser(str(grammar).replace('\u03B5', ''), keep_all_tokens=True)
+
+    parsed_trees, new_leaves = [], []
+    for leaf_lst in leaves:
+        try:
+            lark_tree = parser.parse(''.join(leaf.payload for leaf in leaf_lst))
+        except Exception:
+            new_leaves.append(leaf_lst)
+            continue
+        parsed_trees.append(lark_to_parse_tree(lark_tree))
+
+    used_rules = {(start, tuple(body)) for tree in parsed_trees for start, body in tree.rules()}
+    fixed_trees = [collapse_tokens(tree) for tree in parsed_trees]
+    for tree in witness_trees(grammar, used_rules):
+        try:
+            oracle.parse(tree.derived_string())
+        except Exception:
+            continue
+        fixed_trees.append(collapse_tokens(tree))
+    for tree in fixed_trees:
+        tree.update_cache_info()
+    return fixed_trees, new_leaves